@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Compares the single-pass max.rest.utils.extractEntities tokenizer with the legacy
+    findHashtags and findKeywords functions, on random posts of 140 to 5000 characters
+    with words, hashtags and urls.
+
+    Usage, with max installed in the environment:
+
+        python benchmarks/entities.py [number of posts] [number of rounds]
+"""
+
+import sys
+import re
+import random
+import timeit
+
+from max.rest.utils import extractEntities, getEntityValues
+from max.rest.utils import FIND_URL_REGEX, FIND_HASHTAGS_REGEX, FIND_KEYWORDS_REGEX
+
+
+# Legacy implementation, as it was before the single-pass tokenizer
+
+def legacyFindURLs(text):
+    return [match.group(0) for match in re.finditer(FIND_URL_REGEX, text)]
+
+
+def legacyFindHashtags(text):
+    hashtags = [a.groups()[1] for a in re.finditer(FIND_HASHTAGS_REGEX, text)]
+    lowercase = [hasht.lower() for hasht in hashtags]
+    return lowercase
+
+
+def legacyFindKeywords(text):
+    _text = text.lower().decode('utf-8')
+    stripped_urls = re.sub(FIND_URL_REGEX, '', _text)
+    keywords = [kw.groups()[1] for kw in re.finditer(FIND_KEYWORDS_REGEX, stripped_urls)]
+    return keywords
+
+
+WORDS = u'el la de que un una per amb canvi estatus creació informació reunió avui demà' \
+        u' universitat campus projecte docència recerca èxit'.split()
+HASHTAGS = [u'#upc', u'#max', u'#campus', u'#recerca', u'#docència']
+URLS = [u'http://www.upc.edu/noticies', u'https://github.com/upcnet/max', u'www.example.com/path?a=1']
+
+
+def buildPost(length):
+    """
+        Returns a random post of about length characters
+    """
+    tokens = []
+    size = 0
+    while size < length:
+        choice = random.random()
+        token = choice < 0.05 and random.choice(URLS) or choice < 0.15 and random.choice(HASHTAGS) or random.choice(WORDS)
+        tokens.append(token)
+        size += len(token) + 1
+    return u' '.join(tokens)
+
+
+def legacy(posts):
+    for post in posts:
+        legacyFindURLs(post)
+        legacyFindHashtags(post)
+        legacyFindKeywords(post.encode('utf-8'))
+
+
+def single_pass(posts):
+    for post in posts:
+        entities = extractEntities(post)
+        getEntityValues(entities, 'url')
+        getEntityValues(entities, 'hashtag')
+        getEntityValues(entities, 'keyword')
+
+
+def main(argv=sys.argv):
+    count = len(argv) > 1 and int(argv[1]) or 1000
+    rounds = len(argv) > 2 and int(argv[2]) or 5
+    random.seed(0)
+    posts = [buildPost(random.randint(140, 5000)) for i in range(count)]
+
+    for post in posts:
+        entities = extractEntities(post)
+        assert getEntityValues(entities, 'url') == legacyFindURLs(post)
+        assert getEntityValues(entities, 'hashtag') == legacyFindHashtags(post)
+        assert getEntityValues(entities, 'keyword') == legacyFindKeywords(post.encode('utf-8'))
+
+    legacy_time = timeit.timeit(lambda: legacy(posts), number=rounds)
+    single_pass_time = timeit.timeit(lambda: single_pass(posts), number=rounds)
+    processed = count * rounds
+
+    print "%d rounds of %d posts" % (rounds, count)
+    print "legacy:      %.3fs (%d posts/s)" % (legacy_time, processed / legacy_time)
+    print "single-pass: %.3fs (%d posts/s)" % (single_pass_time, processed / single_pass_time)
+    print "speedup:     %.1fx" % (legacy_time / single_pass_time)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+"""
+    Replays a log of MAX requests, or a synthesized mix of them, against a MAX
+    application loaded in-process from an .ini file, and reports the latency
+    percentiles, throughput and MongoDB operations of each route.
+
+    Usage, with max installed in the environment and a local MongoDB:
+
+        python benchmarks/replay.py [options] [log.jsonl]
+
+    The log has a request per line:
+
+        {"method": "GET", "path": "/people/messi/timeline", "params": {"limit": 10},
+         "body": null, "auth": {"oauth": "messi"}}
+
+    where auth is {"oauth": username} or {"basic": [username, password]}. Without a
+    log, a mix of timeline and context reads, posts, comments and subscriptions is
+    synthesized for --users users and --contexts contexts, and can be saved with
+    --record to be replayed later. Recorded comments refer to its activities by id,
+    so they must be replayed against the same database.
+
+    OAuth tokens are not validated against the oauth server: the benchmark users
+    tokens are stored as valid in the application token cache beforehand.
+
+    MongoDB operations are read from the serverStatus opcounters. They are reported
+    per route only when running with a single thread, and include the operations of
+    the application background threads (url shortening, notifications), if enabled.
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import base64
+import random
+import optparse
+import urllib
+import threading
+from hashlib import sha1
+
+from paste.deploy import loadapp
+from webtest import TestApp
+
+from max.rest.resources import RESOURCES
+
+DEFAULT_INI = os.path.join(os.path.dirname(__file__), '..', 'max', 'tests', 'tests.ini')
+BENCHMARK_TOKEN = 'benchmark-token'
+BENCHMARK_SCOPE = 'widgetcli'
+OPERATIONS = ['insert', 'query', 'update', 'delete', 'getmore', 'command']
+
+# Default weights of each kind of synthesized request
+DEFAULT_MIX = 'timeline=50,context=15,post=20,comment=10,subscribe=5'
+
+
+def parseMix(mix):
+    """
+        Parses a mix of request kinds as kind=weight,kind=weight...
+    """
+    weights = []
+    for part in mix.split(','):
+        kind, weight = part.split('=')
+        weights.append((kind.strip(), int(weight)))
+    return weights
+
+
+def buildRouteMatchers():
+    """
+        Returns (name, regex) pairs to find the route of a path
+    """
+    matchers = []
+    for name, properties in RESOURCES.items():
+        parts = re.split(r'\{[^}]+\}', properties['route'])
+        matchers.append((name, re.compile('^%s$' % '[^/]+'.join([re.escape(part) for part in parts]))))
+    return matchers
+
+
+def getRouteName(matchers, method, path):
+    """
+        Returns the METHOD route name of a path, or the path if not a known route
+    """
+    for name, regex in matchers:
+        if regex.match(path.split('?')[0]):
+            return '%s %s' % (method, name)
+    return '%s %s' % (method, path)
+
+
+def percentile(values, percent):
+    """
+        Returns the nearest-rank percentile of a sorted list of values
+    """
+    if not values:
+        return 0
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def authHeaders(auth):
+    """
+        Returns the headers of a request auth description
+    """
+    if 'oauth' in auth:
+        return {'X-Oauth-Token': BENCHMARK_TOKEN, 'X-Oauth-Username': str(auth['oauth']), 'X-Oauth-Scope': BENCHMARK_SCOPE}
+    username, password = auth['basic']
+    return {'Authorization': 'Basic %s' % base64.encodestring('%s:%s' % (username, password))[:-1]}
+
+
+class Benchmark(object):
+    """
+        Sends requests to the application, collecting its timings and database operations
+    """
+
+    def __init__(self, app, per_request_ops=True):
+        self.app = app
+        self.db = app.registry.max_store
+        self.matchers = buildRouteMatchers()
+        self.per_request_ops = per_request_ops
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.errors = {}
+        self.operations = {}
+        self.local = threading.local()
+        # Tokens must outlive the benchmark
+        self.app.registry.max_token_cache.ttl = 7 * 24 * 3600
+
+    def allowUser(self, username):
+        """
+            Stores the benchmark token of username as valid
+        """
+        self.app.registry.max_token_cache.set(BENCHMARK_TOKEN, username, BENCHMARK_SCOPE, True)
+
+    def getTestApp(self):
+        """
+            Returns the test client of the current thread
+        """
+        if not hasattr(self.local, 'testapp'):
+            self.local.testapp = TestApp(self.app)
+        return self.local.testapp
+
+    def getOpCounters(self):
+        """
+            Returns the operation counters of the MongoDB server
+        """
+        return self.db.connection.admin.command('serverStatus')['opcounters']
+
+    def send(self, record):
+        """
+            Sends a request record, and returns the response
+        """
+        method = record['method'].upper()
+        path = record['path']
+        params = record.get('params') or {}
+        if params:
+            path = '%s?%s' % (path, urllib.urlencode(params))
+        body = record.get('body')
+        body = body is not None and json.dumps(body) or ''
+        headers = authHeaders(record.get('auth', {'basic': ['operations', 'operations']}))
+
+        before = self.per_request_ops and self.getOpCounters() or None
+        start = time.time()
+        response = self.getTestApp().request(path, method=method, body=body, headers=headers, expect_errors=True)
+        elapsed = time.time() - start
+        after = self.per_request_ops and self.getOpCounters() or None
+
+        route = getRouteName(self.matchers, method, record['path'])
+        with self.lock:
+            self.timings.setdefault(route, []).append(elapsed)
+            if response.status_int >= 400:
+                self.errors[route] = self.errors.get(route, 0) + 1
+            if before is not None:
+                counts = self.operations.setdefault(route, dict([(operation, 0) for operation in OPERATIONS]))
+                for operation in OPERATIONS:
+                    counts[operation] += after[operation] - before[operation]
+                # Don't count the serverStatus command itself
+                counts['command'] -= 1
+        return response
+
+    def report(self, elapsed, total_operations):
+        """
+            Prints the collected timings
+        """
+        print '%-40s %7s %6s %9s %9s %9s %9s %8s' % ('route', 'count', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'db ops')
+        total = 0
+        for route in sorted(self.timings.keys()):
+            timings = sorted(self.timings[route])
+            total += len(timings)
+            operations = route in self.operations and '%.1f' % (sum(self.operations[route].values()) / float(len(timings))) or '-'
+            print '%-40s %7d %6d %9.1f %9.1f %9.1f %9.1f %8s' % (
+                route, len(timings), self.errors.get(route, 0),
+                percentile(timings, 50) * 1000, percentile(timings, 90) * 1000,
+                percentile(timings, 99) * 1000, timings[-1] * 1000, operations)
+        print
+        print '%d requests in %.2fs: %.1f requests/s' % (total, elapsed, total / elapsed)
+        print 'MongoDB operations: %s' % ', '.join(['%s %d' % (operation, total_operations[operation]) for operation in OPERATIONS])
+        if self.operations:
+            print '(db ops is the mean number of MongoDB operations per request of each route)'
+
+
+class MixGenerator(object):
+    """
+        Synthesizes a mix of requests of users to their timelines and contexts
+    """
+
+    def __init__(self, benchmark, users, contexts, mix, seed=None):
+        self.benchmark = benchmark
+        self.random = random.Random(seed)
+        self.usernames = ['benchmark%d' % i for i in range(users)]
+        self.urls = ['http://benchmark.upc.edu/%d' % i for i in range(contexts)]
+        self.weights = parseMix(mix)
+        self.subscriptions = dict([(username, set()) for username in self.usernames])
+        self.activities = []
+        self.lock = threading.Lock()
+
+    def setUp(self):
+        """
+            Creates the users and contexts, and subscribes each user to some contexts
+        """
+        for username in self.usernames:
+            self.benchmark.allowUser(username)
+            self.benchmark.send({'method': 'POST', 'path': '/people/%s' % username, 'auth': {'basic': ['operations', 'operations']}})
+        for url in self.urls:
+            context = {'url': url, 'displayName': 'Benchmark %s' % url.split('/')[-1],
+                       'permissions': dict(read='public', write='public', join='public', invite='subscribed')}
+            self.benchmark.send({'method': 'POST', 'path': '/contexts', 'body': context, 'auth': {'basic': ['operations', 'operations']}})
+        for username in self.usernames:
+            for url in self.random.sample(self.urls, min(2, len(self.urls))):
+                self.benchmark.send(self.subscribe(username, url))
+
+    def subscribe(self, username, url):
+        """
+            Returns the request subscribing username to the context url
+        """
+        with self.lock:
+            self.subscriptions[username].add(url)
+        return {'method': 'POST', 'path': '/people/%s/subscriptions' % username,
+                'body': {'object': {'objectType': 'context', 'url': url}},
+                'auth': {'basic': ['operations', 'operations']}}
+
+    def choose(self):
+        """
+            Returns a kind of request, chosen by its weight in the mix
+        """
+        point = self.random.uniform(0, sum([weight for kind, weight in self.weights]))
+        for kind, weight in self.weights:
+            point -= weight
+            if point <= 0:
+                return kind
+        return self.weights[-1][0]
+
+    def next(self):
+        """
+            Returns the next request to send
+        """
+        username = self.random.choice(self.usernames)
+        subscribed = sorted(self.subscriptions[username])
+        kind = self.choose()
+        if kind == 'comment' and not self.activities:
+            kind = 'post'
+        if kind == 'context' and not subscribed:
+            kind = 'timeline'
+
+        if kind == 'timeline':
+            return {'method': 'GET', 'path': '/people/%s/timeline' % username, 'auth': {'oauth': username}}
+        if kind == 'context':
+            return {'method': 'GET', 'path': '/activities', 'params': {'context': sha1(self.random.choice(subscribed)).hexdigest()},
+                    'auth': {'oauth': username}}
+        if kind == 'post':
+            activity = {'object': {'objectType': 'note', 'content': 'Benchmark #post %d http://example.com' % self.random.randint(0, 1000000)}}
+            if subscribed:
+                activity['contexts'] = [self.random.choice(subscribed)]
+            return {'method': 'POST', 'path': '/people/%s/activities' % username, 'body': activity, 'auth': {'oauth': username}}
+        if kind == 'comment':
+            with self.lock:
+                activity_id = self.random.choice(self.activities[-100:])
+            return {'method': 'POST', 'path': '/activities/%s/comments' % activity_id,
+                    'body': {'object': {'objectType': 'comment', 'content': 'Benchmark comment'}}, 'auth': {'oauth': username}}
+        if kind == 'subscribe':
+            return self.subscribe(username, self.random.choice(self.urls))
+        raise ValueError, 'Unknown kind of request: %s' % kind
+
+    def sent(self, record, response):
+        """
+            Remembers the activities created, to comment them later
+        """
+        if record['method'] == 'POST' and record['path'].endswith('/activities') and response.status_int == 201:
+            with self.lock:
+                self.activities.append(json.loads(response.body)['id'])
+
+
+class LogReplayer(object):
+    """
+        Replays the requests of a log, in order
+    """
+
+    def __init__(self, benchmark, records):
+        self.benchmark = benchmark
+        self.records = list(records)
+        self.position = 0
+        self.lock = threading.Lock()
+
+    def setUp(self):
+        """
+            Allows the tokens of all the users of the log
+        """
+        for username in set([record['auth']['oauth'] for record in self.records if 'oauth' in record.get('auth', {})]):
+            self.benchmark.allowUser(username)
+
+    def next(self):
+        """
+            Returns the next request of the log, or None when done
+        """
+        with self.lock:
+            if self.position >= len(self.records):
+                return None
+            self.position += 1
+            return self.records[self.position - 1]
+
+    def sent(self, record, response):
+        pass
+
+
+def run(benchmark, source, count, threads, recorded):
+    """
+        Sends count requests from source, or all of them if count is None, from threads
+        threads. Returns the elapsed time.
+    """
+    sent = [0]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if count is not None and sent[0] >= count:
+                    return
+                sent[0] += 1
+            record = source.next()
+            if record is None:
+                return
+            response = benchmark.send(record)
+            source.sent(record, response)
+            if recorded is not None:
+                with lock:
+                    recorded.write(json.dumps(record) + '\n')
+
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.time() - start
+
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser('usage: %prog [options] [log.jsonl]',
+                                   description='Replays MAX requests against an in-process application, and reports its timings')
+    parser.add_option('-c', '--config', dest='config', default=DEFAULT_INI,
+                      help='.ini file of the MAX application (default: max/tests/tests.ini)')
+    parser.add_option('-n', '--requests', dest='requests', type='int', default=None,
+                      help='Number of requests to send (default: all the log, or 1000 synthesized)')
+    parser.add_option('-t', '--threads', dest='threads', type='int', default=1,
+                      help='Number of concurrent clients (default: 1)')
+    parser.add_option('-u', '--users', dest='users', type='int', default=50,
+                      help='Number of users of the synthesized mix (default: 50)')
+    parser.add_option('-x', '--contexts', dest='contexts', type='int', default=10,
+                      help='Number of contexts of the synthesized mix (default: 10)')
+    parser.add_option('-m', '--mix', dest='mix', default=DEFAULT_MIX,
+                      help='Weights of the synthesized requests (default: %s)' % DEFAULT_MIX)
+    parser.add_option('-s', '--seed', dest='seed', type='int', default=None,
+                      help='Random seed of the synthesized mix')
+    parser.add_option('-r', '--record', dest='record', default=None,
+                      help='Save the requests sent to this file, as a log that can be replayed')
+    parser.add_option('--reset', dest='reset', action='store_true', default=False,
+                      help='Drop the database of the application before starting. Beware!')
+    options, args = parser.parse_args(argv[1:])
+
+    app = loadapp('config:%s' % os.path.abspath(options.config))
+    if options.reset:
+        db = app.registry.max_store
+        db.connection.drop_database(db.name)
+
+    benchmark = Benchmark(app, per_request_ops=options.threads == 1)
+    if args:
+        source = LogReplayer(benchmark, [json.loads(line) for line in open(args[0]) if line.strip()])
+        count = options.requests
+    else:
+        source = MixGenerator(benchmark, options.users, options.contexts, options.mix, seed=options.seed)
+        count = options.requests or 1000
+    source.setUp()
+
+    # Only the requests of the run itself are measured
+    benchmark.timings, benchmark.errors, benchmark.operations = {}, {}, {}
+    recorded = options.record and open(options.record, 'w') or None
+    before = benchmark.getOpCounters()
+    elapsed = run(benchmark, source, count, options.threads, recorded)
+    after = benchmark.getOpCounters()
+    if recorded is not None:
+        recorded.close()
+
+    benchmark.report(elapsed, dict([(operation, after[operation] - before[operation]) for operation in OPERATIONS]))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+    Compares the single-pass max.rest.utils.flattened serializer with the legacy
+    in-place flatten implementation, on a page of timeline-like activities.
+
+    Usage, with max installed in the environment:
+
+        python benchmarks/serializer.py [number of activities] [number of rounds]
+"""
+
+import sys
+import copy
+import json
+import timeit
+from datetime import datetime
+
+from bson import json_util
+from bson.objectid import ObjectId
+from rfc3339 import rfc3339
+
+from max.rest.utils import flattened
+
+
+# Legacy implementation, as it was before being replaced by flattened
+
+def decodeBSONEntity(di, key):
+    value = di[key]
+    if isinstance(value, ObjectId):
+        di[key] = str(value)
+        return
+    if isinstance(value, datetime):
+        di[key] = rfc3339(value, utc=True, use_system_timezone=False)
+        return
+    try:
+        decoded = json_util.default(di[key])
+        if len(decoded.keys()) == 1:
+            di[key] = decoded[decoded.keys()[0]]
+        else:
+            di[key] = decoded
+    except:
+        pass
+
+
+def deUnderescore(di, key):
+    if key.startswith('_'):
+        di[key.lstrip('_')] = di[key]
+        del di[key]
+
+
+def flattendict(di):
+    for key in di.keys():
+        value = di[key]
+        if isinstance(value, dict) or isinstance(value, list):
+            flatten(value)
+        else:
+            decodeBSONEntity(di, key)
+            deUnderescore(di, key)
+
+
+def flatten(data):
+    if isinstance(data, list):
+        for item in data:
+            flatten(item)
+    if isinstance(data, dict):
+        flattendict(data)
+
+
+def buildActivity(replies=5):
+    """
+        Returns an activity as stored in the database, with some replies
+    """
+    actor = {'_id': ObjectId(), 'username': 'messi', 'displayName': 'Lionel Messi', 'objectType': 'person'}
+    activity = {
+        '_id': ObjectId(),
+        'actor': actor,
+        'verb': 'post',
+        'published': datetime.utcnow(),
+        'object': {'objectType': 'note',
+                   'content': 'Hello world #benchmark http://example.com',
+                   '_hashtags': ['benchmark'],
+                   '_keywords': ['hello', 'world', 'benchmark']},
+        'contexts': [{'url': 'http://example.com/context', 'objectType': 'uri', 'displayName': 'Context'}],
+        'replies': {'totalItems': replies, 'items': []},
+    }
+    for i in range(replies):
+        activity['replies']['items'].append({
+            'id': ObjectId(),
+            'objectType': 'comment',
+            'content': 'A comment',
+            'author': dict(actor, published=datetime.utcnow()),
+            'published': datetime.utcnow(),
+            '_keywords': ['comment'],
+        })
+    return activity
+
+
+def legacy(activities):
+    activities = copy.deepcopy(activities)
+    flatten(activities)
+    return activities
+
+
+def single_pass(activities):
+    return flattened(activities)
+
+
+def main(argv=sys.argv):
+    count = len(argv) > 1 and int(argv[1]) or 100
+    rounds = len(argv) > 2 and int(argv[2]) or 100
+    activities = [buildActivity() for i in range(count)]
+
+    assert json.dumps(legacy(activities), sort_keys=True) == json.dumps(single_pass(activities), sort_keys=True)
+
+    # The legacy implementation mutates its input, so both are measured on a copy
+    copy_time = timeit.timeit(lambda: copy.deepcopy(activities), number=rounds)
+    legacy_time = timeit.timeit(lambda: legacy(activities), number=rounds) - copy_time
+    single_pass_time = timeit.timeit(lambda: single_pass(activities), number=rounds)
+
+    print "%d rounds of %d activities" % (rounds, count)
+    print "legacy flatten:      %.3fs" % legacy_time
+    print "single-pass flatten: %.3fs" % single_pass_time
+    print "speedup:             %.1fx" % (legacy_time / single_pass_time)
+
+if __name__ == '__main__':
+    sys.exit(main())
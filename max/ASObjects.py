@@ -1,4 +1,4 @@
-from max.rest.utils import formatMessageEntities, findHashtags, findKeywords
+from max.rest.utils import extractEntities, getEntityValues
 from max.MADObjects import MADDict
 
 
@@ -39,11 +39,11 @@ class Note(ASObject):
         """
         self.data = data
         self.processFields()
-        self.data['content'] = formatMessageEntities(self.data['content'])
-        hashtags = findHashtags(self.data['content'])
+        entities = extractEntities(self.data['content'])
+        hashtags = getEntityValues(entities, 'hashtag')
         if hashtags:
             self.data['_hashtags'] = hashtags
-        self.data['_keywords'] = findKeywords(self.data['content'])
+        self.data['_keywords'] = getEntityValues(entities, 'keyword')
         self.update(self.data)
 
 
@@ -67,11 +67,11 @@ class Comment(ASObject):
         """
         self.data = data
         self.processFields()
-        self.data['content'] = formatMessageEntities(self.data['content'])
-        hashtags = findHashtags(self.data['content'])
+        entities = extractEntities(self.data['content'])
+        hashtags = getEntityValues(entities, 'hashtag')
         if hashtags:
             self.data['_hashtags'] = hashtags
-        self.data['_keywords'] = findKeywords(self.data['content'])
+        self.data['_keywords'] = getEntityValues(entities, 'keyword')
         self.update(self.data)
 
 
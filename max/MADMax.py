@@ -1,11 +1,58 @@
 #MADMax  Mongo Access Delegate for Max
 
 from max.exceptions import ObjectNotFound
+from max.instrumentation import timed
 from bson.objectid import ObjectId
 import sys
-from pymongo import DESCENDING
+from pymongo import ASCENDING, DESCENDING
 
 UNDEF = "__NO_DEFINED_VALUE_FOR_GETATTR__"
+STREAM_BATCH_SIZE = 100
+
+
+class IdentityMap(object):
+    """
+        Request-scoped store of the items already loaded from the database, so
+        repeated dict-like and getItemsBy* lookups of the same key in a request
+        return the same object without hitting the database. Every lookup kind
+        stores the list of items found, so they can share the same keys.
+
+        Keeps counters of the lookups served from memory (hits) and of the
+        queries that had to go to the database (queries)
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.hits = 0
+        self.queries = 0
+
+    def get(self, key):
+        """
+            Returns the item stored for key, or None if not present
+        """
+        item = self.items.get(key, None)
+        if item is not None:
+            self.hits += 1
+        return item
+
+    def set(self, key, item):
+        """
+            Stores the item for key
+        """
+        self.items[key] = item
+
+    def invalidate(self, collection_name):
+        """
+            Forgets all the items of a collection, used after writing on it
+        """
+        for key in [key for key in self.items if key[0] == collection_name]:
+            del self.items[key]
+
+    def stats(self):
+        """
+            Returns the counters of this request
+        """
+        return dict(hits=self.hits, queries=self.queries)
 
 
 class MADMaxCollection(object):
@@ -13,15 +60,37 @@ class MADMaxCollection(object):
         Wrapper for accessing collections
     """
 
-    def __init__(self, collection, query_key='_id', field_filter=None):
+    def __init__(self, collection, query_key='_id', field_filter=None, identity_map=None):
         """
             Wrapper for accessig a collection. Acces to items can be performed dict-like using "_id" as
             key for finding items, or any field specified in "query_key". Anything passed in query_key must have unique values
             as we will perform find_one queries for dict-like access
+
+            If an identity_map is given, dict-like and getItemsBy* lookups are remembered on it
         """
         self.collection = collection
         self.query_key = query_key
         self.show_fields = field_filter
+        self.identity_map = identity_map
+
+    def _getIdentityKey(self, fieldname, value):
+        """
+            Returns the key of a lookup in the identity map, or None if the lookup can't be
+            remembered, because there's no identity map, the value is not hashable or only
+            some fields of the items are retrieved
+        """
+        if self.identity_map is None or self.show_fields:
+            return None
+        if isinstance(value, (dict, list)):
+            return None
+        return (self.collection.name, fieldname, unicode(value))
+
+    def _countQuery(self):
+        """
+            Counts a database round trip on the identity map
+        """
+        if self.identity_map is not None:
+            self.identity_map.queries += 1
 
     def setQueryKey(self, key):
         """
@@ -50,6 +119,7 @@ class MADMaxCollection(object):
                 hashtag: A list of hastags to filter activities by
                 keywords: A list of keywords to filter activities by
                 author: A username to filter activitues by author
+                ids: A list of ids to restrict the search to, as resolved from the term index
         """
 
         #Extract known params from kwargs
@@ -59,6 +129,7 @@ class MADMaxCollection(object):
         hashtag = kwargs.get('hashtag', None)
         keywords = kwargs.get('keywords', None)
         author = kwargs.get('author', None)
+        ids = kwargs.get('ids', None)
 
         if after or before:
             condition = after and '$gt' or '$lt'
@@ -66,49 +137,73 @@ class MADMaxCollection(object):
         else:
             offset = None
 
-        if query:
-            if offset:
-                # Filter the query to return objects created later or earlier than the one
-                # represented by offset (offset not included)
-                query.update({'_id': {condition: offset}})
-
-            if hashtag:
-                # Filter the query to only objects containing certain hashtags
-                hashtag_query = {'$and': []}
-                for hasht in hashtag:
-                    hashtag_query['$and'].append({'object._hashtags': hasht})
-                query.update(hashtag_query)
-
-            if author:
-                # Filter the query to only objects containing certain hashtags
-                username_query = {'actor.username':author}
-                query.update(username_query)
-
-            if keywords:
-                # Filter the query to only objects containing certain keywords
-                keywords_query = {'$and': []}
-                for keyw in keywords:
-                    keywords_query['$and'].append({'object._keywords': keyw})
-                query.update(keywords_query)
-
-            # Cursor is lazy, but better to execute search here for mental sanity
-            self.setVisibleResultFields(show_fields)
-            cursor = self.collection.find(query, self.show_fields)
-
-
-        else:
-            cursor = self.collection.find()
+        # Work on a copy, so the caller's query is not modified
+        query = dict(query or {})
+
+        if offset:
+            # Filter the query to return objects created later or earlier than the one
+            # represented by offset (offset not included)
+            self._addIdCondition(query, condition, offset)
+
+        if ids is not None:
+            # Filter the query to only objects with the given ids
+            self._addIdCondition(query, '$in', ids)
+
+        if hashtag:
+            # Filter the query to only objects containing certain hashtags
+            hashtag_query = {'$and': []}
+            for hasht in hashtag:
+                hashtag_query['$and'].append({'object._hashtags': hasht})
+            query.update(hashtag_query)
+
+        if author:
+            # Filter the query to only objects containing certain hashtags
+            username_query = {'actor.username':author}
+            query.update(username_query)
+
+        if keywords:
+            # Filter the query to only objects containing certain keywords
+            keywords_query = {'$and': []}
+            for keyw in keywords:
+                keywords_query['$and'].append({'object._keywords': keyw})
+            query.update(keywords_query)
+
+        # Cursor is lazy, but better to execute search here for mental sanity
+        self._countQuery()
+        self.setVisibleResultFields(show_fields)
+        cursor = self.collection.find(query, self.show_fields)
+
+        # When asking for a limited page of objects past an offset against the sort order
+        # (newer ones in descending order, older ones in ascending order), walk away from the
+        # offset, so we get the page right next to it, and restore the requested order later
+        walk_reversed = limit and sort == '_id' and (after and sort_dir == DESCENDING or before and sort_dir == ASCENDING)
 
         # Sort and limit the results if specified
         if sort:
-            cursor = cursor.sort(sort, sort_dir)
+            cursor = cursor.sort(sort, walk_reversed and -sort_dir or sort_dir)
         if limit:
             cursor = cursor.limit(limit)
 
         # Unpack the lazy cursor,
         # Wrap the result in its Mad Class,
         # and flattens it if specified
-        return [self.ItemWrapper(result, flatten=flatten) for result in cursor]
+        with timed('db'):
+            items = list(cursor)
+        results = [self.ItemWrapper(result, flatten=flatten) for result in items]
+        if walk_reversed:
+            results.reverse()
+        return results
+
+    def _addIdCondition(self, query, condition, value):
+        """
+            Adds a condition on _id to query, keeping the existing ones
+        """
+        id_query = query.get('_id', {})
+        id_query = isinstance(id_query, dict) and dict(id_query) or {'$in': [id_query]}
+        if condition == '$in' and '$in' in id_query:
+            value = [item for item in id_query['$in'] if item in set(value)]
+        id_query[condition] = value
+        query['_id'] = id_query
 
     def _getQuery(self, itemID):
         """
@@ -134,6 +229,7 @@ class MADMaxCollection(object):
         model = getattr(sys.modules['max.models'], class_map[self.collection.name], None)
         wrapped = model()
         wrapped.fromObject(item, collection=self.collection)
+        wrapped.identity_map = self.identity_map
         if flatten:
             return wrapped.flatten()
         else:
@@ -145,18 +241,64 @@ class MADMaxCollection(object):
 
             XXX TODO : Check if fieldname exists in the current collection
         """
+        key = self._getIdentityKey(fieldname, value)
+        if key:
+            items = self.identity_map.get(key)
+            if items is not None:
+                return list(items)
+
         query = {}
         query[fieldname] = value
-        return self.search(query)
+        items = self.search(query)
+
+        if key:
+            self.identity_map.set(key, list(items))
+        return items
+
+    def _getItemsMapByFieldName(self, fieldname, values):
+        """
+            Resolves many values of a single fieldname in one $in query, and returns
+            a dict of the found items keyed by its fieldname value. Values not found
+            are not present in the result.
+        """
+        found = {}
+        pending = []
+        for value in set(values):
+            key = self._getIdentityKey(fieldname, value)
+            items = key and self.identity_map.get(key)
+            if items:
+                found[value] = items[0]
+            else:
+                pending.append(value)
+
+        if pending:
+            query = {fieldname: {'$in': pending}}
+            for item in self.search(query):
+                found[item[fieldname]] = item
+                key = self._getIdentityKey(fieldname, item[fieldname])
+                if key:
+                    self.identity_map.set(key, [item])
+        return found
 
     def __getitem__(self, itemID):
         """
             Returns an unique item of the collection
         """
-        query = self._getQuery(itemID)
-        item = self.collection.find_one(query, self.show_fields)
-        if item:
-            return self.ItemWrapper(item)
+        key = self._getIdentityKey(self.query_key, itemID)
+        items = None
+        if key:
+            items = self.identity_map.get(key)
+        if items is None:
+            query = self._getQuery(itemID)
+            self._countQuery()
+            with timed('db'):
+                item = self.collection.find_one(query, self.show_fields)
+            items = item and [self.ItemWrapper(item)] or []
+            if key:
+                self.identity_map.set(key, items)
+
+        if items:
+            return items[0]
         else:
             raise ObjectNotFound, "Object with id %s not found inside %s" % (itemID,self.collection.name)
 
@@ -164,13 +306,31 @@ class MADMaxCollection(object):
         """
             Enables single field queries on the collection,  by calling dynamically-created functions
             with the form myCollection.getItemsByFieldName, where 'FieldName' is a known field of the collection's items.
+
+            Many values can be resolved at once using myCollection.getItemsMapByFieldName, that returns
+            a dict of items keyed by 'FieldName'.
         """
-        if name.startswith('getItemsBy'):
+        if name.startswith('getItemsMapBy'):
+            fieldname = name[13:]
+            return lambda values: self._getItemsMapByFieldName(fieldname, values)
+        elif name.startswith('getItemsBy'):
             fieldname = name[10:]
             return lambda value: self._getItemsByFieldName(fieldname, value)
         else:
             getattr(self, name)
 
+    def iterate(self, query=None, show_fields=None, flatten=0, batch_size=STREAM_BATCH_SIZE):
+        """
+            Lazily iterates over the objects matching query (all objects if none), in insertion order.
+            Objects are fetched from the database in batches of batch_size and wrapped one at a time,
+            so the memory used doesn't depend on the number of objects matched.
+        """
+        self._countQuery()
+        self.setVisibleResultFields(show_fields)
+        cursor = self.collection.find(query or {}, self.show_fields).sort('_id', ASCENDING).batch_size(batch_size)
+        for result in cursor:
+            yield self.ItemWrapper(result, flatten=flatten)
+
     def dump(self, flatten=0):
         """
             Returns all records of a collection
@@ -184,10 +344,12 @@ class MADMaxDB(object):
         Wrapper for accessing Database
     """
 
-    def __init__(self, db):
+    def __init__(self, db, identity_map=None):
         """
+            If an identity_map is given, all the collection wrappers share it
         """
         self.db = db
+        self.identity_map = identity_map
 
     def __getattr__(self, name, default=UNDEF):
         """
@@ -196,7 +358,7 @@ class MADMaxDB(object):
         #First we try to access a colleccion named "name"
         collection = getattr(self.db, name, None)
         if collection:
-            return MADMaxCollection(collection)
+            return MADMaxCollection(collection, identity_map=self.identity_map)
         else:
             #If no collection found, try to get a class attribute
             try:
@@ -1,5 +1,7 @@
-from max.rest.utils import extractPostData, flatten, RUDict
+from max.rest.utils import extractPostData, flattened, RUDict
 from max.exceptions import MissingField, ObjectNotSupported, DuplicatedItemError, UnknownUserError, ValidationError
+from pymongo.errors import DuplicateKeyError
+from max.instrumentation import timed
 import datetime
 from pyramid.request import Request
 import sys
@@ -180,23 +182,47 @@ class MADBase(MADDict):
         Provides the methods to validate and construct an object according to activitystrea.ms
         specifications by subclassing it and providing an schema with the required fields,
         and a structure builder function 'buildObject'
+
+        Objects with a 'unique' field are looked up before being created, and returned
+        as they are if already existing. Objects with an 'idempotency_key' field may carry
+        a client supplied key instead (Idempotency-Key header), that must be backed by a
+        unique index on the actor and the key, so repeated creations are detected by the
+        insert itself. Without the index, repeated keys are not detected at all.
     """
 
     unique = ''
+    idempotency_key = ''
+    duplicated = False
     collection = ''
+    indexes = []
     mdb_collection = None
+    identity_map = None
     data = {}
 
     def fromRequest(self, request, rest_params={}):
-        self.mdb_collection = request.context.db[self.collection]
-
-        self.data = RUDict({})
-        self.data.update(extractPostData(request))
-        self.data.update(rest_params)
+        data = extractPostData(request)
+        if self.idempotency_key and request.headers.get('Idempotency-Key'):
+            data[self.idempotency_key] = request.headers['Idempotency-Key']
 
         # Since we are building from a request,
         # overwrite actor with the validated one from the request in source
-        self.data['actor'] = request.actor
+        self.fromData(data, request.actor, request.context.db,
+                      identity_map=getattr(request.context, 'identity_map', None),
+                      rest_params=rest_params)
+
+    def fromData(self, data, actor, db, identity_map=None, rest_params={}):
+        """
+            Validates and builds the object from a dict of data posted by actor,
+            the same way as fromRequest does with the request body. Used to build
+            many objects in the same request.
+        """
+        self.mdb_collection = db[self.collection]
+        self.identity_map = identity_map
+
+        self.data = RUDict({})
+        self.data.update(data)
+        self.data.update(rest_params)
+        self.data['actor'] = actor
 
         self.processFields()
 
@@ -224,24 +250,64 @@ class MADBase(MADDict):
         return properties
 
 
+    def invalidateIdentityMap(self, collection_name=None):
+        """
+            Forgets the items loaded in the current request from the collection
+            of this object, or from collection_name if specified. Must be called after
+            any write, so later lookups in the request get fresh data
+        """
+        if self.identity_map is not None:
+            self.identity_map.invalidate(collection_name or self.mdb_collection.name)
+
     def insert(self):
         """
             Inserts the item into his defined collection and returns its _id
+
+            If the item carries an idempotency key already used by the same actor, nothing
+            is inserted: the item is populated with the existing object and marked as duplicated
         """
-        oid = self.mdb_collection.insert(self)
+        try:
+            oid = self.mdb_collection.insert(self)
+        except DuplicateKeyError:
+            existing = self.findIdempotentDuplicate()
+            if existing is None:
+                raise
+            self.update(existing)
+            self.duplicated = True
+            return str(existing['_id'])
+        self.invalidateIdentityMap()
         return str(oid)
 
+    def findIdempotentDuplicate(self):
+        """
+            Returns the object created before with the same idempotency key and actor
+            as this one, or None if the object has no idempotency key.
+            Raises if the key was used by another actor.
+        """
+        key = self.idempotency_key and self.get(self.idempotency_key)
+        if not key:
+            return None
+        query = {self.idempotency_key: key}
+        if 'actor' in self:
+            query['actor._id'] = self['actor']['_id']
+        existing = self.mdb_collection.find_one(query)
+        if existing is None:
+            raise DuplicatedItemError, 'Idempotency key "%s" already used' % key
+        return existing
+
     def save(self):
         """
             Updates itself to the database
         """
         self.mdb_collection.save(self)
+        self.invalidateIdentityMap()
 
     def delete(self):
         """
             Removes the object from the DB
         """
         self.mdb_collection.remove({'_id': self._id})
+        self.invalidateIdentityMap()
 
     def addToList(self, field, obj, allow_duplicates=False, safe=True):
         """
@@ -267,6 +333,7 @@ class MADBase(MADDict):
                                        '$inc': {count: 1}
                                       }
                                      )
+            self.invalidateIdentityMap()
         else:
             if not safe:
                 raise DuplicatedItemError, 'Item already on list "%s"' % (field)
@@ -282,9 +349,12 @@ class MADBase(MADDict):
     def alreadyExists(self):
         """
             Checks if there's an object with the value specified in the unique field.
-            If present, return the object, otherwise returns None
+            If present, return the object, otherwise returns None. Objects without a unique
+            field, or without a value for it, don't query the database.
         """
         unique = self.unique
+        if not unique or self.data.get(unique) is None:
+            return None
         query = {unique: self.data.get(unique)}
         return self.mdb_collection.find_one(query)
 
@@ -293,9 +363,8 @@ class MADBase(MADDict):
             Recursively transforms non-json-serializable values and simplifies
             $oid and $data BISON structures. Intended for final output
         """
-        dd = dict([(key, self[key]) for key in self.keys()])
-        flatten(dd)
-        return dd
+        with timed('flatten'):
+            return flattened(dict([(key, self[key]) for key in self.keys()]))
 
     def getObjectWrapper(self, objType):
         """
@@ -3,11 +3,17 @@ from pyramid.config import Configurator
 from pyramid.session import UnencryptedCookieSessionFactoryConfig
 from pyramid_who.whov2 import WhoV2AuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.settings import asbool
 
 from max.resources import Root, loadMAXSettings
 from max.rest.resources import RESOURCES
-
-import pymongo
+from max.timelines import isTimelineFanOutEnabled, ensureTimelineIndexes
+from max.terms import isTermIndexEnabled, ensureTermIndexes
+from max.oauth2 import TokenCache, buildOAuthSession
+from max.shortener import URLShortenerPool
+from max.notifications import startTimelineNotifier
+from max.mongodb import getDatabase, getReadDatabases, getWriteConcerns
+from max.instrumentation import RequestMetrics, startStackSampler
 
 DEFAULT_CONTEXT_PERMISSIONS = dict(read='public', write='public', join='public', invite='public')
 
@@ -38,15 +44,44 @@ def main(global_config, **settings):
     config.add_route('profiles', '/profiles/{username}')
     config.add_route('wadl', '/WADL')
 
-    # Store in registry
-    db_uri = settings['mongodb.url']
-    conn = pymongo.Connection(db_uri)
-    db = conn[settings['mongodb.db_name']]
+    # Store in registry, along with the databases for the read preferences declared
+    # in RESOURCES and the write concerns of each type of operation
+    db = getDatabase(settings)
     config.registry.max_store = db
+    read_preferences = set([properties['read_preference'] for properties in RESOURCES.values() if 'read_preference' in properties])
+    config.registry.max_read_stores = getReadDatabases(settings, db, read_preferences)
+    config.registry.max_write_concerns = getWriteConcerns(settings)
 
     # Set MAX settings
     config.registry.max_settings = loadMAXSettings(settings, config)
 
+    # OAuth token validation cache and connection pool to the oauth server
+    config.registry.max_token_cache = TokenCache.fromSettings(config.registry.max_settings, db)
+    config.registry.max_oauth_session = buildOAuthSession(config.registry.max_settings)
+
+    # Background url shortening
+    config.registry.max_shortener = URLShortenerPool.fromSettings(config.registry.max_settings, db)
+
+    # Request timing counters, and stacks sampling of slow requests
+    config.registry.max_metrics = RequestMetrics()
+    config.registry.max_sampler = startStackSampler(config.registry.max_settings)
+
+    # Wake up the long-polling timeline requests on new activities
+    config.registry.max_notifier = startTimelineNotifier(config.registry.max_settings, db)
+
+    # Create the declared indexes missing in the database
+    if asbool(config.registry.max_settings.get('max_ensure_indexes', False)):
+        # Imported here, as max.models depends on this module
+        from max.indexes import ensureIndexes
+        ensureIndexes(db)
+
+    else:
+        # Materialized timelines and the term index need their indexes to be usable
+        if isTimelineFanOutEnabled(config.registry.max_settings):
+            ensureTimelineIndexes(db)
+        if isTermIndexEnabled(config.registry.max_settings):
+            ensureTermIndexes(db)
+
     # REST Resources
     # Configure routes based on resources defined in RESOURCES
     for name, properties in RESOURCES.items():
@@ -1,12 +1,18 @@
 from max.exceptions import MissingField, ObjectNotSupported, ObjectNotFound, DuplicatedItemError, UnknownUserError, Unauthorized, InvalidSearchParams, InvalidPermission, ValidationError
-from max.exceptions import JSONHTTPUnauthorized, JSONHTTPBadRequest
+from max.exceptions import JSONHTTPUnauthorized, JSONHTTPBadRequest, JSONHTTPServiceUnavailable, ServiceUnavailable
 from pyramid.httpexceptions import HTTPInternalServerError
 from bson.errors import InvalidId
 from max.MADMax import MADMaxDB
 from max.resources import Root
-from max.rest.resources import RESOURCES
+from max.rest.resources import RESOURCES, NO_CACHE
 from max.rest.utils import isOauth, isBasic, getUsernameFromXOAuth, getUsernameFromURI, getUsernameFromPOSTBody, getUrlHashFromURI
 from max.models import User, Context
+from max.instrumentation import timeRequest
+
+import logging
+import time
+
+logger = logging.getLogger('max')
 
 
 def MaxRequest(func):
@@ -15,8 +21,13 @@ def MaxRequest(func):
         context, request = isinstance(nkargs[0], Root) and tuple(nkargs) or tuple(nkargs[::-1])
 
         actor = None
-        mmdb = MADMaxDB(context.db)
-        admin_ws = [('admin_users', 'GET'), ('admin_activities', 'GET'), ('admin_contexts', 'GET'), ('admin_user', 'DELETE'), ('admin_activity', 'DELETE'), ('admin_context', 'DELETE')]
+        started = time.time()
+        # The actor is always loaded from the primary, regardless of the route read preference
+        mmdb = MADMaxDB(context.primary_db, identity_map=context.identity_map)
+        # Bulk webservices carry a list of objects, each one with its own actor, in the POST body
+        bulk_ws = [('admin_activities', 'POST')]
+        admin_ws = [('admin_users', 'GET'), ('admin_activities', 'GET'), ('admin_contexts', 'GET'), ('admin_user', 'DELETE'), ('admin_activity', 'DELETE'), ('admin_context', 'DELETE'), ('admin_connections', 'GET'), ('admin_metrics', 'GET')] + bulk_ws
+        is_bulk = (request.matched_route.name, request.method) in bulk_ws
         allowed_ws_without_username = admin_ws + [('contexts', 'POST'), ('context', 'GET'), ('context', 'PUT'), ('context', 'DELETE')]
         allowed_ws_without_actor = [('user', 'POST')] + allowed_ws_without_username
 
@@ -32,7 +43,7 @@ def MaxRequest(func):
             # to rest_username/post_username
             if rest_username and oauth_username != rest_username:
                 raise Unauthorized, "You don't have permission to access %s resources" % (rest_username)
-            post_username = getUsernameFromPOSTBody(request)
+            post_username = not is_bulk and getUsernameFromPOSTBody(request) or None
             if post_username and oauth_username != post_username:
                 raise Unauthorized, "You don't have permission to access %s resources" % (post_username)
             # If user validation is successfull, try to load the oauth User from DB
@@ -49,7 +60,7 @@ def MaxRequest(func):
             #Try to get the username from the REST URI
             username = getUsernameFromURI(request)
             #Try to get the username from the POST body
-            if not username and request.method == 'POST':
+            if not username and request.method == 'POST' and not is_bulk:
                 username = getUsernameFromPOSTBody(request)
 
             # If no actor specified anywhere, raise an error
@@ -87,6 +98,9 @@ def MaxRequest(func):
         else:
             raise Unauthorized, "There are no supported authentication methods present in this request"
 
+        if context.timer is not None:
+            context.timer.add('actor', time.time() - started)
+
         # If we arrive at this point, we have a valid user in actor.
         # (Except in the case of a new users explained 10 lines up)
         # Define a callable to prepare the actor in order to inject it in the request
@@ -113,40 +127,46 @@ def MaxResponse(fun):
         # issue proper status code with message
         nkargs = [a for a in args]
         context, request = isinstance(nkargs[0], Root) and tuple(nkargs) or tuple(nkargs[::-1])
-        try:
-            response = fun(*args, **kwargs)
-        except InvalidId, message:
-            return JSONHTTPBadRequest(error=dict(error=InvalidId.__name__, error_description=message.value))
-        except ObjectNotSupported, message:
-            return JSONHTTPBadRequest(error=dict(error=ObjectNotSupported.__name__, error_description=message.value))
-        except ObjectNotFound, message:
-            return JSONHTTPBadRequest(error=dict(error=ObjectNotFound.__name__, error_description=message.value))
-        except MissingField, message:
-            return JSONHTTPBadRequest(error=dict(error=MissingField.__name__, error_description=message.value))
-        except DuplicatedItemError, message:
-            return JSONHTTPBadRequest(error=dict(error=DuplicatedItemError.__name__, error_description=message.value))
-        except UnknownUserError, message:
-            return JSONHTTPBadRequest(error=dict(error=UnknownUserError.__name__, error_description=message.value))
-        except Unauthorized, message:
-            return JSONHTTPUnauthorized(error=dict(error=Unauthorized.__name__, error_description=message.value))
-        except InvalidSearchParams, message:
-            return JSONHTTPBadRequest(error=dict(error=InvalidSearchParams.__name__, error_description=message.value))
-        except InvalidPermission, message:
-            return JSONHTTPBadRequest(error=dict(error=InvalidPermission.__name__, error_description=message.value))
-        except ValidationError, message:
-            return JSONHTTPBadRequest(error=dict(error=ValidationError.__name__, error_description=message.value))
-
-        # JSON decode error????
-        except ValueError:
-            return JSONHTTPBadRequest(error=dict(error='JSONDecodeError', error_description='Invalid JSON data found on requests body'))
-        except:
-            return HTTPInternalServerError()
-        else:
+        def respond():
             try:
-                # Don't cache by default, get configuration from resource if any
-                route_cache_settings = RESOURCES.get(request.matched_route.name).get('cache', 'must-revalidate, max-age=0, no-cache, no-store')
-                response.headers.update({'Cache-Control': route_cache_settings})
+                response = fun(*args, **kwargs)
+            except InvalidId, message:
+                return JSONHTTPBadRequest(error=dict(error=InvalidId.__name__, error_description=message.value))
+            except ObjectNotSupported, message:
+                return JSONHTTPBadRequest(error=dict(error=ObjectNotSupported.__name__, error_description=message.value))
+            except ObjectNotFound, message:
+                return JSONHTTPBadRequest(error=dict(error=ObjectNotFound.__name__, error_description=message.value))
+            except MissingField, message:
+                return JSONHTTPBadRequest(error=dict(error=MissingField.__name__, error_description=message.value))
+            except DuplicatedItemError, message:
+                return JSONHTTPBadRequest(error=dict(error=DuplicatedItemError.__name__, error_description=message.value))
+            except UnknownUserError, message:
+                return JSONHTTPBadRequest(error=dict(error=UnknownUserError.__name__, error_description=message.value))
+            except Unauthorized, message:
+                return JSONHTTPUnauthorized(error=dict(error=Unauthorized.__name__, error_description=message.value))
+            except InvalidSearchParams, message:
+                return JSONHTTPBadRequest(error=dict(error=InvalidSearchParams.__name__, error_description=message.value))
+            except InvalidPermission, message:
+                return JSONHTTPBadRequest(error=dict(error=InvalidPermission.__name__, error_description=message.value))
+            except ValidationError, message:
+                return JSONHTTPBadRequest(error=dict(error=ValidationError.__name__, error_description=message.value))
+            except ServiceUnavailable, message:
+                return JSONHTTPServiceUnavailable(error=dict(error=ServiceUnavailable.__name__, error_description=message.value))
+
+            # JSON decode error????
+            except ValueError:
+                return JSONHTTPBadRequest(error=dict(error='JSONDecodeError', error_description='Invalid JSON data found on requests body'))
             except:
-                pass
-            return response
+                return HTTPInternalServerError()
+            else:
+                stats = context.identity_map.stats()
+                logger.debug('%s %s: %d lookups served from the identity map, %d database queries' % (request.method, request.path, stats['hits'], stats['queries']))
+                try:
+                    # Don't cache by default, get configuration from resource if any
+                    route_cache_settings = RESOURCES.get(request.matched_route.name).get('cache', NO_CACHE)
+                    response.headers.update({'Cache-Control': route_cache_settings})
+                except:
+                    pass
+                return response
+        return timeRequest(request, respond)
     return replacement
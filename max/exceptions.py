@@ -1,4 +1,4 @@
-from pyramid.httpexceptions import HTTPUnauthorized, HTTPBadRequest, HTTPNotImplemented
+from pyramid.httpexceptions import HTTPUnauthorized, HTTPBadRequest, HTTPNotImplemented, HTTPServiceUnavailable
 from pyramid.response import Response
 
 import json
@@ -25,6 +25,13 @@ class JSONHTTPNotImplemented(HTTPNotImplemented):
         self.content_type = 'application/json'
 
 
+class JSONHTTPServiceUnavailable(HTTPServiceUnavailable):
+
+    def __init__(self, error):
+        Response.__init__(self, json.dumps(error), status=self.code)
+        self.content_type = 'application/json'
+
+
 class MissingField(Exception):
     def __init__(self, value):
         self.value = value
@@ -95,3 +102,11 @@ class ValidationError(Exception):
 
     def __str__(self):
         return repr(self.value)
+
+
+class ServiceUnavailable(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
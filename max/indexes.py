@@ -0,0 +1,115 @@
+"""
+    Index management for the MAX collections
+
+    Indexes are declared next to the schema of each model, in its ``indexes``
+    attribute, as a list of dicts with the index ``keys`` in pymongo format and
+    any of the index options (unique, sparse, partialFilterExpression ...):
+
+        indexes = [
+                    dict(keys=[('username', ASCENDING)], unique=True),
+                  ]
+
+    Partial indexes (partialFilterExpression) need mongodb 3.2 or newer.
+
+    The declared indexes can be checked against the database, reporting the missing
+    ones and the existing ones that are not declared or not used, and created either at
+    startup (``max.ensure_indexes = true``) or with the max.indexes console script.
+
+    Unique indexes can't be created on existing data with duplicated values. Those are
+    logged and skipped, so the application still starts, and have to be created with the
+    console script once the duplicates are solved. On big databases, prefer the console
+    script to creating the indexes at startup.
+"""
+
+from pymongo.errors import OperationFailure
+import logging
+
+from max.models import Activity, User, Context
+from max.timelines import TIMELINE_COLLECTION, TIMELINE_INDEXES
+from max.terms import TERMS_COLLECTION, TERM_INDEXES
+
+INDEXED_MODELS = [Activity, User, Context]
+INDEX_OPTIONS = ['unique', 'sparse', 'partialFilterExpression', 'background']
+
+logger = logging.getLogger('max')
+
+
+def getIndexName(keys):
+    """
+        Returns the name that mongodb assigns by default to an index on keys
+    """
+    return '_'.join(['%s_%s' % (field, direction) for field, direction in keys])
+
+
+def getDeclaredIndexes():
+    """
+        Returns a dict with the declared indexes of each collection, keyed by collection name
+    """
+    declared = dict([(model.collection, model.indexes) for model in INDEXED_MODELS])
+    declared[TIMELINE_COLLECTION] = TIMELINE_INDEXES
+    declared[TERMS_COLLECTION] = TERM_INDEXES
+    return declared
+
+
+def getUsageStats(collection):
+    """
+        Returns a dict with the number of operations that used each index since the
+        server started, keyed by index name. Returns an empty dict if the server
+        doesn't support $indexStats (mongodb < 3.2)
+    """
+    try:
+        result = collection.aggregate([{'$indexStats': {}}])
+    except OperationFailure:
+        return {}
+    # Older pymongo returns the whole result document, newer returns a cursor
+    if isinstance(result, dict):
+        result = result.get('result', [])
+    return dict([(stats['name'], stats['accesses']['ops']) for stats in result])
+
+
+def checkIndexes(db):
+    """
+        Compares the declared indexes with the ones existing in the database.
+        Returns a dict keyed by collection name, with lists of index names:
+
+            missing: Declared but not present in the database
+            undeclared: Present in the database but not declared
+            unused: Present in the database and never used since the server started
+    """
+    report = {}
+    for collection_name, indexes in getDeclaredIndexes().items():
+        collection = db[collection_name]
+        existing = collection.index_information().keys()
+        declared = [getIndexName(index['keys']) for index in indexes]
+        usage = getUsageStats(collection)
+
+        report[collection_name] = dict(
+            missing=[name for name in declared if name not in existing],
+            undeclared=[name for name in existing if name not in declared and name != '_id_'],
+            unused=[name for name in existing if usage.get(name, None) == 0 and name != '_id_'],
+        )
+    return report
+
+
+def ensureIndexes(db, dry_run=False):
+    """
+        Creates all the declared indexes missing in the database.
+        Returns a list of (collection name, index name) tuples of the indexes
+        created, or that would be created if dry_run is True. Indexes that can't
+        be created (ie. unique ones on duplicated data) are logged and skipped
+    """
+    report = checkIndexes(db)
+    created = []
+    for collection_name, indexes in getDeclaredIndexes().items():
+        for index in indexes:
+            name = getIndexName(index['keys'])
+            if name in report[collection_name]['missing']:
+                if not dry_run:
+                    options = dict([(option, index[option]) for option in INDEX_OPTIONS if option in index])
+                    try:
+                        db[collection_name].create_index(index['keys'], name=name, **options)
+                    except OperationFailure, error:
+                        logger.error('Could not create index %s on %s: %s. Solve it and create it with the max.indexes script' % (name, collection_name, error))
+                        continue
+                created.append((collection_name, name))
+    return created
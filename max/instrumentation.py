@@ -0,0 +1,241 @@
+"""
+    Timing of the phases of the requests
+
+    When enabled with the ``max.request_timing`` setting, every request served through
+    MaxResponse keeps the time spent in each of its phases:
+
+        oauth: Validating the oauth token (oauth2)
+        actor: Loading the actor (MaxRequest)
+        db: Queries through the MADMax wrappers
+        flatten: Transforming the database objects to json serializable ones
+        json: Encoding the response body
+        total: The whole request, from MaxResponse
+
+    along with the number of database queries. The timings are sent back in the
+    Server-Timing header, logged in a json line on the "max.timing" logger and added
+    to the per route counters shown at /admin/metrics.
+
+    With ``max.profile_slow_requests`` set to a number of milliseconds, the stacks of
+    the requests are also sampled every ``max.profile_interval`` seconds, and the most
+    frequent ones of the requests slower than that are logged on the "max.profile" logger.
+"""
+
+from pyramid.settings import asbool
+from pyramid.threadlocal import get_current_request
+from contextlib import contextmanager
+import traceback
+import threading
+import logging
+import json
+import time
+import sys
+
+DEFAULT_PROFILE_INTERVAL = 0.01
+PROFILE_TOP_STACKS = 5
+
+# Order of the phases in the Server-Timing header
+PHASES = ['oauth', 'actor', 'db', 'flatten', 'json', 'total']
+
+timing_logger = logging.getLogger('max.timing')
+profile_logger = logging.getLogger('max.profile')
+
+
+def isRequestTimingEnabled(settings):
+    """
+        Returns True if the requests have to be timed
+    """
+    return asbool(settings.get('max_request_timing', False))
+
+
+class RequestTimer(object):
+    """
+        Time spent in each phase of a request
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.samples = None
+
+    def add(self, name, seconds):
+        """
+            Adds the seconds spent in a phase
+        """
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        """
+            Times the enclosed block as part of a phase
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def serverTiming(self, queries):
+        """
+            Returns the value of the Server-Timing header
+        """
+        metrics = []
+        for name in PHASES:
+            if name in self.phases:
+                metric = '%s;dur=%.1f' % (name, self.phases[name] * 1000)
+                if name == 'db':
+                    metric += ';desc="%d queries"' % queries
+                metrics.append(metric)
+        return ', '.join(metrics)
+
+
+def getCurrentTimer():
+    """
+        Returns the timer of the request being served by this thread, or None if
+        there's no request or it's not timed
+    """
+    request = get_current_request()
+    context = request is not None and getattr(request, 'context', None) or None
+    return getattr(context, 'timer', None)
+
+
+@contextmanager
+def timed(name):
+    """
+        Times the enclosed block as part of a phase of the current request, if timed
+    """
+    timer = getCurrentTimer()
+    if timer is None:
+        yield
+    else:
+        with timer.phase(name):
+            yield
+
+
+class RequestMetrics(object):
+    """
+        Counters of the timed requests of this process, per route
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def record(self, route, status, timer, queries):
+        """
+            Adds a timed request to the counters of its route
+        """
+        with self.lock:
+            metrics = self.routes.setdefault(route, {'count': 0, 'errors': 0, 'queries': 0, 'max_ms': 0, 'phases_ms': {}})
+            metrics['count'] += 1
+            metrics['errors'] += status >= 400 and 1 or 0
+            metrics['queries'] += queries
+            metrics['max_ms'] = max(metrics['max_ms'], timer.phases.get('total', 0) * 1000)
+            for name, seconds in timer.phases.items():
+                metrics['phases_ms'][name] = metrics['phases_ms'].get(name, 0) + seconds * 1000
+
+    def stats(self):
+        """
+            Returns the counters of each route, with the mean time of each phase
+        """
+        with self.lock:
+            stats = {}
+            for route, metrics in self.routes.items():
+                stats[route] = dict(count=metrics['count'],
+                                    errors=metrics['errors'],
+                                    max_ms=round(metrics['max_ms'], 1),
+                                    mean_queries=round(metrics['queries'] / float(metrics['count']), 2),
+                                    mean_ms=dict([(name, round(total / metrics['count'], 2)) for name, total in metrics['phases_ms'].items()]))
+            return stats
+
+
+class StackSampler(object):
+    """
+        Background thread sampling the stacks of the threads serving timed requests
+    """
+
+    def __init__(self, interval=DEFAULT_PROFILE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.watched = {}
+        self.thread = threading.Thread(target=self.sample, name='max-stack-sampler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def watch(self, timer):
+        """
+            Starts collecting the stacks of the current thread in the timer
+        """
+        timer.samples = {}
+        with self.lock:
+            self.watched[threading.current_thread().ident] = timer
+
+    def unwatch(self):
+        """
+            Stops collecting the stacks of the current thread
+        """
+        with self.lock:
+            self.watched.pop(threading.current_thread().ident, None)
+
+    def sample(self):
+        """
+            Collects a stack of each watched thread every interval, forever
+        """
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                watched = self.watched.items()
+            for ident, timer in watched:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = ';'.join(['%s:%s:%d' % (filename.split('/')[-1], function, line) for filename, line, function, text in traceback.extract_stack(frame)])
+                timer.samples[stack] = timer.samples.get(stack, 0) + 1
+
+
+def startStackSampler(settings):
+    """
+        Returns the stack sampler of this process, or None if slow requests are not profiled
+    """
+    if not isRequestTimingEnabled(settings) or not float(settings.get('max_profile_slow_requests', 0)):
+        return None
+    return StackSampler(interval=float(settings.get('max_profile_interval', DEFAULT_PROFILE_INTERVAL)))
+
+
+def timeRequest(request, respond):
+    """
+        Serves a request calling respond, timing it if enabled. The timings are
+        sent in the Server-Timing header, logged and added to the metrics.
+    """
+    timer = getattr(request.context, 'timer', None)
+    if timer is None:
+        return respond()
+
+    sampler = getattr(request.registry, 'max_sampler', None)
+    if sampler is not None:
+        sampler.watch(timer)
+    try:
+        with timer.phase('total'):
+            response = respond()
+    finally:
+        if sampler is not None:
+            sampler.unwatch()
+
+    queries = request.context.identity_map.queries
+    route = '%s %s' % (request.method, getattr(request.matched_route, 'name', request.path))
+    response.headers['Server-Timing'] = timer.serverTiming(queries)
+
+    timing_logger.info(json.dumps(dict(route=route, path=request.path, status=response.status_int, queries=queries,
+                                       phases_ms=dict([(name, round(seconds * 1000, 2)) for name, seconds in timer.phases.items()]))))
+
+    metrics = getattr(request.registry, 'max_metrics', None)
+    if metrics is not None:
+        metrics.record(route, response.status_int, timer, queries)
+
+    threshold = float(request.registry.max_settings.get('max_profile_slow_requests', 0))
+    samples = dict(timer.samples or {})
+    if samples and timer.phases['total'] * 1000 >= threshold:
+        top = sorted(samples.items(), key=lambda sample: -sample[1])[:PROFILE_TOP_STACKS]
+        profile_logger.warning('Slow request %s %s (%.1f ms), most sampled stacks:\n%s' % (
+            request.method, request.path, timer.phases['total'] * 1000,
+            '\n'.join(['%d %s' % (count, stack) for stack, count in top])))
+    return response
@@ -15,7 +15,9 @@ class IMADObjects(Interface):
     """
 
     unique = Attribute("""Ensure Unique""")
+    idempotency_key = Attribute("""Field holding the client supplied idempotency key""")
     collection = Attribute("""Name of the collection""")
+    indexes = Attribute("""Indexes to be created on the collection""")
     mdb_collection = Attribute("")
     data = Attribute("")
 
@@ -2,9 +2,19 @@ from max.MADObjects import MADBase
 from max.rest.utils import canWriteInContexts
 import datetime
 from hashlib import sha1
-from MADMax import MADMaxDB
+from pymongo import ASCENDING, DESCENDING
+from MADMax import MADMaxDB, MADMaxCollection
 from max.rest.utils import getUserIdFromTwitter, findKeywords, findHashtags
 from max import DEFAULT_CONTEXT_PERMISSIONS
+from max.routing import hasTwitterRoutingFields, touchTwitterRouting
+
+
+# Fields of a comment not embedded in the replies of the commented activity
+REPLY_EXCLUDED_FIELDS = ['_keywords', '_hashtags', 'inReplyTo']
+REPLY_AUTHOR_FIELDS = ['_id', 'username', 'displayName']
+
+# Default number of latest replies embedded in the commented activity
+MAX_EMBEDDED_REPLIES = 10
 
 
 class Activity(MADBase):
@@ -12,9 +22,10 @@ class Activity(MADBase):
         An activitystrea.ms Activity object representation
     """
     collection = 'activity'
-    unique = '_id'
+    idempotency_key = 'idempotencyKey'
     schema = {
                 '_id':         dict(required=0),
+                'idempotencyKey': dict(required=0),
                 'actor':       dict(required=1),
                 'verb':        dict(required=1),
                 'object':      dict(required=1),
@@ -23,6 +34,19 @@ class Activity(MADBase):
                 'replies':    dict(required=0),
                 'generator':    dict(required=0),
              }
+    indexes = [
+                dict(keys=[('actor._id', ASCENDING), ('_id', DESCENDING)]),
+                dict(keys=[('actor.username', ASCENDING), ('_id', DESCENDING)]),
+                dict(keys=[('contexts.url', ASCENDING), ('_id', DESCENDING)]),
+                dict(keys=[('verb', ASCENDING), ('_id', DESCENDING)]),
+                dict(keys=[('object._hashtags', ASCENDING)]),
+                dict(keys=[('object._keywords', ASCENDING)]),
+                dict(keys=[('object.inReplyTo._id', ASCENDING), ('_id', ASCENDING)]),
+                # Idempotency keys are unique per actor. Repeated keys are only detected if
+                # this index exists (max.ensure_indexes or the max.indexes script)
+                dict(keys=[('actor._id', ASCENDING), ('idempotencyKey', ASCENDING)], unique=True,
+                     partialFilterExpression={'idempotencyKey': {'$exists': True}}),
+              ]
 
     def buildObject(self):
         """
@@ -60,6 +84,9 @@ class Activity(MADBase):
         if 'generator' in self.data:
             ob['generator'] = self.data['generator']
 
+        if self.data.get('idempotencyKey'):
+            ob['idempotencyKey'] = self.data['idempotencyKey']
+
         if 'contexts' in self.data:
             if isPerson:
                 # When a person posts an activity it can be targeted
@@ -82,24 +109,51 @@ class Activity(MADBase):
                                    )]
         self.update(ob)
 
-    def addComment(self, comment):
+    def asReply(self):
         """
-            Adds a comment to an existing activity and updates refering activity keywords and hashtags
+            Returns the summary of this comment activity, as embedded in the
+            replies of the commented activity
         """
-        self.addToList('replies', comment, allow_duplicates=True)
-
-        activity_keywords = self.object.setdefault('_keywords',[])
-        activity_keywords.extend(comment.get('_keywords',[]))
-        activity_keywords = list(set(activity_keywords))
-
-        activity_hashtags = self.object.setdefault('_hashtags',[])
-        activity_hashtags.extend(comment.get('_hashtags',[]))
-        activity_hashtags = list(set(activity_hashtags))
+        reply = dict([(key, value) for key, value in self['object'].items() if key not in REPLY_EXCLUDED_FIELDS])
+        reply['published'] = self['published']
+        reply['author'] = dict([(key, self['actor'][key]) for key in REPLY_AUTHOR_FIELDS if key in self['actor']])
+        reply['id'] = str(self['_id'])
+        return reply
 
-        self.mdb_collection.update({'_id': self['_id']},
-                                      {'$set': {'object._keywords': activity_keywords,
-                                                'object._hashtags': activity_hashtags}}
-                                      )
+    def addComment(self, comment, max_replies=None):
+        """
+            Adds a comment activity to an existing activity and updates refering activity keywords and
+            hashtags, in a single atomic update. The comment keywords and hashtags are merged into the
+            activity ones, and the comment is embedded as a summary. Only the latest max_replies
+            summaries are kept embedded, if specified. The full list of comments is in the
+            comment activities themselves.
+        """
+        reply = comment.asReply()
+        push = max_replies is None and reply or {'$each': [reply], '$slice': -max_replies}
+        changes = {'$push': {'replies.items': push},
+                   '$inc': {'replies.totalItems': 1}}
+
+        # Comments stripped of its term arrays (max.strip_term_arrays) leave the activity ones untouched
+        terms = {}
+        for field in ['_keywords', '_hashtags']:
+            if comment['object'].get(field):
+                terms['object.%s' % field] = {'$each': list(set(comment['object'][field]))}
+        if terms:
+            changes['$addToSet'] = terms
+
+        self.mdb_collection.update({'_id': self['_id']}, changes)
+        self.invalidateIdentityMap()
+
+        # Keep this copy up to date with the changes
+        replies = self.setdefault('replies', {'items': [], 'totalItems': 0})
+        replies['items'].append(reply)
+        if max_replies is not None:
+            replies['items'] = max_replies and replies['items'][-max_replies:] or []
+        replies['totalItems'] = replies.get('totalItems', 0) + 1
+        for field in ['_keywords', '_hashtags']:
+            if comment['object'].get(field):
+                values = self.object.setdefault(field, [])
+                values.extend([value for value in set(comment['object'][field]) if value not in values])
 
     def _on_create_custom_validations(self):
         """
@@ -117,7 +171,31 @@ class Activity(MADBase):
         return result
 
 
-class User(MADBase):
+class TwitterRouted(object):
+    """
+        Mixin for the objects used to route tweets, bumping the twitter routing
+        version whenever its twitter fields change
+    """
+
+    def insert(self):
+        """
+            Inserts the item, bumping the routing version if it has twitter fields
+        """
+        oid = super(TwitterRouted, self).insert()
+        if hasTwitterRoutingFields(self):
+            touchTwitterRouting(self.mdb_collection.database)
+        return oid
+
+    def delete(self):
+        """
+            Removes the item, bumping the routing version if it had twitter fields
+        """
+        super(TwitterRouted, self).delete()
+        if hasTwitterRoutingFields(self):
+            touchTwitterRouting(self.mdb_collection.database)
+
+
+class User(TwitterRouted, MADBase):
     """
         An activitystrea.ms User object representation
     """
@@ -136,6 +214,13 @@ class User(MADBase):
                                            validators=['isValidTwitterUsername'],
                                            ),
              }
+    indexes = [
+                dict(keys=[('username', ASCENDING)], unique=True),
+                dict(keys=[('subscribedTo.items.urlHash', ASCENDING)]),
+                dict(keys=[('subscribedTo.items.url', ASCENDING)]),
+                dict(keys=[('following.items.username', ASCENDING)]),
+                dict(keys=[('twitterUsername', ASCENDING)], sparse=True),
+              ]
 
     def buildObject(self):
         """
@@ -159,10 +244,25 @@ class User(MADBase):
 
     def addFollower(self, person):
         """
-            Adds a follower to the list
+            Adds a follower to the list. The person is expected to carry the
+            followed user _id along with its username
         """
         self.addToList('following', person)
 
+    def getFollowedIds(self):
+        """
+            Returns the _id's of the followed users. Ids are stored along with
+            the following items, the ones that don't (followed before ids were stored)
+            are resolved all at once by username
+        """
+        following = self.get('following', {}).get('items', [])
+        followed_ids = [followed['_id'] for followed in following if followed.get('_id')]
+        unresolved = [followed['username'] for followed in following if not followed.get('_id')]
+        if unresolved:
+            users = MADMaxCollection(self.mdb_collection).getItemsMapByusername(unresolved)
+            followed_ids += [user['_id'] for user in users.values()]
+        return followed_ids
+
     def addSubscription(self, context):
         """
             Adds a comment to an existing activity
@@ -182,6 +282,8 @@ class User(MADBase):
 
         self.updateFields(properties)
         self.save()
+        if hasTwitterRoutingFields(properties):
+            touchTwitterRouting(self.mdb_collection.database)
 
     def grantPermission(self, subscription, permission):
         """
@@ -194,6 +296,7 @@ class User(MADBase):
         what = {'$addToSet': {'subscribedTo.items.$.permissions': permission}}
 
         self.mdb_collection.update(criteria, what)
+        self.invalidateIdentityMap()
 
     def revokePermission(self, subscription, permission):
         """
@@ -206,6 +309,7 @@ class User(MADBase):
         what = {'$pull': {'subscribedTo.items.$.permissions': permission}}
 
         self.mdb_collection.update(criteria, what)
+        self.invalidateIdentityMap()
 
     def getSubscriptionByURL(self, url):
         """
@@ -214,7 +318,7 @@ class User(MADBase):
         return context_map.get(url)
 
 
-class Context(MADBase):
+class Context(TwitterRouted, MADBase):
     """
         A max Context object representation
     """
@@ -241,6 +345,14 @@ class Context(MADBase):
                                                   'join': DEFAULT_CONTEXT_PERMISSIONS['join'],
                                                   'invite': DEFAULT_CONTEXT_PERMISSIONS['invite']}),
              }
+    indexes = [
+                dict(keys=[('urlHash', ASCENDING)], unique=True),
+                dict(keys=[('url', ASCENDING)], unique=True),
+                dict(keys=[('permissions.read', ASCENDING), ('url', ASCENDING)]),
+                dict(keys=[('twitterHashtag', ASCENDING)], sparse=True),
+                dict(keys=[('twitterUsername', ASCENDING)], sparse=True),
+                dict(keys=[('twitterUsernameId', ASCENDING)], sparse=True),
+              ]
 
     def buildObject(self):
         """
@@ -280,6 +392,8 @@ class Context(MADBase):
             del self['twitterUsernameId']
 
         self.save()
+        if hasTwitterRoutingFields(properties):
+            touchTwitterRouting(self.mdb_collection.database)
 
 
     def subscribedUsers(self):
@@ -312,14 +426,12 @@ class Context(MADBase):
         """
         """
         # XXX TODO For now only updates displayName
-        ids = [user['_id'] for user in self.subscribedUsers()]
-
-        for obid in ids:
-            criteria = {'_id': obid, 'subscribedTo.items.urlHash': self.urlHash}
-
-                 # deletes context from subcription list
-            what = {'$set': {'subscribedTo.items.$.displayName': self.displayName}}
-            self.mdb_collection.database.users.update(criteria, what)
+        # A single multi-document update, the positional operator
+        # is resolved independently for each matching user
+        criteria = {'subscribedTo.items.urlHash': self.urlHash}
+        what = {'$set': {'subscribedTo.items.$.displayName': self.displayName}}
+        self.mdb_collection.database.users.update(criteria, what, multi=True)
+        self.invalidateIdentityMap('users')
 
     def removeUserSubscriptions(self):
         """
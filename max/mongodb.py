@@ -0,0 +1,147 @@
+"""
+    Shared MongoDB connections
+
+    All the entry points (the MAX application, the console scripts and the maxrules
+    workers) get its connection from getConnection, that keeps a single pooled client
+    per url and options in each process. Clients are configured from the ``mongodb.*``
+    settings of the .ini file:
+
+        mongodb.pool_size: Maximum number of sockets in the pool (100)
+        mongodb.connect_timeout: Seconds to wait for a new socket to connect
+        mongodb.socket_timeout: Seconds to wait for the answer of an operation
+        mongodb.wait_queue_timeout: Seconds to wait for a free socket when the pool is full
+        mongodb.write_concern: Default write concern (w) of all writes (1)
+        mongodb.write_concern.<operation>: Write concern of a type of operation, ie. bulk.
+                                 Unacknowledged writes (0) are not allowed for bulk, as
+                                 repeated idempotency keys are detected from its errors
+        mongodb.secondary_reads: Serve the GET requests of the resources that declare a
+                                 read_preference in RESOURCES from it (false)
+        mongodb.secondary_acceptable_latency: Milliseconds of ping time over the nearest
+                                 member allowed to the members chosen for secondary reads
+
+    Reading from secondaries takes load from the primary, but a client may not see
+    its own writes right away.
+"""
+
+from pymongo import MongoClient, ReadPreference
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+from pyramid.settings import asbool
+import threading
+
+# Timeout settings in seconds, and the client option they map to in milliseconds
+TIMEOUT_OPTIONS = {
+    'mongodb.connect_timeout': 'connectTimeoutMS',
+    'mongodb.socket_timeout': 'socketTimeoutMS',
+    'mongodb.wait_queue_timeout': 'waitQueueTimeoutMS',
+}
+
+# Operations that rely on the errors of its writes, so they can't be unacknowledged
+ACKNOWLEDGED_OPERATIONS = ['bulk']
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def parseWriteConcern(value):
+    """
+        Returns the w value of a write concern setting: a number of servers or a tag (majority)
+    """
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    return value
+
+
+def getConnectionOptions(settings):
+    """
+        Returns the client options configured in settings
+    """
+    options = {}
+    if settings.get('mongodb.pool_size'):
+        options['max_pool_size'] = int(settings['mongodb.pool_size'])
+    for setting, option in TIMEOUT_OPTIONS.items():
+        if settings.get(setting):
+            options[option] = int(float(settings[setting]) * 1000)
+    if settings.get('mongodb.write_concern'):
+        options['w'] = parseWriteConcern(settings['mongodb.write_concern'])
+    return options
+
+
+def getConnection(url, **options):
+    """
+        Returns the client of this process connected to url with options,
+        creating it the first time
+    """
+    key = (url, tuple(sorted(options.items())))
+    with _connections_lock:
+        if key not in _connections:
+            _connections[key] = MongoClient(url, **options)
+        return _connections[key]
+
+
+def getDatabase(settings):
+    """
+        Returns the database configured in settings, from the shared client
+    """
+    client = getConnection(settings['mongodb.url'], **getConnectionOptions(settings))
+    return client[settings['mongodb.db_name']]
+
+
+def getReadDatabase(db, preference, acceptable_latency=None):
+    """
+        Returns a copy of db reading with a read preference, ie. secondary_preferred
+    """
+    read_db = Database(db.connection, db.name)
+    read_db.read_preference = getattr(ReadPreference, preference.upper())
+    if acceptable_latency is not None:
+        read_db.secondary_acceptable_latency_ms = acceptable_latency
+    return read_db
+
+
+def getReadDatabases(settings, db, preferences):
+    """
+        Returns the databases for each of the read preferences, keyed by its name.
+        Empty unless secondary reads are enabled, so everything is read from the primary.
+    """
+    if not asbool(settings.get('mongodb.secondary_reads', False)):
+        return {}
+    latency = settings.get('mongodb.secondary_acceptable_latency')
+    latency = latency and float(latency) or None
+    return dict([(preference, getReadDatabase(db, preference, acceptable_latency=latency)) for preference in preferences])
+
+
+def getWriteConcerns(settings):
+    """
+        Returns the write concerns configured for each type of operation, as a dict of
+        keyword arguments for the write methods keyed by the operation name
+    """
+    prefix = 'mongodb.write_concern.'
+    concerns = dict([(key[len(prefix):], {'w': parseWriteConcern(value)}) for key, value in settings.items() if key.startswith(prefix)])
+    for operation in ACKNOWLEDGED_OPERATIONS:
+        if concerns.get(operation, {}).get('w') == 0:
+            raise ValueError, '%s%s can\'t be 0, its writes must be acknowledged' % (prefix, operation)
+    return concerns
+
+
+def getWriteConcern(registry, operation):
+    """
+        Returns the keyword arguments with the write concern of a type of operation,
+        empty if not configured, so the default one is used
+    """
+    return getattr(registry, 'max_write_concerns', {}).get(operation, {})
+
+
+def getPoolStats(client):
+    """
+        Returns the pool configuration of a client, along with the server connection
+        counts if the server allows reading them
+    """
+    stats = {'max_pool_size': client.max_pool_size,
+             'nodes': ['%s:%s' % node for node in client.nodes],
+             'write_concern': client.write_concern}
+    try:
+        stats['server'] = client.admin.command('serverStatus').get('connections', {})
+    except OperationFailure:
+        pass
+    return stats
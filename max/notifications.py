@@ -0,0 +1,202 @@
+"""
+    Push notifications of new timeline activities
+
+    When enabled with the ``max.timeline_push`` setting, clients can long-poll
+    /people/{username}/timeline/poll?cursor=<prev cursor of the timeline> instead of
+    polling the timeline every few seconds. The request is answered as soon as a new
+    activity reaches the user timeline, or with an empty page after ``max.poll_timeout``
+    seconds.
+
+    Every inserted timeline activity leaves a small document in the "notifications"
+    capped collection, with the keys of the timelines that receive it:
+
+        {'keys': ['actor:<actor _id>', 'context:<context url>', ...]}
+
+    Every process follows that collection with a tailable cursor from a background
+    thread, and wakes up its own waiting requests whose timeline keys match, so it
+    works the same with one or many processes. As each waiting request holds a server
+    thread, at most ``max.poll_limit`` requests of each process wait at a time, and the
+    rest are answered right away, as a plain timeline request. The server must be
+    configured with more threads than that, to leave some for the other requests.
+"""
+
+from pyramid.settings import asbool
+import threading
+import logging
+import time
+
+from max.timelines import TIMELINE_VERBS
+from max.mongodb import getWriteConcern
+
+NOTIFICATIONS_COLLECTION = 'notifications'
+DEFAULT_NOTIFICATIONS_SIZE = 1048576
+DEFAULT_POLL_TIMEOUT = 25
+DEFAULT_POLL_LIMIT = 16
+
+logger = logging.getLogger('max')
+
+
+def isTimelinePushEnabled(settings):
+    """
+        Returns True if timeline long-polling is enabled
+    """
+    return asbool(settings.get('max_timeline_push', False))
+
+
+def getPollTimeout(settings):
+    """
+        Returns the seconds a long-poll request waits for new activities
+    """
+    return float(settings.get('max_poll_timeout', DEFAULT_POLL_TIMEOUT))
+
+
+def getPollLimit(settings):
+    """
+        Returns the number of long-poll requests of a process that can wait at a time
+    """
+    return int(settings.get('max_poll_limit', DEFAULT_POLL_LIMIT))
+
+
+def getActivityKeys(activity):
+    """
+        Returns the keys of the timelines that receive an activity
+    """
+    keys = ['actor:%s' % activity['actor']['_id']]
+    keys += ['context:%s' % context['url'] for context in activity.get('contexts', [])]
+    return keys
+
+
+def getTimelineKeys(actor, followed_ids=[]):
+    """
+        Returns the keys of the activities that reach the actor timeline, this is,
+        the ones from the actor, from the people it follows and from the contexts
+        it's subscribed to. Mirrors max.timelines.buildTimelineQuery
+    """
+    keys = ['actor:%s' % actor['_id']]
+    keys += ['actor:%s' % followed_id for followed_id in followed_ids]
+    keys += ['context:%s' % subscribed['url'] for subscribed in actor.get('subscribedTo', {}).get('items', [])]
+    return keys
+
+
+class TimelineWaiter(object):
+    """
+        A request waiting for activities with any of its keys
+    """
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+        self.event = threading.Event()
+
+    def wait(self, timeout):
+        """
+            Blocks until notified or timeout seconds. Returns True if notified
+        """
+        return self.event.wait(timeout)
+
+
+class TimelineNotifier(object):
+    """
+        Wakes up the requests of this process waiting for new timeline activities
+    """
+
+    def __init__(self, limit=DEFAULT_POLL_LIMIT):
+        self.lock = threading.Lock()
+        self.waiters = []
+        self.limit = limit
+
+    def subscribe(self, keys):
+        """
+            Registers and returns a waiter for the activities with any of keys, or None
+            if there are already as many waiters as the limit. Must be unsubscribed when done.
+        """
+        waiter = TimelineWaiter(keys)
+        with self.lock:
+            if len(self.waiters) >= self.limit:
+                return None
+            self.waiters.append(waiter)
+        return waiter
+
+    def unsubscribe(self, waiter):
+        """
+            Forgets a waiter
+        """
+        with self.lock:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+    def notify(self, keys):
+        """
+            Wakes up the waiters interested in any of keys
+        """
+        keys = set(keys)
+        with self.lock:
+            for waiter in self.waiters:
+                if waiter.keys & keys:
+                    waiter.event.set()
+
+
+def ensureNotificationsCollection(db, size=DEFAULT_NOTIFICATIONS_SIZE):
+    """
+        Creates the capped collection of notifications if missing. It's created with a
+        first document, as tailable cursors on empty collections are closed right away
+    """
+    if NOTIFICATIONS_COLLECTION not in db.collection_names():
+        db.create_collection(NOTIFICATIONS_COLLECTION, capped=True, size=size)
+        db[NOTIFICATIONS_COLLECTION].insert({'keys': []})
+
+
+class NotificationFeed(object):
+    """
+        Background thread following the notifications collection, feeding the notifier
+    """
+
+    def __init__(self, db, notifier):
+        self.collection = db[NOTIFICATIONS_COLLECTION]
+        self.notifier = notifier
+        self.thread = threading.Thread(target=self.follow, name='max-notification-feed')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def follow(self):
+        """
+            Tails the notifications collection forever, starting from the newest one
+        """
+        last = None
+        while True:
+            try:
+                if last is None:
+                    newest = list(self.collection.find({}, {'_id': 1}).sort('$natural', -1).limit(1))
+                    last = newest and newest[0]['_id'] or None
+                query = last is not None and {'_id': {'$gt': last}} or {}
+                cursor = self.collection.find(query, tailable=True, await_data=True)
+                while cursor.alive:
+                    for notification in cursor:
+                        last = notification['_id']
+                        self.notifier.notify(notification['keys'])
+            except Exception:
+                logger.exception('Error following the timeline notifications')
+            time.sleep(1)
+
+
+def startTimelineNotifier(settings, db):
+    """
+        Returns the notifier of this process, fed from the notifications collection,
+        or None if timeline push is disabled
+    """
+    if not isTimelinePushEnabled(settings):
+        return None
+    ensureNotificationsCollection(db, size=int(settings.get('max_notifications_size', DEFAULT_NOTIFICATIONS_SIZE)))
+    notifier = TimelineNotifier(limit=getPollLimit(settings))
+    NotificationFeed(db, notifier)
+    return notifier
+
+
+def publishActivities(registry, db, activities):
+    """
+        Notifies the timelines that receive the newly inserted activities, if enabled
+    """
+    if not isTimelinePushEnabled(registry.max_settings):
+        return
+    notifications = [{'keys': getActivityKeys(activity)} for activity in activities if activity.get('verb') in TIMELINE_VERBS]
+    if notifications:
+        db[NOTIFICATIONS_COLLECTION].insert(notifications, **getWriteConcern(registry, 'notifications'))
@@ -1,10 +1,210 @@
-from max.exceptions import Unauthorized
+from max.exceptions import Unauthorized, ServiceUnavailable
 from max.resources import getMAXSettings
 from max.resources import Root
+from max.instrumentation import timed
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from hashlib import sha1
+import threading
+import time
 
 import requests
 
 
+DEFAULT_CACHE_TTL = 60
+DEFAULT_CACHE_NEGATIVE_TTL = 5
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CHECK_TIMEOUT = 10
+DEFAULT_UNAVAILABLE_TTL = 5
+
+
+class MongoDBTokenCacheBackend(object):
+    """
+        Shared storage for validated tokens, so all the workers using the same
+        database benefit from the validations made by any of them.
+        Expired entries are purged by mongodb through a TTL index.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.collection.ensure_index('expires', expireAfterSeconds=0)
+
+    def get(self, key):
+        """
+            Returns the cached validation result, or None if not cached or expired
+        """
+        entry = self.collection.find_one({'_id': key, 'expires': {'$gt': datetime.utcnow()}})
+        if entry:
+            return entry['valid']
+        return None
+
+    def set(self, key, valid, ttl):
+        """
+            Stores a validation result for ttl seconds
+        """
+        expires = datetime.utcnow() + timedelta(seconds=ttl)
+        self.collection.update({'_id': key}, {'$set': {'valid': valid, 'expires': expires}}, upsert=True)
+
+
+class TokenCache(object):
+    """
+        In-process LRU cache of oauth token validation results, keyed by the
+        (token, username, scope) triple.
+
+        Valid tokens are remembered for ``ttl`` seconds, invalid ones for ``negative_ttl``
+        seconds (0 disables negative caching). When the cache holds ``max_size`` items,
+        the least recently used ones are discarded. On local misses, the optional
+        shared ``backend`` is looked up before reporting a miss.
+    """
+
+    def __init__(self, ttl=DEFAULT_CACHE_TTL, negative_ttl=DEFAULT_CACHE_NEGATIVE_TTL, max_size=DEFAULT_CACHE_SIZE, backend=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.backend = backend
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def getKey(self, token, username, scope):
+        """
+            Hash the triple, so raw tokens are never kept in memory or in the shared backend
+        """
+        triple = u'%s\n%s\n%s' % (token, username, scope)
+        return sha1(triple.encode('utf-8')).hexdigest()
+
+    def get(self, token, username, scope):
+        """
+            Returns True or False if the triple validation result is cached, None otherwise
+        """
+        key = self.getKey(token, username, scope)
+        with self.lock:
+            cached = self.items.pop(key, None)
+            if cached is not None and cached[1] > time.time():
+                # Reinsert to mark it as the most recently used
+                self.items[key] = cached
+                self.hits += 1
+                return cached[0]
+
+        if self.backend is not None:
+            valid = self.backend.get(key)
+            if valid is not None:
+                self.store(key, valid)
+                with self.lock:
+                    self.hits += 1
+                return valid
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, token, username, scope, valid):
+        """
+            Caches the validation result of the triple
+        """
+        key = self.getKey(token, username, scope)
+        ttl = self.store(key, valid)
+        if self.backend is not None and ttl:
+            self.backend.set(key, valid, ttl)
+
+    def store(self, key, valid):
+        """
+            Stores the validation result locally, and returns the ttl used
+        """
+        ttl = valid and self.ttl or self.negative_ttl
+        if not ttl:
+            return 0
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (valid, time.time() + ttl)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+        return ttl
+
+    def stats(self):
+        """
+            Returns the cache counters
+        """
+        return dict(hits=self.hits, misses=self.misses, size=len(self.items))
+
+    @classmethod
+    def fromSettings(cls, settings, db):
+        """
+            Builds a cache configured by the max.oauth_cache_* settings, or returns
+            None if caching is disabled (max.oauth_cache_ttl = 0)
+        """
+        ttl = int(settings.get('max_oauth_cache_ttl', DEFAULT_CACHE_TTL))
+        if not ttl:
+            return None
+        backend = None
+        if settings.get('max_oauth_cache_backend', 'memory') == 'mongodb':
+            backend = MongoDBTokenCacheBackend(db.tokens)
+        return cls(ttl=ttl,
+                   negative_ttl=int(settings.get('max_oauth_cache_negative_ttl', DEFAULT_CACHE_NEGATIVE_TTL)),
+                   max_size=int(settings.get('max_oauth_cache_size', DEFAULT_CACHE_SIZE)),
+                   backend=backend)
+
+
+def buildOAuthSession(settings):
+    """
+        Returns a requests session with a pool of persistent connections
+        to the oauth server, sized by max.oauth_pool_size
+    """
+    pool_size = int(settings.get('max_oauth_pool_size', DEFAULT_POOL_SIZE))
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def checkToken(request, oauth_token, username, scope):
+    """
+        Validates the token against the oauth server, unless a previous
+        validation result is cached. Only definitive answers are cached.
+
+        If the oauth server can't be reached or answers with an error, the request
+        fails as unavailable, and so do the ones not cached for the next
+        max.oauth_unavailable_ttl seconds, without waiting for the server again.
+    """
+    settings = getMAXSettings(request)
+    cache = getattr(request.registry, 'max_token_cache', None)
+
+    if cache is not None:
+        valid = cache.get(oauth_token, username, scope)
+        if valid is not None:
+            return valid
+
+    payload = {"oauth_token": oauth_token,
+               "user_id": username,
+               }
+    if scope:
+        payload['scope'] = scope
+
+    if getattr(request.registry, 'max_oauth_unavailable_until', 0) > time.time():
+        raise ServiceUnavailable, 'The oauth server is not available, try again later.'
+
+    session = getattr(request.registry, 'max_oauth_session', requests)
+    timeout = float(settings.get('max_oauth_check_timeout', DEFAULT_CHECK_TIMEOUT))
+    try:
+        r = session.post(settings['max_oauth_check_endpoint'], data=payload, verify=False, timeout=timeout)
+    except requests.RequestException:
+        r = None
+
+    if r is None or r.status_code >= 500:
+        unavailable_ttl = float(settings.get('max_oauth_unavailable_ttl', DEFAULT_UNAVAILABLE_TTL))
+        request.registry.max_oauth_unavailable_until = time.time() + unavailable_ttl
+        raise ServiceUnavailable, 'The oauth server is not available, try again later.'
+
+    valid = r.status_code == 200
+    if cache is not None:
+        cache.set(oauth_token, username, scope, valid)
+    return valid
+
+
 def oauth2(allowed_scopes=[]):
     def wrap(view_function):
         def new_function(*args, **kw):
@@ -15,8 +215,6 @@ def oauth2(allowed_scopes=[]):
             # It will be like:
             # headers = {"X-Oauth-Token": "jfa1sDF2SDF234", "X-Oauth-Username": "messi", "X-Oauth-Scope": "widgetcli"}
 
-            settings = getMAXSettings(request)
-
             oauth_token = request.headers.get('X-Oauth-Token', '')
             username = request.headers.get('X-Oauth-Username', '')
             scope = request.headers.get('X-Oauth-Scope', '')
@@ -29,15 +227,9 @@ def oauth2(allowed_scopes=[]):
                     raise Unauthorized, 'The specified scope is not allowed for this resource.'
 
             # Validate access token
-            payload = {"oauth_token": oauth_token,
-                       "user_id": username,
-                       }
-            if scope:
-                payload['scope'] = scope
-
-            r = requests.post(settings['max_oauth_check_endpoint'], data=payload, verify=False)
-
-            if r.status_code == 200:
+            with timed('oauth'):
+                valid = checkToken(request, oauth_token, username, scope)
+            if valid:
                 # Valid token, proceed.
                 return view_function(*args, **kw)
             else:
@@ -1,4 +1,7 @@
 import pymongo
+from max.MADMax import IdentityMap
+from max.rest.resources import RESOURCES
+from max.instrumentation import RequestTimer, isRequestTimingEnabled
 from pyramid.security import Everyone, Allow, Authenticated
 from pyramid.settings import asbool
 
@@ -16,7 +19,24 @@ class Root(object):
         self.request = request
         # MongoDB:
         registry = self.request.registry
-        self.db = registry.max_store
+        self.primary_db = registry.max_store
+        self.db = self.getRouteDatabase()
+        # Items loaded from the database during this request
+        self.identity_map = IdentityMap()
+        # Time spent in each phase of this request, if timed
+        self.timer = isRequestTimingEnabled(getattr(registry, 'max_settings', {})) and RequestTimer() or None
+
+    def getRouteDatabase(self):
+        """
+            Returns the database with the read preference declared for the matched route,
+            only for read-only requests. Any other request uses the primary.
+        """
+        route = getattr(self.request, 'matched_route', None)
+        if route is None or self.request.method not in ['GET', 'HEAD']:
+            return self.primary_db
+        preference = RESOURCES.get(route.name, {}).get('read_preference')
+        read_stores = getattr(self.request.registry, 'max_read_stores', {})
+        return read_stores.get(preference, self.primary_db)
 
 
 def getMAXSettings(request):
@@ -3,18 +3,21 @@ from pyramid.httpexceptions import HTTPNotFound, HTTPInternalServerError
 
 import json
 
+from max.instrumentation import timed
+
 
 class ResourceRoot(object):
     """
     """
     response_content_type = 'application/text'
 
-    def __init__(self, data, status_code=200, extension={}):
+    def __init__(self, data, status_code=200, extension={}, etag=None):
         """
         """
         self.data = data
         self.status_code = status_code
         self.extension = extension
+        self.etag = etag
 
     def wrap(self):
         """
@@ -30,6 +33,8 @@ class ResourceRoot(object):
         data = payload == None and self.data or payload
         response = Response(data, status_int=self.status_code)
         response.content_type = self.response_content_type
+        if self.etag:
+            response.etag = self.etag
         return response
 
 
@@ -45,7 +50,8 @@ class JSONResourceRoot(ResourceRoot):
         """
         if self.data:
             if isinstance(self.data, list):
-                response_payload = json.dumps(self.wrap())
+                with timed('json'):
+                    response_payload = json.dumps(self.wrap())
             else:
                 return HTTPInternalServerError('Invalid JSON output')
         else:
@@ -54,17 +60,79 @@ class JSONResourceRoot(ResourceRoot):
         return super(JSONResourceRoot, self).buildResponse(payload=response_payload)
 
 
+class JSONResourceStream(object):
+    """
+        Streams a (possibly huge) iterable of json serializable items in a chunked
+        response, without holding all of them in memory. Items are serialized and
+        written in chunks of batch_size items.
+
+        The output has the same form as JSONResourceRoot, but with the totalItems
+        field at the end, as it's not known until all items are written. If ndjson
+        is True, each item is written as a json document in its own line instead.
+    """
+
+    def __init__(self, items, status_code=200, batch_size=100, ndjson=False):
+        """
+        """
+        self.items = items
+        self.status_code = status_code
+        self.batch_size = batch_size
+        self.ndjson = ndjson
+
+    @property
+    def response_content_type(self):
+        return self.ndjson and 'application/x-ndjson' or 'application/json'
+
+    def iterBatches(self):
+        """
+            Yields lists of the serialized items, batch_size items at a time
+        """
+        batch = []
+        for item in self.items:
+            batch.append(json.dumps(item))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def iterNDJSON(self):
+        """
+        """
+        for batch in self.iterBatches():
+            yield '\n'.join(batch) + '\n'
+
+    def iterJSON(self):
+        """
+        """
+        total = 0
+        yield '{"items": ['
+        for batch in self.iterBatches():
+            yield (total and ', ' or '') + ', '.join(batch)
+            total += len(batch)
+        yield '], "totalItems": %d}' % total
+
+    def buildResponse(self, payload=None):
+        """
+        """
+        app_iter = self.ndjson and self.iterNDJSON() or self.iterJSON()
+        response = Response(app_iter=app_iter, status_int=self.status_code)
+        response.content_type = self.response_content_type
+        return response
+
+
 class ResourceEntity(object):
     """
     """
 
     response_content_type = 'application/text'
 
-    def __init__(self, data, status_code=200):
+    def __init__(self, data, status_code=200, etag=None):
         """
         """
         self.data = data
         self.status_code = status_code
+        self.etag = etag
 
     def buildResponse(self, payload=None):
         """
@@ -73,6 +141,8 @@ class ResourceEntity(object):
         if data:
             response = Response(data, status_int=self.status_code)
             response.content_type = self.response_content_type
+            if self.etag:
+                response.etag = self.etag
         else:
             response = HTTPNotFound()
 
@@ -91,7 +161,8 @@ class JSONResourceEntity(ResourceEntity):
         """
         if self.data:
             if isinstance(self.data, dict):
-                response_payload = json.dumps(self.data)
+                with timed('json'):
+                    response_payload = json.dumps(self.data)
             else:
                 return HTTPInternalServerError('Invalid JSON output')
         else:
@@ -1,5 +1,5 @@
 from pyramid.view import view_config
-from pyramid.httpexceptions import HTTPNotImplemented
+from pyramid.httpexceptions import HTTPNotImplemented, HTTPNotModified
 
 from max.MADMax import MADMaxDB
 from max.models import Activity
@@ -8,7 +8,9 @@ from max.oauth2 import oauth2
 from max.exceptions import MissingField, Unauthorized
 
 from max.rest.ResourceHandlers import JSONResourceRoot, JSONResourceEntity
-from max.rest.utils import searchParams, canReadContext
+from max.rest.utils import searchParams, fieldsParam, buildCursors, canReadContext
+from max.rest.utils import buildETag, isNotModified
+from max.services import insertActivity
 import re
 
 
@@ -23,11 +25,16 @@ def getUserActivities(context, request):
          Retorna all activities generated by a user
     """
 
-    mmdb = MADMaxDB(context.db)
+    mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
+    search_params = searchParams(request)
     query = {'actor._id': request.actor['_id']}
-    activities = mmdb.activity.search(query, sort="_id", flatten=1)
+    activities = mmdb.activity.search(query, show_fields=fieldsParam(request), sort="_id", flatten=1, **search_params)
+    # The page itself is the validator, so its query runs only once
+    etag = buildETag(request.query_string, activities)
+    if isNotModified(request, etag):
+        return HTTPNotModified(etag=etag)
 
-    handler = JSONResourceRoot(activities)
+    handler = JSONResourceRoot(activities, extension=buildCursors(activities, search_params['limit']), etag=etag)
     return handler.buildResponse()
 
 
@@ -48,19 +55,11 @@ def addUserActivity(context, request):
     newactivity = Activity()
     newactivity.fromRequest(request, rest_params=rest_params)
 
-    # If we have the _id setted, then the object already existed in the DB,
-    # otherwise, proceed to insert it into the DB
-    # In both cases, respond with the JSON of the object and the appropiate
-    # HTTP Status Code
-
-    if newactivity.get('_id'):
-        # Already Exists
-        code = 200
-    else:
-        # New User
-        code = 201
-        activity_oid = newactivity.insert()
-        newactivity['_id'] = activity_oid
+    # If the activity carries an idempotency key already used, the existing one
+    # is returned instead. In both cases, respond with the JSON of the object
+    # and the appropiate HTTP Status Code
+    insertActivity(request.registry, context.db, newactivity)
+    code = newactivity.duplicated and 200 or 201
 
     handler = JSONResourceEntity(newactivity.flatten(), status_code=code)
     return handler.buildResponse()
@@ -80,7 +79,8 @@ def getActivities(context, request):
     if not urlhash:
         raise MissingField, 'You have to specify one context'
 
-    mmdb = MADMaxDB(context.db)
+    mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
+    fields = fieldsParam(request)
 
     # subscribed contexts with read permission
     subscribed = [context.get('url') for context in request.actor.subscribedTo.get('items', []) if 'read' in context.get('permissions', [])]
@@ -97,6 +97,10 @@ def getActivities(context, request):
     query = {'permissions.read': 'public', 'url': url_regex}
     public = [result.url for result in mmdb.contexts.search(query, show_fields=['url'])]
 
+    # Term searches only need to look in the readable contexts within url
+    readable = set([curl for curl in subscribed if curl.startswith(url)] + public)
+    search_params = searchParams(request, contexts=readable)
+
     query = {}                                                     # Search
     query.update({'verb': 'post'})                                 # 'post' activities
     query.update({'contexts.url': url_regex})                      # equal or child of url
@@ -110,16 +114,24 @@ def getActivities(context, request):
         public_query = {'contexts.url': {'$in': public}}
         contexts_query.append(public_query)                        # pubic contexts
 
+    # The page also carries the read context
+    query.update({'$or': contexts_query})
     if contexts_query:
-        query.update({'$or': contexts_query})
-        activities = mmdb.activity.search(query, sort="_id", flatten=1, **searchParams(request))
+        activities = mmdb.activity.search(query, show_fields=fields, sort="_id", flatten=1, **search_params)
     else:
         # we have no public contexts and we are not subscribed to any context, so we
         # won't get anything
         activities = []
 
-    # pass the read context as a extension to the resource
-    handler = JSONResourceRoot(activities, extension=dict(context=rcontext.flatten()))
+    # The page itself is the validator, so its query runs only once
+    etag = buildETag(request.query_string, rcontext, activities)
+    if isNotModified(request, etag):
+        return HTTPNotModified(etag=etag)
+
+    # pass the read context and the page cursors as a extension to the resource
+    extension = dict(context=rcontext.flatten())
+    extension.update(buildCursors(activities, search_params['limit']))
+    handler = JSONResourceRoot(activities, extension=extension, etag=etag)
     return handler.buildResponse()
 
 
@@ -133,11 +145,15 @@ def getActivity(context, request):
          Mostra una activitat
     """
 
-    mmdb = MADMaxDB(context.db)
+    mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
     activity_oid = request.matchdict['activity']
-    activity = mmdb.activity[activity_oid].flatten()
+    activity = mmdb.activity[activity_oid]
+
+    etag = buildETag(request.query_string, activity['_id'], activity.get('replies', {}).get('totalItems', 0), activity.get('version', 0))
+    if isNotModified(request, etag):
+        return HTTPNotModified(etag=etag)
 
-    handler = JSONResourceEntity(activity)
+    handler = JSONResourceEntity(activity.flatten(), etag=etag)
     return handler.buildResponse()
 
 
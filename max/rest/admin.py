@@ -5,8 +5,20 @@ from max.models import Activity
 from max.decorators import MaxRequest, MaxResponse
 from max.MADMax import MADMaxDB
 from max.rest.ResourceHandlers import JSONResourceEntity
-from max.rest.ResourceHandlers import JSONResourceRoot
-from max.exceptions import ObjectNotFound
+from max.resources import getMAXSettings
+from max.services import insertActivity, addActivities, ACTIVITY_ERRORS
+from max.mongodb import getPoolStats
+from max.timelines import removeActivityFromTimelines
+from max.terms import removeActivityTerms
+from max.instrumentation import isRequestTimingEnabled
+from max.rest.ResourceHandlers import JSONResourceRoot, JSONResourceStream
+from max.exceptions import ObjectNotFound, UnknownUserError, ValidationError
+from max.rest.utils import searchParams, buildCursors, iterBulkPostData
+
+from hashlib import sha1
+from itertools import islice
+
+BULK_BATCH_SIZE = 500
 
 
 @view_config(route_name='admin_context_activities', request_method='POST', permission='admin')
@@ -26,33 +38,142 @@ def addAdminUserActivity(context, request):
     newactivity = Activity()
     newactivity.fromRequest(request, rest_params=rest_params)
 
-    # If we have the _id setted, then the object already existed in the DB,
-    # otherwise, proceed to insert it into the DB
-    # In both cases, respond with the JSON of the object and the appropiate
-    # HTTP Status Code
-
-    if newactivity.get('_id'):
-        # Already Exists
-        code = 200
-    else:
-        # New User
-        code = 201
-        activity_oid = newactivity.insert()
-        newactivity['_id'] = activity_oid
+    # If the activity carries an idempotency key already used, the existing one
+    # is returned instead. In both cases, respond with the JSON of the object
+    # and the appropiate HTTP Status Code
+    insertActivity(request.registry, context.db, newactivity)
+    code = newactivity.duplicated and 200 or 201
 
     handler = JSONResourceEntity(newactivity.flatten(), status_code=code)
     return handler.buildResponse()
 
 
+def getBulkActorKey(actor):
+    """
+        Returns the (objectType, username|urlHash) key that identifies the actor
+        of a bulk item, or None if the actor is not specified
+    """
+    if not isinstance(actor, dict):
+        return None
+    if actor.get('objectType', 'person') == 'context':
+        url = actor.get('url')
+        urlHash = actor.get('urlHash') or url and sha1(url.encode('utf-8')).hexdigest()
+        return urlHash and ('context', urlHash) or None
+    username = actor.get('username')
+    return username and ('person', username) or None
+
+
+def resolveBulkActors(mmdb, items):
+    """
+        Loads the actors of all the bulk items at once, with a single query for users
+        and another one for contexts. Returns a dict of actors keyed by getBulkActorKey
+    """
+    keys = set([getBulkActorKey(item.get('actor')) for item in items if isinstance(item, dict)])
+    usernames = [value for objectType, value in filter(None, keys) if objectType == 'person']
+    urlHashes = [value for objectType, value in filter(None, keys) if objectType == 'context']
+
+    actors = {}
+    for username, user in (usernames and mmdb.users.getItemsMapByusername(usernames) or {}).items():
+        user.setdefault('displayName', user['username'])
+        actors[('person', username)] = user
+    for urlHash, context in (urlHashes and mmdb.contexts.getItemsMapByurlHash(urlHashes) or {}).items():
+        context.setdefault('displayName', context['url'])
+        actors[('context', urlHash)] = context
+    return actors
+
+
+def addBulkActivities(context, request, items):
+    """
+        Validates and inserts a batch of activities posted to the bulk endpoint.
+        Actors are resolved once for the whole batch, and the valid activities are
+        inserted at once. Returns a status for each item, in the same order.
+    """
+    mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
+    actors = resolveBulkActors(mmdb, items)
+
+    statuses = [None] * len(items)
+    postings = []
+    for position, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValidationError, 'Item is not a valid json object'
+            actor_key = getBulkActorKey(item.get('actor'))
+            if actor_key is None:
+                raise UnknownUserError, 'No user or context specified as actor'
+            if actor_key not in actors:
+                raise UnknownUserError, 'Unknown actor identified by %s: %s' % (actor_key[0] == 'person' and 'username' or 'context', actor_key[1])
+        except ACTIVITY_ERRORS, message:
+            statuses[position] = dict(status=400, error=message.__class__.__name__, error_description=message.value)
+            continue
+        postings.append((position, actors[actor_key], item))
+
+    results = addActivities(request.registry, context.db,
+                            [(actor, item) for position, actor, item in postings],
+                            identity_map=context.identity_map)
+    for (position, actor, item), result in zip(postings, results):
+        if isinstance(result, ACTIVITY_ERRORS):
+            statuses[position] = dict(status=400, error=result.__class__.__name__, error_description=result.value)
+        elif isinstance(result, Exception):
+            statuses[position] = dict(status=500, error='InternalServerError', error_description='Unexpected error creating the activity')
+        else:
+            statuses[position] = dict(status=result.duplicated and 200 or 201, id=result['_id'])
+    return statuses
+
+
+@view_config(route_name='admin_activities', request_method='POST', permission='admin')
+@MaxResponse
+@MaxRequest
+def addAdminActivities(context, request):
+    """
+         /admin/activities
+
+         Add many activities at once, each one impersonated as the valid MAX user or context
+         specified in its actor, ie. {"objectType": "person", "username": "..."} or
+         {"objectType": "context", "url": "..."}. Activities are posted as a json array
+         or as newline delimited json (application/x-ndjson), and processed in batches
+         of max.bulk_batch_size items. ndjson bodies are read as each batch is processed.
+
+         Responds with the status of each item, in the same order they were posted:
+         201 and the new id, 200 and the id of the existing activity if its idempotencyKey
+         was already used by the same actor, 400 and the error, or 500 if the item
+         failed unexpectedly.
+    """
+    items = iterBulkPostData(request)
+    batch_size = int(getMAXSettings(request).get('max_bulk_batch_size', BULK_BATCH_SIZE))
+
+    statuses = []
+    batch = list(islice(items, batch_size))
+    while batch:
+        statuses.extend(addBulkActivities(context, request, batch))
+        batch = list(islice(items, batch_size))
+
+    handler = JSONResourceRoot(statuses)
+    return handler.buildResponse()
+
+
+def streamCollection(collection, request):
+    """
+        Returns a response streaming all the objects of the collection, as a json
+        document or as newline delimited json, as requested in the stream param
+    """
+    items = collection.iterate(flatten=1)
+    handler = JSONResourceStream(items, ndjson=request.params.get('stream') == 'ndjson')
+    return handler.buildResponse()
+
+
 @view_config(route_name='admin_users', request_method='GET', permission='operations')
 @MaxResponse
 @MaxRequest
 def getUsers(context, request):
     """
     """
-    mmdb = MADMaxDB(context.db)
-    users = mmdb.users.dump(flatten=1)
-    handler = JSONResourceRoot(users)
+    mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
+    if request.params.get('stream'):
+        return streamCollection(mmdb.users, request)
+
+    search_params = searchParams(request)
+    users = mmdb.users.search({}, sort="_id", flatten=1, **search_params)
+    handler = JSONResourceRoot(users, extension=buildCursors(users, search_params['limit']))
     return handler.buildResponse()
 
 
@@ -62,9 +183,13 @@ def getUsers(context, request):
 def getActivities(context, request):
     """
     """
-    mmdb = MADMaxDB(context.db)
-    activities = mmdb.activity.dump(flatten=1)
-    handler = JSONResourceRoot(activities)
+    mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
+    if request.params.get('stream'):
+        return streamCollection(mmdb.activity, request)
+
+    search_params = searchParams(request)
+    activities = mmdb.activity.search({}, sort="_id", flatten=1, **search_params)
+    handler = JSONResourceRoot(activities, extension=buildCursors(activities, search_params['limit']))
     return handler.buildResponse()
 
 
@@ -74,9 +199,44 @@ def getActivities(context, request):
 def getContexts(context, request):
     """
     """
-    mmdb = MADMaxDB(context.db)
-    contexts = mmdb.contexts.dump(flatten=1)
-    handler = JSONResourceRoot(contexts)
+    mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
+    if request.params.get('stream'):
+        return streamCollection(mmdb.contexts, request)
+
+    search_params = searchParams(request)
+    contexts = mmdb.contexts.search({}, sort="_id", flatten=1, **search_params)
+    handler = JSONResourceRoot(contexts, extension=buildCursors(contexts, search_params['limit']))
+    return handler.buildResponse()
+
+
+@view_config(route_name='admin_connections', request_method='GET', permission='operations')
+@MaxResponse
+@MaxRequest
+def getConnections(context, request):
+    """
+         /admin/connections
+
+         Returns the database connection pool configuration and usage
+    """
+    handler = JSONResourceEntity(getPoolStats(request.registry.max_store.connection))
+    return handler.buildResponse()
+
+
+@view_config(route_name='admin_metrics', request_method='GET', permission='operations')
+@MaxResponse
+@MaxRequest
+def getMetrics(context, request):
+    """
+         /admin/metrics
+
+         Returns the timing counters of each route served by this process, and
+         the counters of its oauth token cache, if enabled
+    """
+    token_cache = getattr(request.registry, 'max_token_cache', None)
+    metrics = dict(timing=isRequestTimingEnabled(request.registry.max_settings),
+                   routes=request.registry.max_metrics.stats(),
+                   token_cache=token_cache and token_cache.stats() or None)
+    handler = JSONResourceEntity(metrics)
     return handler.buildResponse()
 
 
@@ -86,7 +246,7 @@ def getContexts(context, request):
 def deleteUser(context, request):
     """
     """
-    mmdb = MADMaxDB(context.db)
+    mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
     userid = request.matchdict.get('id', None)
     try:
         found_user = mmdb.users[userid]
@@ -103,7 +263,7 @@ def deleteUser(context, request):
 def deleteActivity(context, request):
     """
     """
-    mmdb = MADMaxDB(context.db)
+    mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
     activityid = request.matchdict.get('id', None)
     try:
         found_activity = mmdb.activity[activityid]
@@ -111,6 +271,8 @@ def deleteActivity(context, request):
         raise ObjectNotFound, "There's no activity with id: %s" % activityid
 
     found_activity.delete()
+    removeActivityFromTimelines(context.db, found_activity['_id'])
+    removeActivityTerms(context.db, found_activity['_id'])
     return HTTPNoContent()
 
 
@@ -120,7 +282,7 @@ def deleteActivity(context, request):
 def deleteContext(context, request):
     """
     """
-    mmdb = MADMaxDB(context.db)
+    mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
     contextid = request.matchdict.get('id', None)
     try:
         found_context = mmdb.contexts[contextid]
@@ -1,15 +1,19 @@
 # -*- coding: utf-8 -*-
 from pyramid.view import view_config
-from pyramid.httpexceptions import HTTPNotImplemented
+from pyramid.httpexceptions import HTTPNotImplemented, HTTPNotModified
 
 from max.MADMax import MADMaxDB
 from max.rest.ResourceHandlers import JSONResourceRoot, JSONResourceEntity
 from max.decorators import MaxRequest, MaxResponse
-from max.models import Activity
+from max.models import Activity, MAX_EMBEDDED_REPLIES
 from max.oauth2 import oauth2
-from max.rest.utils import flatten
+from max.rest.utils import flattened, searchParams, buildCursors, buildETag, isNotModified
+from max.resources import getMAXSettings
+from max.terms import prepareActivityTerms, indexActivityTerms
+from max.shortener import shortenActivityURLs
 
 from bson.objectid import ObjectId
+from pymongo import ASCENDING
 
 
 @view_config(route_name='user_comments', request_method='GET')
@@ -27,21 +31,27 @@ def getUserComments(context, request):
 @oauth2(['widgetcli'])
 def getActivityComments(context, request):
     """
+         /activities/{activity}/comments
+
+         Returns a page of the activity comments, oldest first. The activity only
+         embeds the latest ones, so the comments are read from the comment activities
     """
     activityid = request.matchdict['activity']
 
-    mmdb = MADMaxDB(context.db)
+    mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
     refering_activity = mmdb.activity[activityid]
-    #cond1 = {'object.objectType' : 'comment'}
-    #cond2 = {'object.inReplyTo._id' : refering_activity['_id']}
-    #query = {'$and' : [ cond1, cond2 ] }
-    #activities = mmdb.activity.search(query, sort="_id", limit=10, flatten=1)
-
-    #handler = JSONResourceRoot(activities)
-    replies = refering_activity.get('replies', {})
-    items = replies.get('items', [])
-    flatten(items)
-    handler = JSONResourceRoot(items)
+
+    # Comments are only added, so its count tells if there's anything new, and
+    # the activity version if any of them was rewritten since
+    etag = buildETag(request.query_string, refering_activity['_id'], refering_activity.get('replies', {}).get('totalItems', 0), refering_activity.get('version', 0))
+    if isNotModified(request, etag):
+        return HTTPNotModified(etag=etag)
+
+    search_params = searchParams(request)
+    query = {'verb': 'comment', 'object.inReplyTo._id': refering_activity['_id']}
+    comments = mmdb.activity.search(query, sort="_id", sort_dir=ASCENDING, **search_params)
+    items = flattened([comment.asReply() for comment in comments])
+    handler = JSONResourceRoot(items, extension=buildCursors(items, search_params['limit'], ascending=True), etag=etag)
     return handler.buildResponse()
 
 
@@ -57,7 +67,7 @@ def addActivityComment(context, request):
     # s'ha de iterar si es vol que el comentari sigui de N activitats
     activityid = request.matchdict['activity']
 
-    mmdb = MADMaxDB(context.db)
+    mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
     refering_activity = mmdb.activity[activityid]
 
     # Prepare rest parameters to be merged with post data
@@ -69,19 +79,23 @@ def addActivityComment(context, request):
     newactivity = Activity()
     newactivity.fromRequest(request, rest_params=rest_params)
 
-    code = 201
-    newactivity_oid = newactivity.insert()
-    newactivity['_id'] = newactivity_oid
+    terms = prepareActivityTerms(getMAXSettings(request), newactivity)
+    newactivity['_id'] = newactivity.insert()
+
+    # A comment repeated with the same idempotency key was already added, return it
+    if newactivity.duplicated:
+        handler = JSONResourceEntity(newactivity.flatten(), status_code=200)
+        return handler.buildResponse()
 
-    comment = dict(newactivity.object)
-    comment['published'] = newactivity.published
-    comment['author'] = request.actor
-    comment['id'] = newactivity._id
-    del comment['inReplyTo']
+    max_replies = int(getMAXSettings(request).get('max_embedded_replies', MAX_EMBEDDED_REPLIES))
+    refering_activity.addComment(newactivity, max_replies=max_replies)
+    shortenActivityURLs(request.registry, context.db, newactivity, reply_to=refering_activity['_id'])
 
-    refering_activity.addComment(comment)
+    # The comment terms are searchable through the commented activity
+    if terms is not None:
+        indexActivityTerms(context.db, refering_activity, terms)
 
-    handler = JSONResourceEntity(newactivity.flatten(), status_code=code)
+    handler = JSONResourceEntity(newactivity.flatten(), status_code=201)
     return handler.buildResponse()
 
 
@@ -1,5 +1,5 @@
 from pyramid.view import view_config
-from pyramid.httpexceptions import HTTPNotImplemented, HTTPNoContent
+from pyramid.httpexceptions import HTTPNotImplemented, HTTPNoContent, HTTPNotModified
 from pyramid.response import Response
 
 from max.MADMax import MADMaxDB, MADMaxCollection
@@ -10,7 +10,9 @@ from max.rest.ResourceHandlers import JSONResourceRoot, JSONResourceEntity
 import os
 
 from max.oauth2 import oauth2
-from max.rest.utils import extractPostData, downloadTwitterUserImage
+from max.resources import getMAXSettings
+from max.timelines import isTimelineFanOutEnabled, removeContextFromTimelines
+from max.rest.utils import extractPostData, downloadTwitterUserImage, buildETag, isNotModified
 import requests
 import json
 import time
@@ -22,14 +24,19 @@ import time
 def getContext(context, request):
     """
     """
-    mmdb = MADMaxDB(context.db)
+    mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
     urlhash = request.matchdict.get('urlHash', None)
     found_context = mmdb.contexts.getItemsByurlHash(urlhash)
 
     if not found_context:
         raise ObjectNotFound, "There's no context matching this url hash: %s" % urlhash
 
-    handler = JSONResourceEntity(found_context[0].flatten())
+    # Contexts are small, so the stored document itself is the validator
+    etag = buildETag(found_context[0])
+    if isNotModified(request, etag):
+        return HTTPNotModified(etag=etag)
+
+    handler = JSONResourceEntity(found_context[0].flatten(), etag=etag)
     return handler.buildResponse()
 
 
@@ -42,7 +49,7 @@ def getContextAvatar(context, request):
     context_image_filename = '%s/%s.jpg' % (AVATAR_FOLDER, urlHash)
 
     if not os.path.exists(context_image_filename):
-        mmdb = MADMaxDB(context.db)
+        mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
         found_context = mmdb.contexts.getItemsByurlHash(urlHash)
         if len(found_context) > 0:
             twitter_username = found_context[0]['twitterUsername']
@@ -54,7 +61,7 @@ def getContextAvatar(context, request):
         modification_time = os.path.getmtime(context_image_filename)
         hours_since_last_modification = (time.time() - modification_time) / 60 / 60
         if hours_since_last_modification > 3:
-            mmdb = MADMaxDB(context.db)
+            mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
             found_context = mmdb.contexts.getItemsByurlHash(urlHash)
             twitter_username = found_context[0]['twitterUsername']
             downloadTwitterUserImage(twitter_username, context_image_filename)
@@ -102,7 +109,7 @@ def ModifyContext(context, request):
     """
     """
     urlHash = request.matchdict['urlHash']
-    contexts = MADMaxCollection(context.db.contexts)
+    contexts = MADMaxCollection(context.db.contexts, identity_map=context.identity_map)
     maxcontext = contexts.getItemsByurlHash(urlHash)
     if maxcontext:
         maxcontext = maxcontext[0]
@@ -122,15 +129,22 @@ def ModifyContext(context, request):
 def DeleteContext(context, request):
     """
     """
-    mmdb = MADMaxDB(context.db)
+    mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
     urlhash = request.matchdict.get('urlHash', None)
     found_context = mmdb.contexts.getItemsByurlHash(urlhash)
 
     if not found_context:
         raise ObjectNotFound, "There's no context matching this url hash: %s" % urlhash
 
+    # Users losing the subscription, to take the context activities out of their timelines
+    fanout = isTimelineFanOutEnabled(getMAXSettings(request))
+    if fanout:
+        subscribers = [user['_id'] for user in context.db.users.find({'subscribedTo.items.urlHash': urlhash}, {'_id': 1})]
+
     found_context[0].delete()
     found_context[0].removeUserSubscriptions()
+    if fanout:
+        removeContextFromTimelines(context.db, found_context[0].url, subscribers)
     return HTTPNoContent()
 
 
@@ -3,6 +3,10 @@ from pyramid.httpexceptions import HTTPNotImplemented
 from max.decorators import MaxResponse, MaxRequest
 
 from max.models import Activity
+from max.MADMax import MADMaxDB
+from max.exceptions import ObjectNotFound
+from max.resources import getMAXSettings
+from max.timelines import isTimelineFanOutEnabled, backfillTimeline
 
 from max.rest.ResourceHandlers import JSONResourceEntity
 
@@ -31,16 +35,33 @@ def follow(context, request):
     #XXX TODO ara nomes es tracta un sol follow
     # s'ha de iterar si es vol que el comentari sigui de N follows
     actor = request.actor
-    rest_params = {'actor': request.actor}
+    followed_username = request.matchdict['followedDN']
+
+    mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
+    followed = mmdb.users.getItemsMapByusername([followed_username]).get(followed_username)
+    if not followed:
+        raise ObjectNotFound, "Unknown user: %s" % followed_username
+
+    rest_params = {'actor': actor,
+                   'verb': 'follow',
+                   'object': {'objectType': 'person',
+                              'username': followed_username}}
 
     # Initialize a Activity object from the request
-    newactivity = Activity(request, rest_params=rest_params)
+    newactivity = Activity()
+    newactivity.fromRequest(request, rest_params=rest_params)
 
     code = 201
     newactivity_oid = newactivity.insert()
     newactivity['_id'] = newactivity_oid
 
-    actor.addFollower(newactivity['object'])
+    # Store the followed user id along with the username, so timelines
+    # don't have to resolve it on every read
+    actor.addFollower(dict(newactivity['object'], _id=followed['_id']))
+
+    # Bring the existing activities of the followed user to the materialized timeline
+    if isTimelineFanOutEnabled(getMAXSettings(request)):
+        backfillTimeline(context.db, actor['_id'], {'actor._id': followed['_id']})
 
     handler = JSONResourceEntity(newactivity.flatten(), status_code=code)
     return handler.buildResponse()
@@ -1,5 +1,5 @@
 from pyramid.view import view_config
-from pyramid.httpexceptions import HTTPNotImplemented
+from pyramid.httpexceptions import HTTPNotImplemented, HTTPNotModified
 from pyramid.response import Response
 
 from max.MADMax import MADMaxDB, MADMaxCollection
@@ -9,7 +9,7 @@ from max.rest.ResourceHandlers import JSONResourceRoot, JSONResourceEntity
 import os
 
 from max.oauth2 import oauth2
-from max.rest.utils import extractPostData
+from max.rest.utils import extractPostData, buildETag, isNotModified
 
 
 @view_config(route_name='user', request_method='GET')
@@ -19,7 +19,12 @@ from max.rest.utils import extractPostData
 def getUser(context, request):
     """
     """
-    handler = JSONResourceEntity(request.actor.flatten())
+    # The user is already loaded, so the stored document itself is the validator
+    etag = buildETag(request.actor)
+    if isNotModified(request, etag):
+        return HTTPNotModified(etag=etag)
+
+    handler = JSONResourceEntity(request.actor.flatten(), etag=etag)
     return handler.buildResponse()
 
 
@@ -1,9 +1,21 @@
+# Cache policies, set as the Cache-Control header of the responses of each resource.
+# Resources that answer conditional requests (ETag / If-None-Match) let the clients
+# keep its copy and revalidate it, the rest are not cached by default.
+NO_CACHE = 'must-revalidate, max-age=0, no-cache, no-store'
+REVALIDATE = 'private, max-age=0, must-revalidate'
+
+# Read preference of the GET requests of a resource. Listings that can tolerate
+# reading slightly stale data declare it to be served from the secondaries when
+# mongodb.secondary_reads is enabled, the rest are always read from the primary.
+SECONDARY_READS = 'secondary_preferred'
+
 OAUTH_RESOURCES = {
 'users': {'route': '/people'},
-'user': {'route': '/people/{username}'},
+'user': {'route': '/people/{username}', 'cache': REVALIDATE},
 'avatar': {'route': '/people/{username}/avatar'},
-'user_activities': {'route': '/people/{username}/activities'},
-'timeline': {'route': '/people/{username}/timeline'},
+'user_activities': {'route': '/people/{username}/activities', 'cache': REVALIDATE, 'read_preference': SECONDARY_READS},
+'timeline': {'route': '/people/{username}/timeline', 'cache': REVALIDATE, 'read_preference': SECONDARY_READS},
+'timeline_poll': {'route': '/people/{username}/timeline/poll'},
 'user_comments': {'route': '/people/{username}/comments'},
 'user_shares': {'route': '/people/{username}/shares'},
 'user_likes': {'route': '/people/{username}/likes'},
@@ -12,9 +24,9 @@ OAUTH_RESOURCES = {
 'subscriptions': {'route': '/people/{username}/subscriptions'},
 'subscription': {'route': '/people/{username}/subscriptions/{urlHash}'},
 
-'activities': {'route': '/activities'},
-'activity': {'route': '/activities/{activity}'},
-'comments': {'route': '/activities/{activity}/comments'},
+'activities': {'route': '/activities', 'cache': REVALIDATE, 'read_preference': SECONDARY_READS},
+'activity': {'route': '/activities/{activity}', 'cache': REVALIDATE},
+'comments': {'route': '/activities/{activity}/comments', 'cache': REVALIDATE, 'read_preference': SECONDARY_READS},
 'comment': {'route': '/activities/{activity}/comments/{commentId}'},
 'likes': {'route': '/activities/{activity}/likes'},
 'like': {'route': '/activities/{activity}/likes/{likeId}'},
@@ -22,7 +34,7 @@ OAUTH_RESOURCES = {
 'share': {'route': '/activities/{activity}/shares/{shareId}'},
 
 'contexts': {'route': '/contexts'},
-'context': {'route': '/contexts/{urlHash}'},
+'context': {'route': '/contexts/{urlHash}', 'cache': REVALIDATE},
 'context_avatar': {'route': '/contexts/{urlHash}/avatar'},
 'context_permissions': {'route': '/contexts/{urlHash}/permissions'},
 'context_user_permissions': {'route': '/contexts/{urlHash}/permissions/{username}'},
@@ -32,9 +44,11 @@ OAUTH_RESOURCES = {
 ADMIN_RESOURCES = {
 'admin_user_activities': {'route': '/admin/people/{username}/activities'},
 'admin_context_activities': {'route': '/admin/contexts/{urlHash}/activities'},
-'admin_users': {'route': '/admin/people'},
-'admin_activities': {'route': '/admin/activities'},
-'admin_contexts': {'route': '/admin/contexts'},
+'admin_users': {'route': '/admin/people', 'read_preference': SECONDARY_READS},
+'admin_activities': {'route': '/admin/activities', 'read_preference': SECONDARY_READS},
+'admin_contexts': {'route': '/admin/contexts', 'read_preference': SECONDARY_READS},
+'admin_connections': {'route': '/admin/connections'},
+'admin_metrics': {'route': '/admin/metrics'},
 
 'admin_user': {'route': '/admin/people/{id}'},
 'admin_activity': {'route': '/admin/activities/{id}'},
@@ -7,6 +7,8 @@ from max.MADMax import MADMaxCollection
 from max.models import Activity
 from max.rest.ResourceHandlers import JSONResourceEntity
 from max.oauth2 import oauth2
+from max.resources import getMAXSettings
+from max.timelines import isTimelineFanOutEnabled, backfillTimeline
 from hashlib import sha1
 
 
@@ -39,7 +41,7 @@ def subscribe(context, request):
         # If user already subscribed, send a 200 code and retrieve the original subscribe activity
         # post when user was susbcribed. This way in th return data we'll have the date of subscription
         code = 200
-        activities = MADMaxCollection(context.db.activity)
+        activities = MADMaxCollection(context.db.activity, identity_map=context.identity_map)
         query = {'verb': 'subscribe', 'object.url': newactivity.object['url'], 'actor.username': actor.username}
         newactivity = activities.search(query)[-1]  # Pick the last one, so we get the last time user subscribed (in case a unsbuscription occured sometime...)
 
@@ -50,10 +52,14 @@ def subscribe(context, request):
         newactivity['_id'] = newactivity_oid
 
         #Register subscription to the actor
-        contexts = MADMaxCollection(context.db.contexts, query_key='urlHash')
+        contexts = MADMaxCollection(context.db.contexts, query_key='urlHash', identity_map=context.identity_map)
         scontext = contexts[sha1(newactivity['object']['url']).hexdigest()]
         actor.addSubscription(scontext)
 
+        # Bring the existing context activities to the materialized timeline
+        if isTimelineFanOutEnabled(getMAXSettings(request)):
+            backfillTimeline(context.db, actor['_id'], {'contexts.url': scontext['url']})
+
     handler = JSONResourceEntity(newactivity.flatten(), status_code=code)
     return handler.buildResponse()
 
@@ -1,10 +1,15 @@
 from pyramid.view import view_config
+from pyramid.httpexceptions import HTTPNotModified, HTTPNotImplemented
 
 from max.MADMax import MADMaxDB
 from max.rest.ResourceHandlers import JSONResourceRoot
 from max.decorators import MaxRequest, MaxResponse
 from max.oauth2 import oauth2
-from max.rest.utils import searchParams
+from max.rest.utils import searchParams, fieldsParam, buildCursors, buildETag, isNotModified, encodeCursor
+from max.resources import getMAXSettings
+from max.exceptions import InvalidSearchParams
+from max.timelines import isTimelineFanOutEnabled, getTimelineActivityIds, buildTimelineQuery
+from max.notifications import getTimelineKeys, getPollTimeout
 
 
 @view_config(route_name='timeline', request_method='GET')
@@ -21,16 +26,34 @@ def getUserTimeline(context, request):
     is_context_resource = 'timeline/contexts' in request.path
     is_follows_resource = 'timeline/follows' in request.path
 
-    mmdb = MADMaxDB(context.db)
+    mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
+    # Activities of the contexts timeline come only from the subscribed contexts
+    subscribed_urls = is_context_resource and [subscribed['url'] for subscribed in actor['subscribedTo']['items']] or None
+    search_params = searchParams(request, contexts=subscribed_urls)
+    fields = fieldsParam(request)
+
+    # When timelines are materialized on write, read the page of activity ids
+    # directly from the owner's timeline. Filtered searches still use the query below
+    is_filtered = [param for param in ['hashtag', 'keywords', 'author', 'ids'] if param in search_params]
+    if isTimelineFanOutEnabled(getMAXSettings(request)) and not is_follows_resource and not is_context_resource and not is_filtered:
+        activity_ids = getTimelineActivityIds(context.db, actor['_id'], **search_params)
+        query = {'_id': {'$in': activity_ids}}
+        if activity_ids:
+            activities = mmdb.activity.search(query, show_fields=fields, sort="_id", flatten=1)
+        else:
+            activities = []
+
+        # The page itself is the validator, so its query runs only once
+        etag = buildETag(request.query_string, activities)
+        if isNotModified(request, etag):
+            return HTTPNotModified(etag=etag)
+        handler = JSONResourceRoot(activities, extension=buildCursors(activities, search_params['limit']), etag=etag)
+        return handler.buildResponse()
 
     actor_query = {'actor._id': actor['_id']}
 
     # Add the activity of the people that the user follows
-    actors_followings = []
-    for following in actor['following']['items']:
-        followed_person = mmdb.users.getItemsByusername(following['username'])[0]
-        if followed_person:
-            actors_followings.append({'actor._id': followed_person['_id']})
+    actors_followings = [{'actor._id': followed_id} for followed_id in actor.getFollowedIds()]
 
     # Add the activity of the people that posts to a particular context
     contexts_followings = []
@@ -50,12 +73,60 @@ def getUserTimeline(context, request):
     if is_follows_resource:
         query_items += contexts_followings
 
+    query = {'$or': query_items, 'verb': 'post'}
     if query_items:
-        query = {'$or': query_items}
-        query['verb'] = 'post'
-        activities = mmdb.activity.search(query, sort="_id", flatten=1, **searchParams(request))
+        activities = mmdb.activity.search(query, show_fields=fields, sort="_id", flatten=1, **search_params)
     else:
         activities = []
 
-    handler = JSONResourceRoot(activities)
+    # The page itself is the validator, so its query runs only once
+    etag = buildETag(request.query_string, activities)
+    if isNotModified(request, etag):
+        return HTTPNotModified(etag=etag)
+
+    handler = JSONResourceRoot(activities, extension=buildCursors(activities, search_params['limit']), etag=etag)
+    return handler.buildResponse()
+
+
+@view_config(route_name='timeline_poll', request_method='GET')
+@MaxResponse
+@MaxRequest
+@oauth2(['widgetcli'])
+def pollUserTimeline(context, request):
+    """
+         /people/{username}/timeline/poll
+
+         Returns the timeline activities newer than the after param or cursor, as soon
+         as there's any. Waits up to max.poll_timeout seconds for new ones to arrive,
+         and returns an empty page if none did. When max.poll_limit requests are already
+         waiting, it doesn't wait.
+    """
+    notifier = getattr(request.registry, 'max_notifier', None)
+    if notifier is None:
+        return HTTPNotImplemented()
+
+    actor = request.actor
+    search_params = searchParams(request)
+    if 'after' not in search_params:
+        raise InvalidSearchParams, 'after or a cursor to newer activities is required'
+
+    mmdb = MADMaxDB(context.db, identity_map=context.identity_map)
+    followed_ids = actor.getFollowedIds()
+    query = buildTimelineQuery(actor, followed_ids)
+
+    # Subscribe before looking for activities, so none is missed between both
+    waiter = notifier.subscribe(getTimelineKeys(actor, followed_ids))
+    if waiter is None:
+        activities = mmdb.activity.search(query, sort="_id", flatten=1, **search_params)
+    else:
+        try:
+            activities = mmdb.activity.search(query, sort="_id", flatten=1, **search_params)
+            if not activities and waiter.wait(getPollTimeout(getMAXSettings(request))):
+                activities = mmdb.activity.search(query, sort="_id", flatten=1, **search_params)
+        finally:
+            notifier.unsubscribe(waiter)
+
+    # Without new activities, the client keeps polling from the same point
+    extension = buildCursors(activities, search_params['limit']) or {'prev': request.params.get('cursor') or encodeCursor('after', search_params['after'])}
+    handler = JSONResourceRoot(activities, extension=extension)
     return handler.buildResponse()
@@ -3,21 +3,46 @@ import json
 from bson import json_util
 from datetime import datetime
 from rfc3339 import rfc3339
-from max.exceptions import InvalidSearchParams, Unauthorized
+from max.exceptions import InvalidSearchParams, Unauthorized, ValidationError
+from max.resources import getMAXSettings
 
 from bson.objectid import ObjectId
 from max.MADMax import MADMaxCollection
+from hashlib import sha1
 
 import requests
 import logging
+import base64
 import urllib2
 import re
 
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 100
+SHORTENER_TIMEOUT = 10
+
+# Named sets of activity fields that can be requested with the fields param
+FIELD_PROFILES = {
+    'summary': ['actor.username', 'actor.displayName', 'actor.objectType', 'actor.url',
+                'verb', 'published', 'object.objectType', 'object.content',
+                'contexts.url', 'contexts.displayName', 'replies.totalItems'],
+}
+FIELD_NAME_REGEX = re.compile(r'^[A-Za-z_]\w*(\.[A-Za-z_]\w*)*$')
+
 UNICODE_ACCEPTED_CHARS = u'áéíóúàèìòùïöüçñ'
 
 FIND_URL_REGEX = r'((https?\:\/\/)|(www\.))(\S+)(\w{2,4})(:[0-9]+)?(\/|\/([\w#!:.?+=&%@!\-\/]))?'
 FIND_HASHTAGS_REGEX = r'(\s|^)#{1}([\w\-\_\.%s]+)' % UNICODE_ACCEPTED_CHARS
 FIND_KEYWORDS_REGEX = r'(\s|^)[#\'\"]?([\w\-\_\.%s]{3,})[\"\']?' % UNICODE_ACCEPTED_CHARS
+KEYWORD_MIN_LENGTH = 3
+
+# Precompiled patterns of the single pass tokenizer. Urls have no whitespaces in them, and hashtags
+# and keywords must be preceded by a whitespace, so text is processed as whitespace separated tokens
+TOKEN_REGEX = re.compile(r'\S+')
+TOKEN_HASHTAG_REGEX = re.compile(r'#([\w\-\_\.%s]+)' % UNICODE_ACCEPTED_CHARS)
+TOKEN_KEYWORD_REGEX = re.compile(r'[#\'\"]?([\w\-\_\.%s]{%d,})' % (UNICODE_ACCEPTED_CHARS, KEYWORD_MIN_LENGTH))
+URL_REGEX = re.compile(FIND_URL_REGEX)
+TOKEN_ENTITIES_CACHE = {}
+TOKEN_ENTITIES_CACHE_SIZE = 10000
 
 
 def downloadTwitterUserImage(twitterUsername, filename):
@@ -89,18 +114,32 @@ def isBasic(request):
         return False
 
 
-def searchParams(request):
+def searchParams(request, contexts=None):
     """
         Extracts valid search params from the request, or sets default values if not found
         Returns a dict with all the results
         Raises InvalidSearchParams on bad param values
+
+        contexts are the urls of the contexts searched, if known, used to narrow
+        hashtag and keyword searches on the term index
     """
     params = {}
-    limit = request.params.get('limit', 10)
+    limit = request.params.get('limit', DEFAULT_PAGE_SIZE)
     try:
         params['limit'] = int(limit)
     except:
         raise InvalidSearchParams, 'limit must be a positive integer'
+    if params['limit'] < 1:
+        raise InvalidSearchParams, 'limit must be a positive integer'
+
+    # Never return more items than the server allows in a single page
+    max_page_size = int(getMAXSettings(request).get('max_max_page_size', MAX_PAGE_SIZE))
+    params['limit'] = min(params['limit'], max_page_size)
+
+    cursor = request.params.get('cursor')
+    if cursor:
+        direction, offset = decodeCursor(cursor)
+        params[direction] = offset
 
     after = request.params.get('after')
     if after:
@@ -117,7 +156,7 @@ def searchParams(request):
             raise InvalidSearchParams, 'before must be a valid ObjectId BSON identifier'
 
     if 'before' in params and 'after' in params:
-        raise InvalidSearchParams, 'only one offset filter is allowe, after or before'
+        raise InvalidSearchParams, 'only one offset filter is allowe, after or before (cursor included)'
 
     hashtags = request.params.getall('hashtag')
     if hashtags:
@@ -132,9 +171,99 @@ def searchParams(request):
         ### XXX Split or regex?
         params['keywords'] = [keyw.lower() for keyw in keywords]
 
+    # Resolve hashtags and keywords to the activities containing them using the term index
+    if 'hashtag' in params or 'keywords' in params:
+        # Imported here, as max.terms depends on this module
+        from max.terms import isTermIndexEnabled, isTermArraysStripEnabled, searchTermIndex, getMaxCandidates
+        settings = getMAXSettings(request)
+        if isTermIndexEnabled(settings):
+            ids = searchTermIndex(request.context.db, params.get('hashtag', []), params.get('keywords', []),
+                                  contexts=contexts,
+                                  max_candidates=getMaxCandidates(settings),
+                                  truncate=isTermArraysStripEnabled(settings))
+            # Too many candidates, search the hashtag and keyword arrays instead
+            if ids is not None:
+                params.pop('hashtag', None)
+                params.pop('keywords', None)
+                params['ids'] = ids
+
     return params
 
 
+def buildETag(*parts):
+    """
+        Returns an entity tag for a representation that depends on parts,
+        any json serializable values (ObjectIds and dates included)
+    """
+    return sha1(json.dumps(parts, sort_keys=True, default=unicode)).hexdigest()
+
+
+def isNotModified(request, etag):
+    """
+        Returns True if the client already has the representation identified by etag,
+        as stated in the If-None-Match header of the request
+    """
+    return etag in request.if_none_match
+
+
+def fieldsParam(request):
+    """
+        Returns the list of fields requested in the fields param, either as a comma separated
+        list of field names (dotted for subfields) or as the name of one of the FIELD_PROFILES.
+        Field names are the ones in the output, so "id" stands for "_id", that is always returned.
+        Returns None if no fields were requested.
+        Raises InvalidSearchParams on bad field names
+    """
+    fields = request.params.get('fields')
+    if not fields:
+        return None
+    if fields in FIELD_PROFILES:
+        return FIELD_PROFILES[fields]
+
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    if not names or [name for name in names if not FIELD_NAME_REGEX.match(name)]:
+        raise InvalidSearchParams, 'fields must be a comma separated list of field names, or one of: %s' % ', '.join(sorted(FIELD_PROFILES))
+    names = ['.'.join([part == 'id' and '_id' or part for part in name.split('.')]) for name in names]
+    return [name for name in names if name != '_id'] or ['_id']
+
+
+def encodeCursor(direction, offset):
+    """
+        Builds an opaque cursor pointing to the items after or before offset
+    """
+    return base64.urlsafe_b64encode('%s:%s' % (direction, offset)).rstrip('=')
+
+
+def decodeCursor(cursor):
+    """
+        Returns the (direction, offset) pair encoded in an opaque cursor
+        Raises InvalidSearchParams on bad cursors
+    """
+    try:
+        padded = str(cursor) + '=' * (-len(cursor) % 4)
+        direction, offset = base64.urlsafe_b64decode(padded).split(':')
+        if direction not in ['after', 'before']:
+            raise ValueError
+        return direction, ObjectId(offset)
+    except:
+        raise InvalidSearchParams, 'cursor is not valid'
+
+
+def buildCursors(items, limit, ascending=False):
+    """
+        Returns a dict with the cursors to the pages next and previous to a page of
+        flattened items, sorted by id. There's a next cursor only when the page is full,
+        as a smaller one must be the last.
+    """
+    cursors = {}
+    if items:
+        first, last = items[0]['id'], items[-1]['id']
+        if len(items) >= limit:
+            cursors['next'] = encodeCursor(ascending and 'after' or 'before', last)
+        cursors['prev'] = encodeCursor(ascending and 'before' or 'after', first)
+    return cursors
+
+
 class RUDict(dict):
 
     def __init__(self, *args, **kw):
@@ -165,78 +294,158 @@ class RUDict(dict):
             self[key] = other_dict[key]
 
 
-def decodeBSONEntity(di, key):
+# Values that are already json serializable, and are left untouched
+JSON_SCALAR_TYPES = (basestring, bool, int, long, float, type(None))
+
+
+def decodeBSONValue(value):
     """
         Inspired by pymongo bson.json_util.default, but specially processing some value types:
 
         ObjectId --> hexvalue
         datetime --> rfc3339
 
-        Also, while json_util.default creates a new dict in the form {$name: decodedvalue} we assign
+        Also, while json_util.default creates a new dict in the form {$name: decodedvalue} we return
         the decoded value, 'flattening' the value directly in the field.
 
         Fallback to other values using json_util.default, and flattening only those decoded entities
-        that has only one key.
+        that has only one key. Values that json_util doesn't know about are returned untouched.
     """
-    value = di[key]
+    if isinstance(value, JSON_SCALAR_TYPES):
+        return value
     if isinstance(value, ObjectId):
-        di[key] = str(value)
-        return
+        return str(value)
     if isinstance(value, datetime):
-        di[key] = rfc3339(value, utc=True, use_system_timezone=False)
-        return
+        return rfc3339(value, utc=True, use_system_timezone=False)
     try:
-        decoded = json_util.default(di[key])
-        if len(decoded.keys()) == 1:
-            di[key] = decoded[decoded.keys()[0]]
+        decoded = json_util.default(value)
+    except TypeError:
+        return value
+    if len(decoded.keys()) == 1:
+        return decoded.values()[0]
+    return decoded
+
+
+def flattenedDict(di):
+    """
+        Returns a flattened copy of a dict. Keys of the decoded values loose its
+        leading underscores, prevailing over an existing key with the same name.
+        As MADDict objects only hold fields in its schema, renamed keys not in the
+        schema are discarded.
+    """
+    schema = getattr(di, 'schema', None)
+    result = {}
+    renamed = []
+    for key, value in di.iteritems():
+        if isinstance(value, (dict, list)):
+            result[key] = flattened(value)
+        elif key.startswith('_'):
+            new_key = key.lstrip('_')
+            if schema is None or new_key in schema:
+                renamed.append((new_key, decodeBSONValue(value)))
         else:
-            di[key] = decoded
-    except:
-        pass
+            result[key] = decodeBSONValue(value)
+    result.update(renamed)
+    return result
 
 
-def deUnderescore(di, key):
+def flattened(data):
     """
-        Renames a dict key, removing underscores from the begginning of the key
+        Returns a json serializable copy of a dict or list, in a single pass and
+        without modifying the original. Values directly inside lists are not decoded.
     """
-    if key.startswith('_'):
-        di[key.lstrip('_')] = di[key]
-        del di[key]
+    if isinstance(data, dict):
+        return flattenedDict(data)
+    if isinstance(data, list):
+        return [flattened(item) for item in data]
+    return data
 
 
-def flattendict(di):
+def tokenEntities(token):
     """
-        Flattens key/values of a dict and continues the recursion
+        Returns the entities found in a whitespace separated token, as (type, value, start, end)
+        tuples, with the positions relative to the token. Results are memoized in
+        TOKEN_ENTITIES_CACHE, as most tokens are common words.
     """
-    for key in di.keys():
-        value = di[key]
-        if isinstance(value, dict) or isinstance(value, list):
-            flatten(value)
-        else:
-            decodeBSONEntity(di, key)
-            deUnderescore(di, key)
+    entities = []
+    lowered = token.lower()
+    if 'http' in lowered or 'www.' in lowered:
+        for match in URL_REGEX.finditer(token):
+            entities.append(('url', match.group(0), match.start(), match.end()))
+        # Keywords are searched once the urls are removed
+        lowered = URL_REGEX.sub('', lowered)
+
+    match = TOKEN_HASHTAG_REGEX.match(token)
+    if match:
+        entities.append(('hashtag', match.group(1).lower(), match.start(), match.end()))
+
+    match = TOKEN_KEYWORD_REGEX.match(lowered)
+    if match and len(lowered) == len(token):
+        entities.append(('keyword', match.group(1), match.start(1), match.end(1)))
+    elif match:
+        # Positions are not meaningful in a token with urls removed
+        entities.append(('keyword', match.group(1), None, None))
 
+    if len(TOKEN_ENTITIES_CACHE) >= TOKEN_ENTITIES_CACHE_SIZE:
+        TOKEN_ENTITIES_CACHE.clear()
+    TOKEN_ENTITIES_CACHE[token] = entities
+    return entities
 
-def flatten(data):
+
+def extractEntities(text):
     """
-        Recursively flatten a dict or list
+        Returns the list of entities found in text, in a single pass over its whitespace
+        separated tokens. Each entity is a (type, value, start, end) tuple, where type is
+        url, hashtag or keyword, and start and end its position in text (None for keywords
+        found in tokens with urls in them)
+
+        Urls are returned as found. Hashtags (without the hash) and keywords are returned
+        in lowercase. Keywords are all words (including hashtags) of at least
+        KEYWORD_MIN_LENGTH characters, that are not part of an url.
     """
-    if isinstance(data, list):
-        for item in data:
-            flatten(item)
-    if isinstance(data, dict):
-        flattendict(data)
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8')
 
+    entities = []
+    # Local names, as this loop runs for every word of every post
+    append = entities.append
+    cached = TOKEN_ENTITIES_CACHE.get
+    for match in TOKEN_REGEX.finditer(text):
+        token_entities = cached(match.group())
+        if token_entities is None:
+            token_entities = tokenEntities(match.group())
+        if token_entities:
+            offset = match.start()
+            for entity_type, value, start, end in token_entities:
+                if start is None:
+                    append((entity_type, value, None, None))
+                else:
+                    append((entity_type, value, offset + start, offset + end))
+    return entities
 
-def formatMessageEntities(text):
+
+def getEntityValues(entities, entity_type):
+    """
+        Returns the values of the entities of a type
+    """
+    return [entity[1] for entity in entities if entity[0] == entity_type]
+
+
+def formatMessageEntities(text, cache=None):
     """
         function that shearches for elements in the text that have to be formatted.
-        Currently shortens urls.
+        Currently shortens urls, looking them up first in cache, if any.
     """
     def shorten(matchobj):
-        return shortenURL(matchobj.group(0))
+        url = matchobj.group(0)
+        short = cache is not None and cache.get(url) or None
+        if short is None:
+            short = shortenURL(url)
+            if cache is not None and short != url:
+                cache.set(url, short)
+        return short
 
-    shortened = re.sub(FIND_URL_REGEX, shorten, text)
+    shortened = URL_REGEX.sub(shorten, text)
 
     return shortened
 
@@ -251,9 +460,7 @@ def findHashtags(text):
         teststring = "#first # Hello i'm a #text with #hashtags but#some are not valid#  # ##double #last"
         should return ['first', 'text', 'hashtags', 'last']
     """
-    hashtags = [a.groups()[1] for a in re.finditer(FIND_HASHTAGS_REGEX, text)]
-    lowercase = [hasht.lower() for hasht in hashtags]
-    return lowercase
+    return getEntityValues(extractEntities(text), 'hashtag')
 
 
 def findKeywords(text):
@@ -262,13 +469,17 @@ def findKeywords(text):
         excluding urls and words shorter than the defined in KEYWORD_MIN_LENGTH.
         Keywords are stored in lowercase.
     """
-    _text = text.lower().decode('utf-8')
-    stripped_urls = re.sub(FIND_URL_REGEX, '', _text)
-    keywords = [kw.groups()[1] for kw in re.finditer(FIND_KEYWORDS_REGEX, stripped_urls)]
-    return keywords
+    return getEntityValues(extractEntities(text), 'keyword')
+
+
+def hasURLs(text):
+    """
+        Returns True if there's any url in text
+    """
+    return URL_REGEX.search(text) is not None
 
 
-def shortenURL(url):
+def shortenURL(url, timeout=SHORTENER_TIMEOUT):
     """
         Shortens a url using bitly API. Keeps the original url in case
         something goes wrong with the api call
@@ -291,9 +502,8 @@ def shortenURL(url):
 
     queryurl = '%(api_url)s/%(version)s/%(endpoint)s?%(login)s&%(endpoint_params)s' % params
 
-    req = requests.get(queryurl)
-
     try:
+        req = requests.get(queryurl, timeout=timeout)
         response = json.loads(req.content)
         if response.get('status_code', None) == 200:
             if 'data' in response.keys():
@@ -313,6 +523,29 @@ def extractPostData(request):
     # TODO: Do more syntax and format checks of sent data
 
 
+def iterBulkPostData(request):
+    """
+        Yields the objects posted in the request body, either as a json array or as newline
+        delimited json (application/x-ndjson content type). ndjson bodies are read line by
+        line as the objects are consumed, so they are never held in memory at once. Lines
+        that are not valid json are yielded as None, so they can be reported one by one
+    """
+    if request.content_type == 'application/x-ndjson':
+        for line in request.body_file:
+            if line.strip():
+                try:
+                    yield json.loads(line, object_hook=json_util.object_hook)
+                except ValueError:
+                    yield None
+        return
+
+    json_data = extractPostData(request)
+    if not isinstance(json_data, list):
+        raise ValidationError, 'Expected a list of objects'
+    for item in json_data:
+        yield item
+
+
 def canWriteInContexts(actor, urls):
     """
     """
@@ -0,0 +1,33 @@
+"""
+    Version of the data used to route tweets
+
+    The maxrules workers keep in memory which contexts and users have twitter fields,
+    and reload them when this version changes. Every insert, modification or deletion
+    of a context or user with twitter fields bumps it.
+"""
+
+ROUTING_COLLECTION = 'routing'
+TWITTER_ROUTING = 'twitter'
+TWITTER_ROUTING_FIELDS = ['twitterUsername', 'twitterUsernameId', 'twitterHashtag']
+
+
+def hasTwitterRoutingFields(item):
+    """
+        Returns True if item sets or unsets any of the fields used to route tweets
+    """
+    return len([field for field in TWITTER_ROUTING_FIELDS if field in item]) > 0
+
+
+def touchTwitterRouting(db):
+    """
+        Bumps the twitter routing version, so the workers reload their routing tables
+    """
+    db[ROUTING_COLLECTION].update({'_id': TWITTER_ROUTING}, {'$inc': {'version': 1}}, upsert=True)
+
+
+def getTwitterRoutingVersion(db):
+    """
+        Returns the current twitter routing version
+    """
+    routing = db[ROUTING_COLLECTION].find_one({'_id': TWITTER_ROUTING})
+    return routing and routing.get('version', 0) or 0
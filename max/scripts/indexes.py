@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import sys
+import optparse
+from max.mongodb import getConnection
+
+import logging
+
+from max.indexes import checkIndexes, ensureIndexes
+
+
+def main(argv=sys.argv, quiet=False):
+    command = MaxIndexesManager(argv, quiet)
+    return command.run()
+
+
+class MaxIndexesManager(object):
+    verbosity = 1  # required
+    description = "Reports and creates the indexes declared on the MAX models."
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage, description=description)
+    parser.add_option('-d', '--mongodb-url',
+                      dest='mongodb_url',
+                      type='string',
+                      action='append',
+                      help=('MongoDB url'))
+    parser.add_option('-n', '--mongodb-name',
+                      dest='mongodb_db_name',
+                      type='string',
+                      action='append',
+                      help=('MongoDB database name'))
+    parser.add_option('-r', '--report',
+                      dest='report',
+                      action='store_true',
+                      default=False,
+                      help=('Only report missing, undeclared and unused indexes'))
+    parser.add_option('--dry-run',
+                      dest='dry_run',
+                      action='store_true',
+                      default=False,
+                      help=('Show the indexes that would be created, without creating them'))
+
+    def __init__(self, argv, quiet=False):
+        self.quiet = quiet
+        self.options, self.args = self.parser.parse_args(argv[1:])
+
+    def log(self, message):
+        if not self.quiet:
+            print message
+
+    def run(self):
+        if not self.options.mongodb_url or not self.options.mongodb_db_name:
+            logging.error('You must provide a valid mongodb url and database name.')
+            return 2
+
+        conn = getConnection(self.options.mongodb_url[0])
+        db = conn[self.options.mongodb_db_name[0]]
+
+        if self.options.report:
+            report = checkIndexes(db)
+            for collection_name in sorted(report.keys()):
+                for status in ['missing', 'undeclared', 'unused']:
+                    for index_name in report[collection_name][status]:
+                        self.log('%s: %s index %s' % (collection_name, status, index_name))
+            return 0
+
+        created = ensureIndexes(db, dry_run=self.options.dry_run)
+        action = self.options.dry_run and 'Would create' or 'Created'
+        for collection_name, index_name in created:
+            self.log('%s index %s on %s' % (action, index_name, collection_name))
+        self.log('%s %d indexes' % (action, len(created)))
+        return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
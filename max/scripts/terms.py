@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+import sys
+import optparse
+from max.mongodb import getConnection
+
+import logging
+
+from max.terms import rebuildTermIndex
+
+
+def main(argv=sys.argv, quiet=False):
+    command = MaxTermIndexRebuilder(argv, quiet)
+    return command.run()
+
+
+class MaxTermIndexRebuilder(object):
+    verbosity = 1  # required
+    description = "Rebuilds the hashtag and keyword index of all activities."
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage, description=description)
+    parser.add_option('-d', '--mongodb-url',
+                      dest='mongodb_url',
+                      type='string',
+                      action='append',
+                      help=('MongoDB url'))
+    parser.add_option('-n', '--mongodb-name',
+                      dest='mongodb_db_name',
+                      type='string',
+                      action='append',
+                      help=('MongoDB database name'))
+
+    def __init__(self, argv, quiet=False):
+        self.quiet = quiet
+        self.options, self.args = self.parser.parse_args(argv[1:])
+
+    def run(self):
+        if not self.options.mongodb_url or not self.options.mongodb_db_name:
+            logging.error('You must provide a valid mongodb url and database name.')
+            return 2
+
+        conn = getConnection(self.options.mongodb_url[0])
+        db = conn[self.options.mongodb_db_name[0]]
+
+        indexed = rebuildTermIndex(db)
+        if not self.quiet:
+            print "Indexed %d activities" % indexed
+        return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import sys
+import optparse
+from max.mongodb import getConnection
+
+import logging
+
+from max.timelines import rebuildTimelines
+import max.models  # Needed by MADMaxCollection to wrap the users
+
+
+def main(argv=sys.argv, quiet=False):
+    command = MaxTimelinesRebuilder(argv, quiet)
+    return command.run()
+
+
+class MaxTimelinesRebuilder(object):
+    verbosity = 1  # required
+    description = "Backfills or rebuilds the materialized user timelines."
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage, description=description)
+    parser.add_option('-d', '--mongodb-url',
+                      dest='mongodb_url',
+                      type='string',
+                      action='append',
+                      help=('MongoDB url'))
+    parser.add_option('-n', '--mongodb-name',
+                      dest='mongodb_db_name',
+                      type='string',
+                      action='append',
+                      help=('MongoDB database name'))
+    parser.add_option('-u', '--username',
+                      dest='usernames',
+                      type='string',
+                      action='append',
+                      help=('Rebuild only the timeline of this user, can be repeated'))
+
+    def __init__(self, argv, quiet=False):
+        self.quiet = quiet
+        self.options, self.args = self.parser.parse_args(argv[1:])
+
+    def run(self):
+        if not self.options.mongodb_url or not self.options.mongodb_db_name:
+            logging.error('You must provide a valid mongodb url and database name.')
+            return 2
+
+        conn = getConnection(self.options.mongodb_url[0])
+        db = conn[self.options.mongodb_db_name[0]]
+
+        rebuilt = rebuildTimelines(db, usernames=self.options.usernames or [])
+        if not self.quiet:
+            print "Rebuilt %d timelines" % rebuilt
+        return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
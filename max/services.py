@@ -0,0 +1,193 @@
+"""
+    Creation of activities, shared by the REST views and the maxrules workers
+
+    Creating an activity is more than inserting it: its terms are indexed, the urls
+    in its content shortened, it's fanned out to the timelines if enabled, and the
+    clients waiting for it are notified. The functions here do all of it given the
+    registry of a MAX application and a database, so they don't need a request and
+    can be called in-process by the workers.
+"""
+
+from max.models import Activity, User, Context
+from max.timelines import isTimelineFanOutEnabled, fanOutActivities
+from max.terms import prepareActivityTerms, indexActivitiesTerms
+from max.shortener import shortenActivityURLs
+from max.notifications import publishActivities
+from max.mongodb import getWriteConcern
+from max.exceptions import MissingField, ObjectNotSupported, UnknownUserError, Unauthorized, ValidationError, DuplicatedItemError
+
+from pymongo.errors import OperationFailure
+import logging
+
+# Errors that prevent the creation of a single activity of a batch, not the whole batch
+ACTIVITY_ERRORS = (MissingField, ObjectNotSupported, UnknownUserError, Unauthorized, ValidationError, DuplicatedItemError)
+
+logger = logging.getLogger('max')
+
+
+def processNewActivities(registry, db, activities):
+    """
+        Runs the steps that follow the insertion of new activities, given as a list
+        of (activity, terms) pairs, terms as returned by prepareActivityTerms
+    """
+    indexActivitiesTerms(db, [(activity, terms) for activity, terms in activities if terms is not None])
+    for activity, terms in activities:
+        shortenActivityURLs(registry, db, activity)
+    if isTimelineFanOutEnabled(registry.max_settings):
+        fanOutActivities(db, [activity for activity, terms in activities])
+    publishActivities(registry, db, [activity for activity, terms in activities])
+
+
+def insertActivity(registry, db, activity):
+    """
+        Inserts a validated activity and processes it. Activities are never looked up
+        before inserting: if the activity carries an idempotency key already used, it's
+        populated with the existing one and marked as duplicated, and nothing is done.
+    """
+    terms = prepareActivityTerms(registry.max_settings, activity)
+    activity['_id'] = activity.insert()
+    if not activity.duplicated:
+        processNewActivities(registry, db, [(activity, terms)])
+    return activity
+
+
+def findDuplicatedActivities(db, activities):
+    """
+        Finds the activities of a batch that were not inserted because its idempotency key
+        was already used. Returns a dict keyed by the _id of the rejected activities, with
+        the _id of the activity inserted before by the same actor with the same key, or None
+        if the key was used by another actor.
+    """
+    keyed = [activity for activity in activities if activity.get('idempotencyKey')]
+    existing = {}
+    query = {'idempotencyKey': {'$in': [activity['idempotencyKey'] for activity in keyed]}}
+    for activity in db.activity.find(query, {'actor._id': 1, 'idempotencyKey': 1}):
+        existing[(activity['actor']['_id'], activity['idempotencyKey'])] = activity['_id']
+
+    duplicates = {}
+    for activity in keyed:
+        existing_id = existing.get((activity['actor']['_id'], activity['idempotencyKey']))
+        if existing_id != activity['_id']:
+            duplicates[activity['_id']] = existing_id
+    return duplicates
+
+
+def insertActivities(registry, db, activities):
+    """
+        Inserts many validated activities at once, given as (activity, terms) pairs, and
+        processes the inserted ones. Returns the errors of the activities not inserted,
+        keyed by its position. Activities whose idempotency key was already used by the
+        same actor are marked as duplicated instead, with the _id of the existing one.
+        Any other write error is returned for the activities it prevented to insert.
+    """
+    errors = {}
+    if not activities:
+        return errors
+
+    # Ids are assigned to the documents before sending them, so the ones
+    # not inserted can be found afterwards
+    inserted = list(activities)
+    try:
+        db.activity.insert([activity for activity, terms in activities], continue_on_error=True,
+                           **getWriteConcern(registry, 'bulk'))
+    except OperationFailure, error:
+        # Only the last error of the batch is raised, so look for the ones written
+        ids = [activity['_id'] for activity, terms in activities]
+        written = set([found['_id'] for found in db.activity.find({'_id': {'$in': ids}}, {'_id': 1})])
+        inserted = [(activity, terms) for activity, terms in activities if activity['_id'] in written]
+        duplicates = findDuplicatedActivities(db, [activity for activity, terms in activities if activity['_id'] not in written])
+        for position, (activity, terms) in enumerate(activities):
+            if activity['_id'] in written:
+                continue
+            if activity['_id'] not in duplicates:
+                logger.error('Activity not inserted in a bulk write: %s' % error)
+                errors[position] = error
+            elif duplicates[activity['_id']] is None:
+                errors[position] = DuplicatedItemError('Idempotency key "%s" already used' % activity['idempotencyKey'])
+            else:
+                activity['_id'] = duplicates[activity['_id']]
+                activity.duplicated = True
+
+    for activity, terms in activities:
+        activity['_id'] = str(activity['_id'])
+    processNewActivities(registry, db, inserted)
+    return errors
+
+
+def prepareActor(actor):
+    """
+        Sets the defaults of a User or Context acting as the actor of new activities
+    """
+    if isinstance(actor, User):
+        actor.setdefault('displayName', actor['username'])
+    if isinstance(actor, Context):
+        actor.setdefault('displayName', actor['url'])
+    return actor
+
+
+def validateActivityData(data):
+    """
+        Checks the shape of the posted data that building an activity takes for granted,
+        raising ValidationError instead of failing later with an unexpected error
+    """
+    if not isinstance(data, dict):
+        raise ValidationError, 'Activity is not a valid json object'
+    obj = data.get('object')
+    if obj is not None:
+        if not isinstance(obj, dict):
+            raise ValidationError, 'The activity object is not a valid json object'
+        if not isinstance(obj.get('objectType'), basestring):
+            raise ValidationError, 'The activity object has no objectType'
+    contexts = data.get('contexts')
+    if contexts is not None:
+        if not isinstance(contexts, list) or [url for url in contexts if not isinstance(url, basestring)]:
+            raise ValidationError, 'The activity contexts are not a list of urls'
+
+
+def addActivity(registry, db, actor, data, identity_map=None):
+    """
+        Creates a new activity posted by actor, a User or Context loaded from db, with
+        the same validations and permission checks of the admin activities endpoints.
+        Raises the same errors, and returns the activity, marked as duplicated if so.
+    """
+    validateActivityData(data)
+    newactivity = Activity()
+    newactivity.fromData(data, prepareActor(actor), db, identity_map=identity_map,
+                         rest_params={'actor': actor, 'verb': 'post'})
+    return insertActivity(registry, db, newactivity)
+
+
+def addActivities(registry, db, postings, identity_map=None):
+    """
+        Creates many activities at once, given as (actor, data) pairs, validated one by
+        one as addActivity does and inserted in a single operation. Returns, in the same
+        order, the new activity, marked as duplicated if so, or the error that prevented
+        its creation. Unexpected errors validating an item are logged and returned too,
+        so they don't prevent the creation of the rest.
+    """
+    settings = registry.max_settings
+    results = []
+    valid = []
+    for actor, data in postings:
+        try:
+            validateActivityData(data)
+            newactivity = Activity()
+            newactivity.fromData(data, prepareActor(actor), db, identity_map=identity_map,
+                                 rest_params={'actor': actor, 'verb': 'post'})
+        except ACTIVITY_ERRORS, error:
+            results.append(error)
+            continue
+        except Exception, error:
+            logger.exception('Unexpected error validating an activity of a batch')
+            results.append(error)
+            continue
+        results.append(newactivity)
+        valid.append((len(results) - 1, newactivity))
+
+    errors = insertActivities(registry, db, [(newactivity, prepareActivityTerms(settings, newactivity)) for position, newactivity in valid])
+    for index, (position, newactivity) in enumerate(valid):
+        if index in errors:
+            results[position] = errors[index]
+    if identity_map is not None:
+        identity_map.invalidate('activity')
+    return results
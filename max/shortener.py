@@ -0,0 +1,146 @@
+"""
+    URL shortening of the activities content
+
+    Activities and comments are stored with its original content, and the urls in it
+    are shortened afterwards, as configured by the ``max.shorten_urls`` setting:
+
+        async: In a pool of background threads (``max.shortener_workers``), so
+               the request doesn't wait for the shortening service (default)
+        sync: Before answering the request that created the activity
+        off: Urls are never shortened
+
+    Once shortened, the content of the activity, and of the embedded reply if the
+    activity is a comment, is patched in the database, increasing the version of the
+    patched activities so their entity tags change. Shortened urls are remembered
+    in the "shorturls" collection, so the same url is never shortened twice.
+"""
+
+from hashlib import sha1
+from Queue import Queue
+import threading
+import logging
+
+from bson.objectid import ObjectId
+from max.rest.utils import formatMessageEntities, hasURLs
+
+SHORTURLS_COLLECTION = 'shorturls'
+DEFAULT_SHORTENING_MODE = 'async'
+DEFAULT_WORKERS = 2
+
+logger = logging.getLogger('max')
+
+
+def getShorteningMode(settings):
+    """
+        Returns when urls are shortened: sync, async or off
+    """
+    return settings.get('max_shorten_urls', DEFAULT_SHORTENING_MODE)
+
+
+class ShortURLCache(object):
+    """
+        Persistent store of the urls already shortened, keyed by the hash of the long url
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def getKey(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return sha1(url).hexdigest()
+
+    def get(self, url):
+        """
+            Returns the short version of url, or None if it was never shortened
+        """
+        entry = self.collection.find_one({'_id': self.getKey(url)})
+        return entry and entry['short'] or None
+
+    def set(self, url, short):
+        """
+            Remembers the short version of url
+        """
+        self.collection.save({'_id': self.getKey(url), 'url': url, 'short': short})
+
+
+def shortenActivityContent(db, activity_id, content, reply_to=None):
+    """
+        Shortens the urls of an activity content, and patches it in the database if
+        still unmodified. If the activity is a comment, the content of the reply
+        embedded in the commented activity (reply_to) is patched too.
+        Returns the content with the urls shortened
+    """
+    shortened = formatMessageEntities(content, cache=ShortURLCache(db[SHORTURLS_COLLECTION]))
+    if shortened != content:
+        activity_id = ObjectId(activity_id)
+        db.activity.update({'_id': activity_id, 'object.content': content},
+                           {'$set': {'object.content': shortened}, '$inc': {'version': 1}})
+        if reply_to is not None:
+            db.activity.update({'_id': ObjectId(reply_to), 'replies.items.id': str(activity_id)},
+                               {'$set': {'replies.items.$.content': shortened}})
+            # The comments listing of the activity changes even if the reply is not embedded
+            db.activity.update({'_id': ObjectId(reply_to)}, {'$inc': {'version': 1}})
+    return shortened
+
+
+class URLShortenerPool(object):
+    """
+        Pool of background threads shortening the urls of activities
+    """
+
+    def __init__(self, db, workers=DEFAULT_WORKERS):
+        self.db = db
+        self.queue = Queue()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.work, name='max-url-shortener-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def schedule(self, activity_id, content, reply_to=None):
+        """
+            Queues the shortening of an activity content
+        """
+        self.queue.put((activity_id, content, reply_to))
+
+    def work(self):
+        """
+            Shortens queued activities forever
+        """
+        while True:
+            activity_id, content, reply_to = self.queue.get()
+            try:
+                shortenActivityContent(self.db, activity_id, content, reply_to=reply_to)
+            except Exception:
+                logger.exception('Error shortening urls of activity %s' % activity_id)
+            finally:
+                self.queue.task_done()
+
+    @classmethod
+    def fromSettings(cls, settings, db):
+        """
+            Returns a pool sized by max.shortener_workers if shortening is async, None otherwise
+        """
+        if getShorteningMode(settings) != 'async':
+            return None
+        return cls(db, workers=int(settings.get('max_shortener_workers', DEFAULT_WORKERS)))
+
+
+def shortenActivityURLs(registry, db, activity, reply_to=None):
+    """
+        Shortens the urls of a newly inserted activity, as configured by max.shorten_urls.
+        When done synchronously, the activity object is updated too.
+    """
+    settings = registry.max_settings
+    content = activity['object'].get('content', u'')
+    mode = getShorteningMode(settings)
+    if mode == 'off' or not hasURLs(content):
+        return
+
+    pool = getattr(registry, 'max_shortener', None)
+    if mode == 'async' and pool is not None:
+        pool.schedule(activity['_id'], content, reply_to=reply_to)
+    else:
+        activity['object']['content'] = shortenActivityContent(db, activity['_id'], content, reply_to=reply_to)
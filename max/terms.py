@@ -0,0 +1,202 @@
+"""
+    Inverted index of activity hashtags and keywords
+
+    When enabled with the ``max.term_index`` setting, every inserted activity and
+    every comment added to an activity stores its terms in the "terms" collection,
+    one document per term, context and activity:
+
+        {'term': <hashtag or keyword>, 'context': <context url or None>, 'activity': <activity _id>}
+
+    Hashtags are stored with its leading hash (#max), to tell them apart from keywords.
+    Hashtag and keyword searches intersect the posting lists of each term, restricted to
+    the contexts searched if known, instead of matching the object._hashtags and
+    object._keywords arrays of the activities.
+
+    Candidates are passed to the activity search as a list of _id's, so searches of terms
+    with more than ``max.term_index_max_candidates`` postings (10000) fall back to the
+    arrays. If the arrays are stripped, only the newest postings are searched instead.
+
+    As those arrays are not needed for searching anymore, they can be dropped from the
+    stored activities with the ``max.strip_term_arrays`` setting.
+"""
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
+from pyramid.settings import asbool
+from bson.objectid import ObjectId
+from max.rest.utils import extractEntities, getEntityValues
+
+TERMS_COLLECTION = 'terms'
+DEFAULT_MAX_CANDIDATES = 10000
+TERM_INDEXES = [
+                dict(keys=[('term', ASCENDING), ('context', ASCENDING), ('activity', DESCENDING)], unique=True),
+                dict(keys=[('activity', ASCENDING)]),
+               ]
+
+
+def isTermIndexEnabled(settings):
+    """
+        Returns True if hashtag and keyword searches use the term index
+    """
+    return asbool(settings.get('max_term_index', False))
+
+
+def isTermArraysStripEnabled(settings):
+    """
+        Returns True if the hashtag and keyword arrays are not stored in the activities.
+        Only possible when the term index is enabled, otherwise search would not work
+    """
+    return isTermIndexEnabled(settings) and asbool(settings.get('max_strip_term_arrays', False))
+
+
+def ensureTermIndexes(db):
+    """
+        Creates the indexes on which the posting list reads, the unique
+        term/context/activity constraint and the removal of deleted activities rely on
+    """
+    for index in TERM_INDEXES:
+        db[TERMS_COLLECTION].ensure_index(index['keys'], unique=index.get('unique', False))
+
+
+def getMaxCandidates(settings):
+    """
+        Returns the maximum number of activities a term search is resolved to
+    """
+    return int(settings.get('max_term_index_max_candidates', DEFAULT_MAX_CANDIDATES))
+
+
+def getTerms(hashtags=[], keywords=[]):
+    """
+        Returns the terms of a list of hashtags and keywords
+    """
+    return set(['#%s' % hashtag for hashtag in hashtags] + list(keywords))
+
+
+def getObjectTerms(obj):
+    """
+        Returns the terms of an activity object or comment, from its hashtag and
+        keyword arrays if present, or from its content otherwise
+    """
+    if '_hashtags' in obj or '_keywords' in obj:
+        return getTerms(obj.get('_hashtags', []), obj.get('_keywords', []))
+    entities = extractEntities(obj.get('content', u''))
+    return getTerms(getEntityValues(entities, 'hashtag'), getEntityValues(entities, 'keyword'))
+
+
+def prepareActivityTerms(settings, activity):
+    """
+        Returns the terms of an activity about to be inserted, or None if the term index is
+        disabled. The hashtag and keyword arrays are removed from the activity if configured so.
+    """
+    if not isTermIndexEnabled(settings):
+        return None
+    terms = getObjectTerms(activity['object'])
+    if isTermArraysStripEnabled(settings):
+        stripActivityTerms(activity)
+    return terms
+
+
+def stripActivityTerms(activity):
+    """
+        Removes the hashtag and keyword arrays from an activity object
+    """
+    for field in ['_hashtags', '_keywords']:
+        if field in activity['object']:
+            del activity['object'][field]
+
+
+def getTermEntries(activity, terms):
+    """
+        Returns the posting list entries of the terms of an activity, one for every
+        context of the activity
+    """
+    activity_id = ObjectId(activity['_id'])
+    contexts = [context['url'] for context in activity.get('contexts', [])] or [None]
+    return [{'term': term, 'context': context, 'activity': activity_id} for term in terms for context in contexts]
+
+
+def indexActivityTerms(db, activity, terms):
+    """
+        Adds terms to the posting lists of the activity, once for every context of the activity.
+        Terms already present are silently skipped
+    """
+    indexActivitiesTerms(db, [(activity, terms)])
+
+
+def indexActivitiesTerms(db, activities_terms):
+    """
+        Adds the terms of many activities to the posting lists in a single batch insert.
+        activities_terms is a list of (activity, terms) pairs
+    """
+    entries = [entry for activity, terms in activities_terms for entry in getTermEntries(activity, terms)]
+    if entries:
+        try:
+            db[TERMS_COLLECTION].insert(entries, continue_on_error=True)
+        except DuplicateKeyError:
+            pass
+
+
+def removeActivityTerms(db, activity_id):
+    """
+        Removes the postings of a deleted activity, so they don't take the place of
+        live activities among the candidates of a search
+    """
+    db[TERMS_COLLECTION].remove({'activity': ObjectId(activity_id)})
+
+
+def searchTermIndex(db, hashtags=[], keywords=[], contexts=None, max_candidates=DEFAULT_MAX_CANDIDATES, truncate=False):
+    """
+        Returns the _id's of the activities that contain all hashtags and keywords,
+        intersecting the posting lists of each term, only within contexts if specified.
+        Terms are processed from the less to the more frequent, and only the candidates
+        left are fetched each time.
+
+        If the less frequent term has more than max_candidates postings, returns None,
+        or if truncate, searches only among its newest max_candidates postings.
+    """
+    def postings(term):
+        query = {'term': term}
+        if contexts is not None:
+            query['context'] = {'$in': list(contexts)}
+        return query
+
+    # Counts are bounded, as any count over max_candidates is enough to know it's too many
+    counts = dict([(term, db[TERMS_COLLECTION].find(postings(term)).limit(max_candidates + 1).count(True)) for term in getTerms(hashtags, keywords)])
+    terms = sorted(counts.keys(), key=lambda term: counts[term])
+    if not terms:
+        return []
+    if counts[terms[0]] > max_candidates and not truncate:
+        return None
+
+    candidates = None
+    for term in terms:
+        query = postings(term)
+        if candidates is not None:
+            query['activity'] = {'$in': list(candidates)}
+        cursor = db[TERMS_COLLECTION].find(query, {'activity': 1})
+        if candidates is None and counts[term] > max_candidates:
+            cursor = cursor.sort('activity', DESCENDING).limit(max_candidates)
+        candidates = set([entry['activity'] for entry in cursor])
+        if not candidates:
+            return []
+    return list(candidates)
+
+
+def rebuildTermIndex(db):
+    """
+        Discards and recreates from scratch the term index of all activities.
+        The terms of the comments are read from the comment activities, as the
+        activities only embed the latest ones. Returns the number of activities indexed
+    """
+    db[TERMS_COLLECTION].drop()
+    ensureTermIndexes(db)
+    indexed = 0
+    for activity in db.activity.find({'verb': {'$ne': 'comment'}}, {'object': 1, 'contexts': 1, 'replies.totalItems': 1}):
+        terms = getObjectTerms(activity.get('object', {}))
+        if activity.get('replies', {}).get('totalItems'):
+            comments = db.activity.find({'verb': 'comment', 'object.inReplyTo._id': activity['_id']}, {'object': 1})
+            for comment in comments:
+                terms.update(getObjectTerms(comment.get('object', {})))
+        indexActivityTerms(db, activity, terms)
+        indexed += 1
+    return indexed
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import unittest
+import threading
+
+
+class TweetBatcherTests(unittest.TestCase):
+
+    def test_full_batches_are_sent_right_away(self):
+        from maxrules.batching import TweetBatcher
+        batches = []
+        batcher = TweetBatcher(batches.append, size=2, window=60)
+        batcher.add(('leomessi', 'Ehteee #upc', 1))
+        self.assertEqual(batches, [])
+        batcher.add(('xavi', 'Golazo #upc', 2))
+        self.assertEqual(batches, [[('leomessi', 'Ehteee #upc', 1), ('xavi', 'Golazo #upc', 2)]])
+        self.assertEqual(batcher.pending, [])
+
+    def test_batches_are_sent_when_window_expires(self):
+        from maxrules.batching import TweetBatcher
+        sent = threading.Event()
+        batches = []
+
+        def flush(batch):
+            batches.append(batch)
+            sent.set()
+
+        batcher = TweetBatcher(flush, size=50, window=0.1)
+        batcher.add(('leomessi', 'Ehteee #upc', 1))
+        self.assertTrue(sent.wait(5))
+        self.assertEqual(batches, [[('leomessi', 'Ehteee #upc', 1)]])
+
+    def test_flush_errors_dont_break_the_batcher(self):
+        from maxrules.batching import TweetBatcher
+        batches = []
+
+        def flush(batch):
+            batches.append(batch)
+            raise Exception('Broker unavailable')
+
+        batcher = TweetBatcher(flush, size=1, window=60)
+        batcher.add(('leomessi', 'Ehteee #upc', 1))
+        batcher.add(('xavi', 'Golazo #upc', 2))
+        self.assertEqual(len(batches), 2)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+
+class EntitiesTests(unittest.TestCase):
+
+    def test_find_hashtags(self):
+        from max.rest.utils import findHashtags
+        text = "#first # Hello i'm a #text with #hashtags but#some are not valid#  # ##double #Last"
+        self.assertEqual(findHashtags(text), ['first', 'text', 'hashtags', 'last'])
+
+    def test_find_keywords(self):
+        from max.rest.utils import findKeywords
+        text = u"<p>[A] Testejant la creació d'un #canvi http://www.upc.edu/noticies d'estatus</p>"
+        self.assertEqual(findKeywords(text), [u'testejant', u'creació', u'canvi'])
+
+    def test_find_keywords_utf8_text(self):
+        from max.rest.utils import findKeywords
+        self.assertEqual(findKeywords("Testejant la creació"), [u'testejant', u'creació'])
+
+    def test_extract_entities(self):
+        from max.rest.utils import extractEntities
+        text = u'Mireu #upc www.upc.edu/noticies'
+        self.assertEqual(extractEntities(text), [('keyword', u'mireu', 0, 5),
+                                                 ('hashtag', u'upc', 6, 10),
+                                                 ('keyword', u'upc', 7, 10),
+                                                 ('url', u'www.upc.edu/noticies', 11, 31)])
+
+    def test_extract_entities_url_inside_token(self):
+        from max.rest.utils import extractEntities, getEntityValues
+        entities = extractEntities(u'(http://www.upc.edu/noticies) foohttp://www.upc.edu')
+        self.assertEqual(getEntityValues(entities, 'url'), [u'http://www.upc.edu/noticies', u'http://www.upc.edu'])
+        self.assertEqual(getEntityValues(entities, 'keyword'), [u'foo'])
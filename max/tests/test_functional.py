@@ -3,6 +3,7 @@ import os
 from paste.deploy import loadapp
 import base64
 import json
+import time
 
 from mock import patch
 
@@ -17,6 +18,7 @@ class mock_post(object):
 
 
 @patch('requests.post', new=mock_post)
+@patch('requests.Session.post', new=mock_post)
 class FunctionalTests(unittest.TestCase):
 
     def setUp(self):
@@ -25,6 +27,10 @@ class FunctionalTests(unittest.TestCase):
         self.app.registry.max_store.drop_collection('users')
         self.app.registry.max_store.drop_collection('activity')
         self.app.registry.max_store.drop_collection('contexts')
+        self.app.registry.max_store.drop_collection('timelines')
+        self.app.registry.max_store.drop_collection('terms')
+        self.app.registry.max_store.drop_collection('shorturls')
+        self.app.registry.max_store.drop_collection('notifications')
         from webtest import TestApp
         self.testapp = TestApp(self.app)
 
@@ -137,6 +143,22 @@ class FunctionalTests(unittest.TestCase):
         self.assertEqual(result.get('totalItems', None), 1)
         self.assertEqual(result.get('items', None)[0].get('username'), 'messi')
 
+    def test_get_all_users_streamed(self):
+        self.create_user('messi')
+        self.create_user('xavi')
+        res = self.testapp.get('/admin/people', {'stream': 'json'}, basicAuthHeader('operations', 'operations'))
+        result = json.loads(res.text)
+        self.assertEqual(result.get('totalItems', None), 2)
+        self.assertEqual([user['username'] for user in result['items']], ['messi', 'xavi'])
+
+    def test_get_all_users_streamed_ndjson(self):
+        self.create_user('messi')
+        self.create_user('xavi')
+        res = self.testapp.get('/admin/people', {'stream': 'ndjson'}, basicAuthHeader('operations', 'operations'))
+        self.assertEqual(res.content_type, 'application/x-ndjson')
+        users = [json.loads(line) for line in res.text.splitlines()]
+        self.assertEqual([user['username'] for user in users], ['messi', 'xavi'])
+
     def test_post_activity_without_context(self):
         from .mockers import user_status
         username = 'messi'
@@ -147,6 +169,28 @@ class FunctionalTests(unittest.TestCase):
         self.assertEqual(result.get('object', None).get('objectType', None), 'note')
         self.assertEqual(result.get('contexts', None), None)
 
+    def test_post_activity_idempotency_key(self):
+        from .mockers import user_status
+        from max.indexes import ensureIndexes
+        ensureIndexes(self.app.registry.max_store)
+        self.create_user('messi')
+        headers = dict(oauth2Header('messi'), **{'Idempotency-Key': 'a8098c1a-f86e'})
+        first = self.testapp.post('/people/messi/activities', json.dumps(user_status), headers, status=201)
+        second = self.testapp.post('/people/messi/activities', json.dumps(user_status), headers, status=200)
+        self.assertEqual(first.json.get('id'), second.json.get('id'))
+        self.assertEqual(self.app.registry.max_store.activity.count(), 1)
+
+    def test_post_activity_same_idempotency_key_other_actor(self):
+        from .mockers import user_status
+        from max.indexes import ensureIndexes
+        ensureIndexes(self.app.registry.max_store)
+        self.create_user('messi')
+        self.create_user('xavi')
+        key = {'Idempotency-Key': 'a8098c1a-f86e'}
+        first = self.testapp.post('/people/messi/activities', json.dumps(user_status), dict(oauth2Header('messi'), **key), status=201)
+        second = self.testapp.post('/people/xavi/activities', json.dumps(user_status), dict(oauth2Header('xavi'), **key), status=201)
+        self.assertNotEqual(first.json.get('id'), second.json.get('id'))
+
     def test_post_activity_with_unauthorized_context(self):
         from .mockers import user_status_contextA
         username = 'messi'
@@ -191,6 +235,33 @@ class FunctionalTests(unittest.TestCase):
         self.assertEqual(result.get('items', None)[0].get('actor', None).get('username'), 'messi')
         self.assertEqual(result.get('items', None)[0].get('object', None).get('objectType', None), 'note')
 
+    def test_get_activities_paginated(self):
+        from .mockers import user_status
+        username = 'messi'
+        self.create_user(username)
+        activity_ids = [json.loads(self.create_activity(username, user_status).text)['id'] for i in range(3)]
+
+        res = self.testapp.get('/people/%s/activities' % username, {'limit': 2}, oauth2Header(username), status=200)
+        result = json.loads(res.text)
+        self.assertEqual([item['id'] for item in result['items']], activity_ids[:0:-1])
+        self.assertIn('next', result)
+
+        res = self.testapp.get('/people/%s/activities' % username, {'limit': 2, 'cursor': result['next']}, oauth2Header(username), status=200)
+        result = json.loads(res.text)
+        self.assertEqual([item['id'] for item in result['items']], activity_ids[:1])
+        self.assertNotIn('next', result)
+
+        res = self.testapp.get('/people/%s/activities' % username, {'limit': 2, 'cursor': result['prev']}, oauth2Header(username), status=200)
+        result = json.loads(res.text)
+        self.assertEqual([item['id'] for item in result['items']], activity_ids[:0:-1])
+
+    def test_get_activities_invalid_cursor(self):
+        username = 'messi'
+        self.create_user(username)
+        res = self.testapp.get('/people/%s/activities' % username, {'cursor': 'invalid'}, oauth2Header(username), status=400)
+        result = json.loads(res.text)
+        self.assertEqual(result.get('error', None), 'InvalidSearchParams')
+
     def test_get_activity_not_me(self):
         from .mockers import user_status
         username = 'messi'
@@ -337,6 +408,126 @@ class FunctionalTests(unittest.TestCase):
         result = json.loads(res.text)
         self.assertEqual(result.get('totalItems', None), 1)
 
+    def test_context_activities_keyword_search_term_index(self):
+        """
+            With the term index enabled, keyword searches work without
+            storing the keyword arrays in the activities
+        """
+        from .mockers import context_query_kw_search
+        from .mockers import create_context
+        from .mockers import subscribe_context, user_status_context
+        self.app.registry.max_settings['max_term_index'] = 'true'
+        self.app.registry.max_settings['max_strip_term_arrays'] = 'true'
+
+        username = 'messi'
+        self.create_user(username)
+        self.create_context(create_context, permissions=dict(read='public', write='subscribed', join='restricted', invite='restricted'))
+        self.subscribe_user_to_context(username, subscribe_context)
+        activity = json.loads(self.create_activity(username, user_status_context).text)
+        self.create_activity(username, dict(user_status_context, object={'objectType': 'note', 'content': '<p>Un altre estatus</p>'}))
+
+        res = self.testapp.get('/activities', context_query_kw_search, oauth2Header(username), status=200)
+        result = json.loads(res.text)
+        self.assertEqual(result.get('totalItems', None), 1)
+        self.assertEqual(result.get('items', None)[0].get('id', None), activity['id'])
+        self.assertNotIn('_keywords', result.get('items', None)[0].get('object', None))
+
+    def test_context_activities_keyword_search_term_index_too_many_candidates(self):
+        """
+            With the term index enabled, searches of terms with too many postings
+            fall back to the keyword arrays, or to the newest postings if stripped
+        """
+        from .mockers import context_query_kw_search
+        from .mockers import create_context
+        from .mockers import subscribe_context, user_status_context
+        self.app.registry.max_settings['max_term_index'] = 'true'
+        self.app.registry.max_settings['max_term_index_max_candidates'] = '1'
+
+        username = 'messi'
+        self.create_user(username)
+        self.create_context(create_context)
+        self.subscribe_user_to_context(username, subscribe_context)
+        self.create_activity(username, user_status_context)
+        newest = json.loads(self.create_activity(username, user_status_context).text)
+
+        res = self.testapp.get('/activities', context_query_kw_search, oauth2Header(username), status=200)
+        self.assertEqual(res.json['totalItems'], 2)
+
+        self.app.registry.max_settings['max_strip_term_arrays'] = 'true'
+        res = self.testapp.get('/activities', context_query_kw_search, oauth2Header(username), status=200)
+        self.assertEqual(res.json['totalItems'], 1)
+        self.assertEqual(res.json['items'][0]['id'], newest['id'])
+
+    def test_context_activities_keyword_search_term_index_after_delete(self):
+        """
+            With the term index enabled, the postings of deleted activities are removed,
+            so they don't take the place of the remaining ones among the candidates
+        """
+        from .mockers import context_query_kw_search
+        from .mockers import create_context
+        from .mockers import subscribe_context, user_status_context
+        self.app.registry.max_settings['max_term_index'] = 'true'
+        self.app.registry.max_settings['max_strip_term_arrays'] = 'true'
+        self.app.registry.max_settings['max_term_index_max_candidates'] = '1'
+
+        username = 'messi'
+        self.create_user(username)
+        self.create_context(create_context)
+        self.subscribe_user_to_context(username, subscribe_context)
+        remaining = json.loads(self.create_activity(username, user_status_context).text)
+        deleted = json.loads(self.create_activity(username, user_status_context).text)
+        self.testapp.delete('/admin/activities/%s' % deleted['id'], "", basicAuthHeader('operations', 'operations'), status=204)
+
+        res = self.testapp.get('/activities', context_query_kw_search, oauth2Header(username), status=200)
+        self.assertEqual(res.json['totalItems'], 1)
+        self.assertEqual(res.json['items'][0]['id'], remaining['id'])
+
+    def test_context_activities_comment_hashtag_search_term_index(self):
+        """
+            With the term index enabled, activities are found by the hashtags of its comments
+        """
+        from .mockers import create_context, subscribe_context, user_status_context, user_comment_with_hashtag
+        from hashlib import sha1
+        self.app.registry.max_settings['max_term_index'] = 'true'
+
+        username = 'messi'
+        self.create_user(username)
+        self.create_context(create_context)
+        self.subscribe_user_to_context(username, subscribe_context)
+        activity = json.loads(self.create_activity(username, user_status_context).text)
+        self.testapp.post('/activities/%s/comments' % activity['id'], json.dumps(user_comment_with_hashtag), oauth2Header(username), status=201)
+
+        query = {'context': sha1(subscribe_context['object']['url']).hexdigest(), 'hashtag': 'comentari'}
+        res = self.testapp.get('/activities', query, oauth2Header(username), status=200)
+        result = json.loads(res.text)
+        self.assertEqual(result.get('totalItems', None), 1)
+        self.assertEqual(result.get('items', None)[0].get('id', None), activity['id'])
+
+    def test_rebuild_term_index_with_comments_not_embedded(self):
+        """
+            Rebuilding the term index keeps the terms of the comments no longer
+            embedded in the commented activity
+        """
+        from .mockers import create_context, subscribe_context, user_status_context, user_comment, user_comment_with_hashtag
+        from max.terms import rebuildTermIndex
+        from hashlib import sha1
+        self.app.registry.max_settings['max_term_index'] = 'true'
+        self.app.registry.max_settings['max_strip_term_arrays'] = 'true'
+        self.app.registry.max_settings['max_embedded_replies'] = '1'
+
+        username = 'messi'
+        self.create_user(username)
+        self.create_context(create_context)
+        self.subscribe_user_to_context(username, subscribe_context)
+        activity = json.loads(self.create_activity(username, user_status_context).text)
+        self.testapp.post('/activities/%s/comments' % activity['id'], json.dumps(user_comment_with_hashtag), oauth2Header(username), status=201)
+        self.testapp.post('/activities/%s/comments' % activity['id'], json.dumps(user_comment), oauth2Header(username), status=201)
+
+        self.assertEqual(rebuildTermIndex(self.app.registry.max_store), 1)
+        query = {'context': sha1(subscribe_context['object']['url']).hexdigest(), 'hashtag': 'comentari'}
+        res = self.testapp.get('/activities', query, oauth2Header(username), status=200)
+        self.assertEqual([item['id'] for item in res.json['items']], [activity['id']])
+
     def test_context_activities_author_search(self):
         """
         """
@@ -417,6 +608,33 @@ class FunctionalTests(unittest.TestCase):
         self.assertEqual(result.get('object', None).get('objectType', None), 'note')
         self.assertEqual(result.get('contexts', None)[0], subscribe_context['object'])
 
+    def test_post_activity_shortens_urls(self):
+        """
+            Urls are shortened once, and remembered for later activities
+        """
+        from mock import Mock
+        username = 'messi'
+        self.create_user(username)
+        activity = {"object": {"objectType": "note", "content": "<p>Mireu http://www.upc.edu/noticies</p>"}}
+        bitly = Mock(return_value=Mock(content=json.dumps({'status_code': 200, 'data': {'url': 'http://bit.ly/upc'}})))
+        with patch('requests.get', new=bitly):
+            res = self.create_activity(username, activity)
+            self.create_activity(username, activity)
+        result = json.loads(res.text)
+        self.assertEqual(result.get('object', None).get('content', None), '<p>Mireu http://bit.ly/upc</p>')
+        self.assertEqual(bitly.call_count, 1)
+        stored = self.app.registry.max_store.activity.find_one()
+        self.assertEqual(stored['object']['content'], '<p>Mireu http://bit.ly/upc</p>')
+
+    def test_post_activity_without_shortening_urls(self):
+        username = 'messi'
+        self.create_user(username)
+        self.app.registry.max_settings['max_shorten_urls'] = 'off'
+        activity = {"object": {"objectType": "note", "content": "<p>Mireu http://www.upc.edu/noticies</p>"}}
+        res = self.create_activity(username, activity)
+        result = json.loads(res.text)
+        self.assertEqual(result.get('object', None).get('content', None), '<p>Mireu http://www.upc.edu/noticies</p>')
+
     def test_post_activity_with_generator(self):
         """ Post an activity to a context which allows everyone to read and write
         """
@@ -491,6 +709,198 @@ class FunctionalTests(unittest.TestCase):
         self.assertEqual(result.get('items', None)[1].get('object', None).get('objectType', None), 'note')
         self.assertEqual(result.get('items', None)[1].get('contexts', None)[0], subscribe_context['object'])
 
+    def test_get_timeline_fields(self):
+        from .mockers import user_status, user_comment
+        username = 'messi'
+        self.create_user(username)
+        activity = self.create_activity(username, user_status).json
+        self.testapp.post('/activities/%s/comments' % activity['id'], json.dumps(user_comment), oauth2Header(username), status=201)
+
+        res = self.testapp.get('/people/%s/timeline' % username, {'fields': 'verb,object.content'}, oauth2Header(username), status=200)
+        self.assertEqual(res.json['items'][0], {'id': activity['id'], 'verb': 'post', 'object': {'content': user_status['object']['content'].decode('utf-8')}})
+
+        res = self.testapp.get('/people/%s/timeline' % username, {'fields': 'summary'}, oauth2Header(username), status=200)
+        item = res.json['items'][0]
+        self.assertEqual(item['replies'], {'totalItems': 1})
+        self.assertNotIn('_keywords', item['object'])
+
+        res = self.testapp.get('/people/%s/timeline' % username, {'fields': 'verb,$where'}, oauth2Header(username), status=400)
+        self.assertEqual(res.json.get('error'), 'InvalidSearchParams')
+
+    def test_get_timeline_not_modified(self):
+        from .mockers import user_status, user_comment
+        username = 'messi'
+        self.create_user(username)
+        activity = self.create_activity(username, user_status).json
+        res = self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+        etag = res.headers['ETag']
+        self.assertIn('must-revalidate', res.headers['Cache-Control'])
+
+        headers = dict(oauth2Header(username), **{'If-None-Match': etag})
+        self.testapp.get('/people/%s/timeline' % username, "", headers, status=304)
+
+        self.testapp.post('/activities/%s/comments' % activity['id'], json.dumps(user_comment), oauth2Header(username), status=201)
+        res = self.testapp.get('/people/%s/timeline' % username, "", headers, status=200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_get_timeline_modified_by_shortened_urls(self):
+        from max.shortener import shortenActivityContent
+        from mock import Mock
+        username = 'messi'
+        self.create_user(username)
+        self.app.registry.max_settings['max_shorten_urls'] = 'off'
+        content = "<p>Mireu http://www.upc.edu/noticies</p>"
+        activity = self.create_activity(username, {"object": {"objectType": "note", "content": content}}).json
+        res = self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+        headers = dict(oauth2Header(username), **{'If-None-Match': res.headers['ETag']})
+
+        bitly = Mock(return_value=Mock(content=json.dumps({'status_code': 200, 'data': {'url': 'http://bit.ly/upc'}})))
+        with patch('requests.get', new=bitly):
+            shortenActivityContent(self.app.registry.max_store, activity['id'], content)
+        res = self.testapp.get('/people/%s/timeline' % username, "", headers, status=200)
+        self.assertEqual(res.json['items'][0]['object']['content'], '<p>Mireu http://bit.ly/upc</p>')
+
+    def test_get_user_not_modified(self):
+        username = 'messi'
+        self.create_user(username)
+        res = self.testapp.get('/people/%s' % username, "", oauth2Header(username), status=200)
+        headers = dict(oauth2Header(username), **{'If-None-Match': res.headers['ETag']})
+        self.testapp.get('/people/%s' % username, "", headers, status=304)
+
+    def test_poll_timeline(self):
+        from .mockers import user_status
+        from max.notifications import TimelineNotifier
+        self.app.registry.max_notifier = TimelineNotifier()
+        self.app.registry.max_settings['max_poll_timeout'] = '0.1'
+        username = 'messi'
+        self.create_user(username)
+        self.create_activity(username, user_status)
+        res = self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+        cursor = res.json['prev']
+
+        res = self.testapp.get('/people/%s/timeline/poll' % username, {'cursor': cursor}, oauth2Header(username), status=200)
+        self.assertEqual(res.json['totalItems'], 0)
+        self.assertEqual(res.json['prev'], cursor)
+
+        newer = self.create_activity(username, user_status).json
+        res = self.testapp.get('/people/%s/timeline/poll' % username, {'cursor': cursor}, oauth2Header(username), status=200)
+        self.assertEqual([activity['id'] for activity in res.json['items']], [newer['id']])
+
+    def test_poll_timeline_over_the_limit(self):
+        """
+            When the limit of waiting requests is reached, the poll is answered right away
+        """
+        from .mockers import user_status
+        from max.notifications import TimelineNotifier
+        self.app.registry.max_notifier = TimelineNotifier(limit=0)
+        self.app.registry.max_settings['max_poll_timeout'] = '60'
+        username = 'messi'
+        self.create_user(username)
+        self.create_activity(username, user_status)
+        res = self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+        cursor = res.json['prev']
+
+        started = time.time()
+        res = self.testapp.get('/people/%s/timeline/poll' % username, {'cursor': cursor}, oauth2Header(username), status=200)
+        self.assertEqual(res.json['totalItems'], 0)
+        self.assertEqual(res.json['prev'], cursor)
+        self.assertTrue(time.time() - started < 5)
+
+    def test_get_timeline_fanout(self):
+        """
+            With materialized timelines enabled, the timeline returns the same
+            activities as the query based one, including the ones posted to a context
+            before the user subscribed to it
+        """
+        from .mockers import user_status, user_status_context, user_status_contextA
+        from .mockers import subscribe_context, subscribe_contextA
+        from .mockers import create_context, create_contextA
+        self.app.registry.max_settings['max_timeline_fanout'] = 'true'
+        username = 'messi'
+        username_not_me = 'xavi'
+        self.create_user(username)
+        self.create_user(username_not_me)
+        self.create_context(create_context)
+        self.create_context(create_contextA)
+        self.subscribe_user_to_context(username, subscribe_context)
+        self.subscribe_user_to_context(username_not_me, subscribe_contextA)
+        self.create_activity(username, user_status)
+        self.create_activity(username, user_status_context)
+        self.create_activity(username_not_me, user_status_contextA)
+        self.subscribe_user_to_context(username, subscribe_contextA)
+        res = self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+        result = json.loads(res.text)
+        self.assertEqual(result.get('totalItems', None), 3)
+        self.assertEqual(result.get('items', None)[0].get('actor', None).get('username'), 'xavi')
+        self.assertEqual(result.get('items', None)[0].get('contexts', None)[0], subscribe_contextA['object'])
+        self.assertEqual(result.get('items', None)[1].get('actor', None).get('username'), 'messi')
+        self.assertEqual(result.get('items', None)[1].get('contexts', None)[0], subscribe_context['object'])
+        self.assertEqual(result.get('items', None)[2].get('actor', None).get('username'), 'messi')
+        self.assertEqual(result.get('items', None)[2].get('contexts', None), None)
+
+    def test_get_timeline_fanout_without_deleted_activities(self):
+        """
+            Deleted activities are removed from the materialized timelines, so pages
+            are not left short of items
+        """
+        from .mockers import user_status
+        self.app.registry.max_settings['max_timeline_fanout'] = 'true'
+        username = 'messi'
+        self.create_user(username)
+        deleted = self.create_activity(username, user_status).json
+        self.create_activity(username, user_status)
+        self.testapp.delete('/admin/activities/%s' % deleted['id'], "", basicAuthHeader('operations', 'operations'), status=204)
+        res = self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+        self.assertEqual(res.json['totalItems'], 1)
+        self.assertEqual(self.app.registry.max_store.timelines.find().count(), 1)
+
+    def test_get_metrics_with_token_cache(self):
+        from max.oauth2 import TokenCache
+        self.app.registry.max_token_cache = TokenCache(ttl=60)
+        self.app.registry.max_token_cache.set('token', 'messi', 'widgetcli', True)
+        self.app.registry.max_token_cache.get('token', 'messi', 'widgetcli')
+        res = self.testapp.get('/admin/metrics', "", basicAuthHeader('operations', 'operations'), status=200)
+        self.assertEqual(res.json['token_cache'], dict(hits=1, misses=0, size=1))
+
+    def test_get_timeline_fanout_without_deleted_context(self):
+        """
+            The activities of a deleted context are removed from the materialized timelines
+            of its subscribers, except the ones they still receive as its actors
+        """
+        from hashlib import sha1
+        from .mockers import user_status_context
+        from .mockers import subscribe_context, create_context
+        self.app.registry.max_settings['max_timeline_fanout'] = 'true'
+        username = 'messi'
+        username_not_me = 'xavi'
+        self.create_user(username)
+        self.create_user(username_not_me)
+        self.create_context(create_context)
+        self.subscribe_user_to_context(username, subscribe_context)
+        self.subscribe_user_to_context(username_not_me, subscribe_context)
+        self.create_activity(username_not_me, user_status_context)
+        own = self.create_activity(username, user_status_context).json
+        url_hash = sha1(create_context['url']).hexdigest()
+        self.testapp.delete('/contexts/%s' % url_hash, "", basicAuthHeader('operations', 'operations'), status=204)
+        res = self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+        self.assertEqual(res.json['totalItems'], 1)
+        self.assertEqual(res.json['items'][0]['id'], own['id'])
+
+    def test_get_timeline_with_followed_user(self):
+        from .mockers import user_status
+        username = 'messi'
+        username_not_me = 'xavi'
+        self.create_user(username)
+        self.create_user(username_not_me)
+        self.create_activity(username_not_me, user_status)
+        res = self.testapp.post('/people/%s/follows/%s' % (username, username_not_me), "", basicAuthHeader('operations', 'operations'), status=201)
+        result = json.loads(res.text)
+        self.assertEqual(result.get('object', None).get('username', None), 'xavi')
+        res = self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+        result = json.loads(res.text)
+        self.assertEqual(result.get('totalItems', None), 1)
+        self.assertEqual(result.get('items', None)[0].get('actor', None).get('username'), 'xavi')
+
     def test_post_comment(self):
         from .mockers import user_status, user_comment
         from .mockers import subscribe_context, create_context
@@ -506,6 +916,61 @@ class FunctionalTests(unittest.TestCase):
         self.assertEqual(result.get('object', None).get('objectType', None), 'comment')
         self.assertEqual(result.get('object', None).get('inReplyTo', None)[0].get('id'), str(activity.get('id')))
 
+    def test_post_comment_idempotency_key(self):
+        from .mockers import user_status, user_comment
+        from max.indexes import ensureIndexes
+        from bson.objectid import ObjectId
+        ensureIndexes(self.app.registry.max_store)
+        username = 'messi'
+        self.create_user(username)
+        activity = self.create_activity(username, user_status).json
+        headers = dict(oauth2Header(username), **{'Idempotency-Key': 'b1f2c3d4-e5f6'})
+        first = self.testapp.post('/activities/%s/comments' % activity['id'], json.dumps(user_comment), headers, status=201)
+        second = self.testapp.post('/activities/%s/comments' % activity['id'], json.dumps(user_comment), headers, status=200)
+        self.assertEqual(first.json['id'], second.json['id'])
+
+        stored = self.app.registry.max_store.activity.find_one({'_id': ObjectId(activity['id'])})
+        self.assertEqual(stored['replies']['totalItems'], 1)
+        self.assertEqual(len(stored['replies']['items']), 1)
+
+    def test_post_comments_merge_terms(self):
+        from .mockers import user_status, user_comment, user_comment_with_hashtag
+        from bson.objectid import ObjectId
+        username = 'messi'
+        self.create_user(username)
+        activity = self.create_activity(username, user_status).json
+        self.testapp.post('/activities/%s/comments' % activity['id'], json.dumps(user_comment_with_hashtag), oauth2Header(username), status=201)
+        self.testapp.post('/activities/%s/comments' % activity['id'], json.dumps(user_comment), oauth2Header(username), status=201)
+
+        stored = self.app.registry.max_store.activity.find_one({'_id': ObjectId(activity['id'])})
+        self.assertEqual(stored['replies']['totalItems'], 2)
+        self.assertEqual(sorted(stored['object']['_hashtags']), ['comentari', 'nou'])
+        self.assertEqual(stored['object']['_keywords'].count('messi'), 1)
+        reply = stored['replies']['items'][0]
+        self.assertEqual(sorted(reply['author'].keys()), ['_id', 'displayName', 'username'])
+        self.assertNotIn('_keywords', reply)
+
+    def test_get_comments_beyond_embedded_replies(self):
+        from .mockers import user_status, user_comment
+        from bson.objectid import ObjectId
+        self.app.registry.max_settings['max_embedded_replies'] = '2'
+        username = 'messi'
+        self.create_user(username)
+        activity = self.create_activity(username, user_status).json
+        comment_ids = []
+        for i in range(3):
+            res = self.testapp.post('/activities/%s/comments' % activity['id'], json.dumps(user_comment), oauth2Header(username), status=201)
+            comment_ids.append(res.json['id'])
+
+        stored = self.app.registry.max_store.activity.find_one({'_id': ObjectId(activity['id'])})
+        self.assertEqual(stored['replies']['totalItems'], 3)
+        self.assertEqual([reply['id'] for reply in stored['replies']['items']], comment_ids[1:])
+
+        res = self.testapp.get('/activities/%s/comments' % activity['id'], {'limit': 2}, oauth2Header(username), status=200)
+        self.assertEqual([comment['id'] for comment in res.json['items']], comment_ids[:2])
+        res = self.testapp.get('/activities/%s/comments' % activity['id'], {'cursor': res.json['next']}, oauth2Header(username), status=200)
+        self.assertEqual([comment['id'] for comment in res.json['items']], comment_ids[2:])
+
     # ADMIN
 
     def test_admin_post_activity_without_context(self):
@@ -545,6 +1010,159 @@ class FunctionalTests(unittest.TestCase):
         self.assertEqual(result.get('object', None).get('objectType', None), 'note')
         self.assertEqual(result.get('contexts', None)[0], subscribe_context['object'])
 
+    def test_admin_post_activities_bulk(self):
+        from .mockers import subscribe_context
+        from .mockers import user_status, user_status_context
+        from .mockers import create_context
+        self.create_user('messi')
+        self.create_context(create_context)
+        self.subscribe_user_to_context('messi', subscribe_context)
+        activities = [dict(user_status, actor={'objectType': 'person', 'username': 'messi'}),
+                      dict(user_status_context, actor={'objectType': 'context', 'url': create_context['url']}),
+                      dict(user_status, actor={'objectType': 'person', 'username': 'xavi'}),
+                      {'actor': {'objectType': 'person', 'username': 'messi'}}]
+        res = self.testapp.post('/admin/activities', json.dumps(activities), basicAuthHeader('admin', 'admin'), status=200)
+        statuses = res.json.get('items')
+        self.assertEqual([status['status'] for status in statuses], [201, 201, 400, 400])
+        self.assertEqual(statuses[2]['error'], 'UnknownUserError')
+        self.assertEqual(statuses[3]['error'], 'MissingField')
+
+        from bson.objectid import ObjectId
+        activity = self.app.registry.max_store.activity.find_one({'_id': ObjectId(statuses[1]['id'])})
+        self.assertEqual(activity['actor']['url'], create_context['url'])
+        self.assertEqual(self.app.registry.max_store.activity.count(), 2)
+
+    def test_admin_post_activities_bulk_malformed_objects(self):
+        from .mockers import user_status
+        self.create_user('messi')
+        actor = {'objectType': 'person', 'username': 'messi'}
+        activities = [dict(user_status, actor=actor),
+                      {'actor': actor, 'object': {'content': 'Sense objectType'}},
+                      {'actor': actor, 'object': 'Not an object'},
+                      dict(user_status, actor=actor, contexts='http://atenea.upc.edu'),
+                      dict(user_status, actor=actor)]
+        res = self.testapp.post('/admin/activities', json.dumps(activities), basicAuthHeader('admin', 'admin'), status=200)
+        statuses = res.json.get('items')
+        self.assertEqual([status['status'] for status in statuses], [201, 400, 400, 400, 201])
+        self.assertEqual(set([status['error'] for status in statuses[1:4]]), set(['ValidationError']))
+        self.assertEqual(self.app.registry.max_store.activity.count(), 2)
+
+    def test_admin_post_activities_bulk_write_error(self):
+        """
+            A write error on some of the documents of a batch is reported on its items,
+            and the ones written are reported as created
+        """
+        from .mockers import user_status
+        from bson.objectid import ObjectId
+        from pymongo.collection import Collection
+        from pymongo.errors import OperationFailure
+        self.create_user('messi')
+        activity = dict(user_status, actor={'objectType': 'person', 'username': 'messi'})
+        insert = Collection.insert
+
+        def failingInsert(collection, docs, *args, **kwargs):
+            if collection.name == 'activity' and isinstance(docs, list) and len(docs) > 1:
+                insert(collection, docs[:1], *args, **kwargs)
+                raise OperationFailure('Write failed')
+            return insert(collection, docs, *args, **kwargs)
+
+        with patch.object(Collection, 'insert', new=failingInsert):
+            res = self.testapp.post('/admin/activities', json.dumps([activity, activity]), basicAuthHeader('admin', 'admin'), status=200)
+        statuses = res.json.get('items')
+        self.assertEqual([status['status'] for status in statuses], [201, 500])
+        self.assertEqual(self.app.registry.max_store.activity.find({'_id': ObjectId(statuses[0]['id'])}).count(), 1)
+
+    def test_admin_post_activities_bulk_ndjson(self):
+        from .mockers import user_status
+        self.create_user('messi')
+        activity = dict(user_status, actor={'objectType': 'person', 'username': 'messi'})
+        body = '\n'.join([json.dumps(activity), '{not json', json.dumps(activity)])
+        headers = dict(basicAuthHeader('admin', 'admin'), **{'Content-Type': 'application/x-ndjson'})
+        res = self.testapp.post('/admin/activities', body, headers, status=200)
+        statuses = res.json.get('items')
+        self.assertEqual([status['status'] for status in statuses], [201, 400, 201])
+        self.assertEqual(statuses[1]['error'], 'ValidationError')
+
+    def test_admin_post_activities_bulk_ndjson_in_batches(self):
+        from .mockers import user_status
+        self.app.registry.max_settings['max_bulk_batch_size'] = '2'
+        self.create_user('messi')
+        activity = dict(user_status, actor={'objectType': 'person', 'username': 'messi'})
+        body = '\n'.join([json.dumps(activity)] * 5)
+        headers = dict(basicAuthHeader('admin', 'admin'), **{'Content-Type': 'application/x-ndjson'})
+        res = self.testapp.post('/admin/activities', body, headers, status=200)
+        self.assertEqual([status['status'] for status in res.json.get('items')], [201] * 5)
+        self.assertEqual(self.app.registry.max_store.activity.count(), 5)
+
+    def test_admin_post_activities_bulk_idempotency_key(self):
+        from .mockers import user_status
+        from max.indexes import ensureIndexes
+        ensureIndexes(self.app.registry.max_store)
+        self.create_user('messi')
+        self.create_user('xavi')
+        activities = [dict(user_status, idempotencyKey='one', actor={'objectType': 'person', 'username': 'messi'}),
+                      dict(user_status, idempotencyKey='one', actor={'objectType': 'person', 'username': 'messi'}),
+                      dict(user_status, idempotencyKey='one', actor={'objectType': 'person', 'username': 'xavi'})]
+        res = self.testapp.post('/admin/activities', json.dumps(activities), basicAuthHeader('admin', 'admin'), status=200)
+        statuses = res.json.get('items')
+        self.assertEqual([status['status'] for status in statuses], [201, 200, 201])
+        self.assertEqual(statuses[0]['id'], statuses[1]['id'])
+        self.assertNotEqual(statuses[0]['id'], statuses[2]['id'])
+        self.assertEqual(self.app.registry.max_store.activity.count(), 2)
+
+    # IDENTITY MAP
+
+    def test_identity_map_lookups(self):
+        from max.MADMax import MADMaxDB, IdentityMap
+        import max.models
+        self.create_user('messi')
+        identity_map = IdentityMap()
+        mmdb = MADMaxDB(self.app.registry.max_store, identity_map=identity_map)
+        user = mmdb.users.getItemsByusername('messi')[0]
+        self.assertIs(mmdb.users.getItemsByusername('messi')[0], user)
+        self.assertIs(mmdb.users.getItemsMapByusername(['messi'])['messi'], user)
+        self.assertEqual(identity_map.stats(), dict(hits=2, queries=1))
+
+    def test_identity_map_invalidated_on_write(self):
+        from max.MADMax import MADMaxDB, IdentityMap
+        import max.models
+        self.create_user('messi')
+        identity_map = IdentityMap()
+        mmdb = MADMaxDB(self.app.registry.max_store, identity_map=identity_map)
+        user = mmdb.users.getItemsByusername('messi')[0]
+        user.modifyUser({'displayName': 'Lionel Messi'})
+        self.assertEqual(mmdb.users.getItemsByusername('messi')[0]['displayName'], 'Lionel Messi')
+        self.assertEqual(identity_map.stats(), dict(hits=0, queries=2))
+
+    # INDEXES
+
+    def test_ensure_indexes_dry_run(self):
+        from max.indexes import ensureIndexes, checkIndexes
+        db = self.app.registry.max_store
+        self.create_user('messi')
+        pending = ensureIndexes(db, dry_run=True)
+        self.assertIn(('users', 'username_1'), pending)
+        self.assertIn('username_1', checkIndexes(db)['users']['missing'])
+
+    def test_ensure_indexes(self):
+        from max.indexes import ensureIndexes, checkIndexes
+        db = self.app.registry.max_store
+        self.create_user('messi')
+        ensureIndexes(db)
+        report = checkIndexes(db)
+        self.assertEqual(report['users']['missing'], [])
+        self.assertEqual(report['activity']['missing'], [])
+        self.assertEqual(ensureIndexes(db), [])
+
+    def test_ensure_indexes_skips_unique_on_duplicates(self):
+        from max.indexes import ensureIndexes, checkIndexes
+        db = self.app.registry.max_store
+        db.users.insert([{'username': 'messi'}, {'username': 'messi'}])
+        created = ensureIndexes(db)
+        self.assertNotIn(('users', 'username_1'), created)
+        self.assertIn(('users', 'subscribedTo.items.url_1'), created)
+        self.assertIn('username_1', checkIndexes(db)['users']['missing'])
+
     # CONTEXTS
 
     def test_add_public_context(self):
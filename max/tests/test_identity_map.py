@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+
+class FakeCollection(object):
+    """
+        Collection answering find and find_one on a single field from a list of items
+    """
+
+    def __init__(self, name, items):
+        self.name = name
+        self.items = items
+        self.queries = 0
+
+    def _matches(self, item, query):
+        for field, value in query.items():
+            if isinstance(value, dict):
+                if item.get(field) not in value['$in']:
+                    return False
+            elif item.get(field) != value:
+                return False
+        return True
+
+    def find(self, query, fields=None):
+        self.queries += 1
+        return [dict(item) for item in self.items if self._matches(item, query)]
+
+    def find_one(self, query, fields=None):
+        found = self.find(query, fields)
+        return found and found[0] or None
+
+
+class IdentityMapTests(unittest.TestCase):
+
+    def setUp(self):
+        import max.models
+        from max.MADMax import MADMaxCollection, IdentityMap
+        self.collection = FakeCollection('contexts', [{'urlHash': 'a1', 'url': 'http://atenea.upc.edu'}])
+        self.identity_map = IdentityMap()
+        self.contexts = MADMaxCollection(self.collection, query_key='urlHash', identity_map=self.identity_map)
+
+    def test_dict_like_then_get_items_by(self):
+        context = self.contexts['a1']
+        found = self.contexts.getItemsByurlHash('a1')
+        self.assertEqual(len(found), 1)
+        self.assertIs(found[0], context)
+        self.assertEqual(self.collection.queries, 1)
+
+    def test_get_items_by_then_dict_like(self):
+        found = self.contexts.getItemsByurlHash('a1')
+        self.assertIs(self.contexts['a1'], found[0])
+        self.assertEqual(self.collection.queries, 1)
+
+    def test_dict_like_after_empty_get_items_by(self):
+        from max.exceptions import ObjectNotFound
+        self.assertEqual(self.contexts.getItemsByurlHash('b2'), [])
+        self.assertRaises(ObjectNotFound, self.contexts.__getitem__, 'b2')
+        self.assertEqual(self.collection.queries, 1)
+
+    def test_get_items_by_after_missing_dict_like(self):
+        from max.exceptions import ObjectNotFound
+        self.assertRaises(ObjectNotFound, self.contexts.__getitem__, 'b2')
+        self.assertEqual(self.contexts.getItemsByurlHash('b2'), [])
+        self.assertEqual(self.collection.queries, 1)
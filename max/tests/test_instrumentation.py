@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+
+class InstrumentationTests(unittest.TestCase):
+
+    def test_server_timing_lists_timed_phases_in_order(self):
+        from max.instrumentation import RequestTimer
+        timer = RequestTimer()
+        timer.add('total', 0.0125)
+        timer.add('db', 0.004)
+        timer.add('db', 0.001)
+        self.assertEqual(timer.serverTiming(3), 'db;dur=5.0;desc="3 queries", total;dur=12.5')
+
+    def test_metrics_aggregate_requests_by_route(self):
+        from max.instrumentation import RequestMetrics, RequestTimer
+        metrics = RequestMetrics()
+        for total, status in [(0.010, 200), (0.030, 400)]:
+            timer = RequestTimer()
+            timer.add('total', total)
+            metrics.record('GET timeline', status, timer, 2)
+        stats = metrics.stats()['GET timeline']
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['max_ms'], 30.0)
+        self.assertEqual(stats['mean_queries'], 2)
+        self.assertEqual(stats['mean_ms'], {'total': 20.0})
+
+    def test_timed_without_request_does_nothing(self):
+        from max.instrumentation import timed, getCurrentTimer
+        self.assertEqual(getCurrentTimer(), None)
+        with timed('db'):
+            result = 1
+        self.assertEqual(result, 1)
+
+    def test_profiling_needs_request_timing(self):
+        from max.instrumentation import startStackSampler
+        self.assertEqual(startStackSampler({'max_profile_slow_requests': '500'}), None)
+        self.assertEqual(startStackSampler({'max_request_timing': 'true'}), None)
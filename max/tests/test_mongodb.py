@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+
+class MongoDBConnectionTests(unittest.TestCase):
+
+    def test_connection_options_from_settings(self):
+        from max.mongodb import getConnectionOptions
+        settings = {'mongodb.url': 'mongodb://localhost',
+                    'mongodb.pool_size': '50',
+                    'mongodb.connect_timeout': '2',
+                    'mongodb.wait_queue_timeout': '0.5',
+                    'mongodb.write_concern': 'majority'}
+        options = getConnectionOptions(settings)
+        self.assertEqual(options, {'max_pool_size': 50,
+                                   'connectTimeoutMS': 2000,
+                                   'waitQueueTimeoutMS': 500,
+                                   'w': 'majority'})
+
+    def test_connection_options_default_to_empty(self):
+        from max.mongodb import getConnectionOptions
+        self.assertEqual(getConnectionOptions({'mongodb.url': 'mongodb://localhost'}), {})
+
+    def test_connections_are_shared(self):
+        from max.mongodb import getConnection
+        first = getConnection('mongodb://localhost', max_pool_size=10, _connect=False)
+        second = getConnection('mongodb://localhost', max_pool_size=10, _connect=False)
+        other = getConnection('mongodb://localhost', max_pool_size=20, _connect=False)
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+
+    def test_write_concerns_per_operation(self):
+        from max.mongodb import getWriteConcerns
+        settings = {'mongodb.write_concern': '1',
+                    'mongodb.write_concern.bulk': '2',
+                    'mongodb.write_concern.notifications': '0'}
+        self.assertEqual(getWriteConcerns(settings), {'bulk': {'w': 2}, 'notifications': {'w': 0}})
+
+    def test_unacknowledged_bulk_writes_rejected(self):
+        from max.mongodb import getWriteConcerns
+        self.assertRaises(ValueError, getWriteConcerns, {'mongodb.write_concern.bulk': '0'})
+
+    def test_read_databases_disabled_by_default(self):
+        from max.mongodb import getConnection, getReadDatabases
+        db = getConnection('mongodb://localhost', _connect=False)['tests']
+        self.assertEqual(getReadDatabases({}, db, ['secondary_preferred']), {})
+
+    def test_routes_read_with_declared_preference(self):
+        from max.mongodb import getConnection, getReadDatabases
+        from max.resources import Root
+        from pymongo import ReadPreference
+
+        class Route(object):
+            def __init__(self, name):
+                self.name = name
+
+        class Registry(object):
+            pass
+
+        class Request(object):
+            def __init__(self, method, route):
+                self.method = method
+                self.matched_route = Route(route)
+                self.registry = registry
+
+        db = getConnection('mongodb://localhost', _connect=False)['tests']
+        registry = Registry()
+        registry.max_store = db
+        registry.max_read_stores = getReadDatabases({'mongodb.secondary_reads': 'true'}, db, ['secondary_preferred'])
+
+        timeline = Root(Request('GET', 'timeline'))
+        self.assertEqual(timeline.db.read_preference, ReadPreference.SECONDARY_PREFERRED)
+        self.assertIs(timeline.primary_db, db)
+        self.assertIs(Root(Request('POST', 'user_activities')).db, db)
+        self.assertIs(Root(Request('GET', 'user')).db, db)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import unittest
+import threading
+
+
+class NotificationsTests(unittest.TestCase):
+
+    def test_activity_keys_match_timeline_keys(self):
+        from max.notifications import getActivityKeys, getTimelineKeys
+        activity = {'actor': {'_id': 'messi'}, 'contexts': [{'url': 'http://atenea.upc.edu'}]}
+        follower = {'_id': 'xavi', 'subscribedTo': {'items': []}}
+        subscriber = {'_id': 'puyol', 'subscribedTo': {'items': [{'url': 'http://atenea.upc.edu'}]}}
+        stranger = {'_id': 'pique', 'subscribedTo': {'items': [{'url': 'http://www.upc.edu'}]}}
+        keys = set(getActivityKeys(activity))
+        self.assertTrue(keys & set(getTimelineKeys(follower, followed_ids=['messi'])))
+        self.assertTrue(keys & set(getTimelineKeys(subscriber)))
+        self.assertFalse(keys & set(getTimelineKeys(stranger)))
+
+    def test_notify_wakes_up_interested_waiters(self):
+        from max.notifications import TimelineNotifier
+        notifier = TimelineNotifier()
+        interested = notifier.subscribe(['actor:messi'])
+        other = notifier.subscribe(['actor:xavi'])
+        threading.Timer(0.05, notifier.notify, [['actor:messi', 'context:http://atenea.upc.edu']]).start()
+        self.assertTrue(interested.wait(5))
+        self.assertFalse(other.wait(0.1))
+
+    def test_unsubscribed_waiters_are_not_notified(self):
+        from max.notifications import TimelineNotifier
+        notifier = TimelineNotifier()
+        waiter = notifier.subscribe(['actor:messi'])
+        notifier.unsubscribe(waiter)
+        notifier.notify(['actor:messi'])
+        self.assertFalse(waiter.wait(0))
+        self.assertEqual(notifier.waiters, [])
+
+    def test_subscribe_over_the_limit(self):
+        from max.notifications import TimelineNotifier
+        notifier = TimelineNotifier(limit=1)
+        waiter = notifier.subscribe(['actor:messi'])
+        self.assertIsNone(notifier.subscribe(['actor:xavi']))
+        notifier.unsubscribe(waiter)
+        self.assertIsNotNone(notifier.subscribe(['actor:xavi']))
@@ -0,0 +1,111 @@
+import unittest
+import time
+
+
+class mock_backend(object):
+
+    def __init__(self):
+        self.items = {}
+
+    def get(self, key):
+        return self.items.get(key, None)
+
+    def set(self, key, valid, ttl):
+        self.items[key] = valid
+
+
+class TokenCacheTests(unittest.TestCase):
+
+    def test_cache_valid_token(self):
+        from max.oauth2 import TokenCache
+        cache = TokenCache(ttl=60)
+        self.assertIsNone(cache.get('token', 'messi', 'widgetcli'))
+        cache.set('token', 'messi', 'widgetcli', True)
+        self.assertTrue(cache.get('token', 'messi', 'widgetcli'))
+        self.assertEqual(cache.stats(), dict(hits=1, misses=1, size=1))
+
+    def test_cache_is_keyed_by_triple(self):
+        from max.oauth2 import TokenCache
+        cache = TokenCache(ttl=60)
+        cache.set('token', 'messi', 'widgetcli', True)
+        self.assertIsNone(cache.get('token', 'xavi', 'widgetcli'))
+        self.assertIsNone(cache.get('token', 'messi', 'otherscope'))
+        self.assertIsNone(cache.get('othertoken', 'messi', 'widgetcli'))
+
+    def test_cache_negative_results(self):
+        from max.oauth2 import TokenCache
+        cache = TokenCache(ttl=60, negative_ttl=60)
+        cache.set('token', 'messi', 'widgetcli', False)
+        self.assertEqual(cache.get('token', 'messi', 'widgetcli'), False)
+
+    def test_negative_caching_disabled(self):
+        from max.oauth2 import TokenCache
+        cache = TokenCache(ttl=60, negative_ttl=0)
+        cache.set('token', 'messi', 'widgetcli', False)
+        self.assertIsNone(cache.get('token', 'messi', 'widgetcli'))
+
+    def test_cache_expires(self):
+        from max.oauth2 import TokenCache
+        cache = TokenCache(ttl=0.01)
+        cache.set('token', 'messi', 'widgetcli', True)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('token', 'messi', 'widgetcli'))
+
+    def test_cache_discards_least_recently_used(self):
+        from max.oauth2 import TokenCache
+        cache = TokenCache(ttl=60, max_size=2)
+        cache.set('token1', 'messi', 'widgetcli', True)
+        cache.set('token2', 'messi', 'widgetcli', True)
+        cache.get('token1', 'messi', 'widgetcli')
+        cache.set('token3', 'messi', 'widgetcli', True)
+        self.assertTrue(cache.get('token1', 'messi', 'widgetcli'))
+        self.assertIsNone(cache.get('token2', 'messi', 'widgetcli'))
+        self.assertTrue(cache.get('token3', 'messi', 'widgetcli'))
+
+    def test_cache_shared_backend(self):
+        from max.oauth2 import TokenCache
+        backend = mock_backend()
+        worker1 = TokenCache(ttl=60, backend=backend)
+        worker2 = TokenCache(ttl=60, backend=backend)
+        worker1.set('token', 'messi', 'widgetcli', True)
+        self.assertTrue(worker2.get('token', 'messi', 'widgetcli'))
+        self.assertEqual(worker2.stats()['hits'], 1)
+
+
+class mock_unreachable_session(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def post(self, *args, **kwargs):
+        import requests
+        self.calls += 1
+        raise requests.ConnectionError('Connection refused')
+
+
+class mock_registry(object):
+
+    def __init__(self, session):
+        self.max_settings = {'max_oauth_check_endpoint': 'https://oauth.upc.edu/checktoken'}
+        self.max_oauth_session = session
+
+
+class mock_request(object):
+
+    def __init__(self, registry):
+        self.registry = registry
+
+
+class CheckTokenTests(unittest.TestCase):
+
+    def test_unreachable_server_fails_fast_until_ttl(self):
+        from max.oauth2 import checkToken
+        from max.exceptions import ServiceUnavailable
+        session = mock_unreachable_session()
+        request = mock_request(mock_registry(session))
+        self.assertRaises(ServiceUnavailable, checkToken, request, 'token', 'messi', 'widgetcli')
+        self.assertRaises(ServiceUnavailable, checkToken, request, 'token', 'messi', 'widgetcli')
+        self.assertEqual(session.calls, 1)
+        request.registry.max_oauth_unavailable_until = 0
+        self.assertRaises(ServiceUnavailable, checkToken, request, 'token', 'messi', 'widgetcli')
+        self.assertEqual(session.calls, 2)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+
+class TwitterRoutingTests(unittest.TestCase):
+
+    def test_routing_fields_detected_when_set_or_unset(self):
+        from max.routing import hasTwitterRoutingFields
+        self.assertTrue(hasTwitterRoutingFields({'twitterHashtag': 'assignatura1'}))
+        self.assertTrue(hasTwitterRoutingFields({'twitterUsername': None}))
+        self.assertFalse(hasTwitterRoutingFields({'displayName': 'Lionel Messi'}))
+
+    def test_tracking_contexts_are_not_repeated(self):
+        from maxrules.routing import TwitterRoutingTables
+        tables = TwitterRoutingTables(max_age=300)
+        contextA = {'_id': 'A', 'url': 'http://atenea.upc.edu/A'}
+        contextB = {'_id': 'B', 'url': 'http://atenea.upc.edu/B'}
+        tables.contexts_by_hashtag = {'assignatura1': [contextA, contextB], 'upc': [contextB]}
+        self.assertEqual(tables.getTrackingContexts(['UPC', 'Assignatura1', 'barça']), [contextB, contextA])
+        self.assertEqual(tables.getTrackingContexts(['barça']), [])
+
+    def test_user_lookup_ignores_case(self):
+        from maxrules.routing import TwitterRoutingTables
+        tables = TwitterRoutingTables(max_age=300)
+        tables.users_by_username = {'leomessi': 'messi_id'}
+        self.assertEqual(tables.getUserId('LeoMessi'), 'messi_id')
+        self.assertEqual(tables.getUserId('xavi'), None)
@@ -8,14 +8,7 @@ import json
 from mock import patch
 from maxrules import config
 
-config.mongodb_db_name = 'tests'
-
-
-class mock_post_obj(object):
-
-    def __init__(self, *args, **kwargs):
-        self.text = kwargs['text']
-        self.status_code = kwargs['status_code']
+config.max_ini_file = os.path.join(os.path.dirname(__file__), 'tests.ini')
 
 
 class RulesTests(unittest.TestCase):
@@ -28,19 +21,6 @@ class RulesTests(unittest.TestCase):
         self.app.registry.max_store.drop_collection('contexts')
         from webtest import TestApp
         self.testapp = TestApp(self.app)
-        self.patched = patch('requests.post', new=self.mock_post)
-        self.patched.start()
-
-    def mock_post(self, *args, **kwargs):
-        if '/admin/people/messi/activities' in args[0]:
-            # Fake the requests.post thorough the self.testapp instance, and test result later in test
-            res = self.testapp.post('/admin/people/%s/activities' % 'messi', args[1], basicAuthHeader('admin', 'admin'), status=201)
-            return mock_post_obj(text=res.text, status_code=201)
-        elif '/admin/contexts/90c8f28a7867fbad7a2359c6427ae8798a37ff07/activities' in args[0]:
-            # Fake the requests.post thorough the self.testapp instance, and test result later in test
-            res = self.testapp.post('/admin/contexts/%s/activities' % '90c8f28a7867fbad7a2359c6427ae8798a37ff07', args[1], basicAuthHeader('admin', 'admin'), status=201)
-            return mock_post_obj(text=res.text, status_code=201)
-        return mock_post_obj(text='', status_code=200)
 
     def create_user(self, username):
         res = self.testapp.post('/people/%s' % username, "", basicAuthHeader('operations', 'operations'), status=201)
@@ -211,6 +191,82 @@ class RulesTests(unittest.TestCase):
         self.assertEqual(result.get('items', None)[0].get('object', None).get('objectType', None), 'note')
         self.assertEqual(result.get('items', None)[0].get('contexts', None)[0], subscribe_contextA['object'])
 
+    def test_process_new_tweet_from_twitter_username_followed_by_two_contexts(self):
+        """
+        Test the case where two contexts follow the same twitter username, so the tweet
+        is posted once on each of them, impersonated as each context
+        """
+        from maxrules.tasks import processTweet
+        from .mockers import create_contextA, subscribe_contextA
+        from .mockers import create_contextB, subscribe_contextB
+        username = 'messi'
+        self.create_user(username)
+        context_permissions = dict(read='subscribed', write='subscribed', join='restricted', invite='restricted')
+        self.create_context(create_contextA, permissions=context_permissions)
+        self.modify_context(create_contextA['url'], {"twitterUsername": "maxupcnet"})
+        self.subscribe_user_to_context(username, subscribe_contextA)
+        self.create_context(create_contextB, permissions=context_permissions)
+        self.modify_context(create_contextB['url'], {"twitterUsername": "maxupcnet"})
+        self.subscribe_user_to_context(username, subscribe_contextB)
+
+        result = processTweet('maxupcnet', 'Ehteee, acabo de batir el récor de goles en el Barça.')
+
+        res = self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+        result_timeline = json.loads(res.text)
+        self.assertEqual(result, "(200) All posts sent")
+        self.assertEqual(result_timeline.get('totalItems', None), 2)
+        posted = sorted([(item['actor']['url'], item['contexts'][0]['url']) for item in result_timeline['items']])
+        self.assertEqual(posted, [(subscribe_contextA['object']['url'], subscribe_contextA['object']['url']),
+                                  (subscribe_contextB['object']['url'], subscribe_contextB['object']['url'])])
+
+    def test_process_tweet_batch_with_failing_tweet(self):
+        """
+        Test the case where routing a tweet of a batch fails unexpectedly, so only that
+        tweet is discarded, and the rest of the batch is posted
+        """
+        from maxrules import tasks
+        from .mockers import create_contextA, subscribe_contextA
+        username = 'messi'
+        self.create_user(username)
+        context_permissions = dict(read='subscribed', write='subscribed', join='restricted', invite='restricted')
+        self.create_context(create_contextA, permissions=context_permissions)
+        self.modify_context(create_contextA['url'], {"twitterUsername": "maxupcnet"})
+        self.subscribe_user_to_context(username, subscribe_contextA)
+
+        routeTweet = tasks.routeTweet
+
+        def failingRouteTweet(db, twitter_username, *args, **kwargs):
+            if twitter_username == 'broken':
+                raise KeyError('object')
+            return routeTweet(db, twitter_username, *args, **kwargs)
+
+        with patch('maxrules.tasks.routeTweet', new=failingRouteTweet):
+            results = tasks.processTweetBatch([('broken', 'Tweet que falla', '1'),
+                                               ('maxupcnet', 'Ehteee, acabo de batir el récor de goles en el Barça.', '2')])
+
+        res = self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+        self.assertEqual(results, ["(500) Error processing tweet", "(200) All posts sent"])
+        self.assertEqual(json.loads(res.text).get('totalItems', None), 1)
+
+    def test_process_tweet_batch_with_failing_post(self):
+        """
+        Test the case where creating the activities fails unexpectedly, so the tweet is
+        reported as failed with a server error
+        """
+        from maxrules import tasks
+        from .mockers import create_contextA, subscribe_contextA
+        username = 'messi'
+        self.create_user(username)
+        context_permissions = dict(read='subscribed', write='subscribed', join='restricted', invite='restricted')
+        self.create_context(create_contextA, permissions=context_permissions)
+        self.modify_context(create_contextA['url'], {"twitterUsername": "maxupcnet"})
+        self.subscribe_user_to_context(username, subscribe_contextA)
+
+        with patch('maxrules.tasks.addActivities', side_effect=Exception('database down')):
+            results = tasks.processTweetBatch([('maxupcnet', 'Ehteee, acabo de batir el récor de goles en el Barça.', '1')])
+
+        self.assertEqual(results, ["(500) Some posts not sent"])
+
     def test_process_new_tweet_from_hashtag_uppercase_from_twitter(self):
         """
         Test the case where we lower the case of the hashtag to match the lowercased from uppercase,
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import unittest
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+
+class SerializerTests(unittest.TestCase):
+
+    def test_flattened_decodes_bson_values(self):
+        from max.rest.utils import flattened
+        oid = ObjectId('4f9d5c5e4d7a8b0001000000')
+        data = {'_id': oid, 'published': datetime(2012, 5, 2, 10, 30, 0), 'verb': 'post', 'count': 3}
+        self.assertEqual(flattened(data), {'id': '4f9d5c5e4d7a8b0001000000',
+                                           'published': '2012-05-02T10:30:00Z',
+                                           'verb': 'post',
+                                           'count': 3})
+
+    def test_flattened_recurses_dicts_and_lists(self):
+        from max.rest.utils import flattened
+        oid = ObjectId('4f9d5c5e4d7a8b0001000000')
+        data = {'actor': {'_id': oid, 'username': 'messi'},
+                'object': {'_hashtags': ['max'], 'content': 'Hello #max'},
+                'replies': {'items': [{'id': oid, 'author': {'_id': oid}}]}}
+        self.assertEqual(flattened(data), {'actor': {'id': '4f9d5c5e4d7a8b0001000000', 'username': 'messi'},
+                                           'object': {'_hashtags': ['max'], 'content': 'Hello #max'},
+                                           'replies': {'items': [{'id': '4f9d5c5e4d7a8b0001000000',
+                                                                  'author': {'id': '4f9d5c5e4d7a8b0001000000'}}]}})
+
+    def test_flattened_underscored_keys_prevail(self):
+        from max.rest.utils import flattened
+        self.assertEqual(flattened({'id': 'old', '_id': 'new'}), {'id': 'new'})
+
+    def test_flattened_keeps_list_values(self):
+        from max.rest.utils import flattened
+        oid = ObjectId()
+        self.assertEqual(flattened([oid, {'_id': oid}]), [oid, {'id': str(oid)}])
+
+    def test_flattened_doesnt_modify_original(self):
+        from max.rest.utils import flattened
+        oid = ObjectId()
+        data = {'_id': oid, 'actor': {'_id': oid}}
+        flattened(data)
+        self.assertEqual(data, {'_id': oid, 'actor': {'_id': oid}})
+
+    def test_flattened_mad_objects_keep_schema_fields(self):
+        """
+            MADDict objects ignore fields not in its schema, so as the legacy in-place
+            flatten did, underscored keys are dropped if the renamed key is not in the schema
+        """
+        from max.rest.utils import flattened
+        from max.ASObjects import Person
+        person = Person({'_id': ObjectId(), 'username': 'messi', 'objectType': 'person'})
+        self.assertEqual(flattened({'object': person}), {'object': {'username': 'messi', 'objectType': 'person'}})
@@ -17,6 +17,7 @@ class mock_post(object):
 
 
 @patch('requests.post', new=mock_post)
+@patch('requests.Session.post', new=mock_post)
 class FunctionalTests(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,197 @@
+"""
+    Materialized (fan-out-on-write) user timelines
+
+    When enabled with the ``max.timeline_fanout`` setting, every time a post
+    activity is inserted, a reference to it is pushed to the timeline of every user
+    that would see it in /people/{username}/timeline: the actor itself, the users
+    following the actor and the users subscribed to any of the activity contexts.
+
+    Each reference is a small document in the "timelines" collection with the form:
+
+        {'owner': <user _id>, 'activity': <activity _id>}
+
+    so reading a timeline page is a single indexed range scan over (owner, activity),
+    followed by a fetch of the referenced activities by _id.
+"""
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
+from pyramid.settings import asbool
+from bson.objectid import ObjectId
+from max.MADMax import MADMaxCollection
+
+TIMELINE_COLLECTION = 'timelines'
+TIMELINE_VERBS = ['post']
+TIMELINE_INDEXES = [
+                    dict(keys=[('owner', ASCENDING), ('activity', DESCENDING)], unique=True),
+                    dict(keys=[('activity', ASCENDING)]),
+                   ]
+
+
+def isTimelineFanOutEnabled(settings):
+    """
+        Returns True if timelines are materialized on write
+    """
+    return asbool(settings.get('max_timeline_fanout', False))
+
+
+def ensureTimelineIndexes(db):
+    """
+        Creates the indexes on which the timeline reads, the unique
+        owner/activity constraint and the removal of deleted activities rely on
+    """
+    for index in TIMELINE_INDEXES:
+        db[TIMELINE_COLLECTION].ensure_index(index['keys'], unique=index.get('unique', False))
+
+
+def buildTimelineQuery(actor, followed_ids=[]):
+    """
+        Builds the query that matches all activities of the actor timeline, this is,
+        the activities from the actor, from the people it follows and
+        from the contexts it's subscribed to
+    """
+    query_items = [{'actor._id': actor['_id']}]
+    query_items += [{'actor._id': followed_id} for followed_id in followed_ids]
+    query_items += [{'contexts.url': subscribed['url']} for subscribed in actor.get('subscribedTo', {}).get('items', [])]
+
+    query = {'$or': query_items}
+    query['verb'] = {'$in': TIMELINE_VERBS}
+    return query
+
+
+def getTimelineRecipients(db, activity):
+    """
+        Returns the _id's of the users that have to receive the activity in its timeline
+    """
+    if activity.get('verb') not in TIMELINE_VERBS:
+        return []
+
+    actor = activity.get('actor', {})
+    criteria = []
+    if actor.get('objectType') == 'person':
+        criteria.append({'_id': actor['_id']})
+        criteria.append({'following.items.username': actor['username']})
+
+    urls = [context['url'] for context in activity.get('contexts', [])]
+    if urls:
+        criteria.append({'subscribedTo.items.url': {'$in': urls}})
+
+    if not criteria:
+        return []
+    return [user['_id'] for user in db.users.find({'$or': criteria}, {'_id': 1})]
+
+
+def insertTimelineEntries(db, entries, batch_size=1000):
+    """
+        Inserts timeline references in batches. References already present
+        are silently skipped
+    """
+    for start in range(0, len(entries), batch_size):
+        try:
+            db[TIMELINE_COLLECTION].insert(entries[start:start + batch_size], continue_on_error=True)
+        except DuplicateKeyError:
+            pass
+
+
+def fanOutActivity(db, activity):
+    """
+        Pushes a newly inserted activity to the timelines of all its recipients
+    """
+    fanOutActivities(db, [activity])
+
+
+def fanOutActivities(db, activities):
+    """
+        Pushes many newly inserted activities to the timelines of its recipients,
+        with a single batch insert
+    """
+    entries = []
+    for activity in activities:
+        activity_id = ObjectId(activity['_id'])
+        entries.extend([{'owner': owner, 'activity': activity_id} for owner in getTimelineRecipients(db, activity)])
+    insertTimelineEntries(db, entries)
+
+
+def removeActivityFromTimelines(db, activity_id):
+    """
+        Removes a deleted activity from all the timelines it was pushed to, so
+        timeline pages don't come back short of items
+    """
+    db[TIMELINE_COLLECTION].remove({'activity': ObjectId(activity_id)})
+
+
+def removeContextFromTimelines(db, url, owners):
+    """
+        Removes the activities of a context from the timelines of the owners that lost
+        its subscription, except the ones they still receive from another source
+        (their own activities, the followed people or another subscribed context).
+        The owners subscriptions must be already removed
+    """
+    activity_ids = [activity['_id'] for activity in db.activity.find({'contexts.url': url, 'verb': {'$in': TIMELINE_VERBS}}, {'_id': 1})]
+    if not activity_ids or not owners:
+        return
+    db[TIMELINE_COLLECTION].remove({'owner': {'$in': owners}, 'activity': {'$in': activity_ids}})
+
+    users = MADMaxCollection(db.users)
+    for user in db.users.find({'_id': {'$in': owners}}):
+        user = users.ItemWrapper(user)
+        query = buildTimelineQuery(user, user.getFollowedIds())
+        query['_id'] = {'$in': activity_ids}
+        backfillTimeline(db, user['_id'], query)
+
+
+def backfillTimeline(db, owner, query):
+    """
+        Adds to the owner timeline all the existing activities matching query.
+        Used when a user gains new sources for its timeline (ie. subscribes to a context)
+    """
+    query = dict(query)
+    query.setdefault('verb', {'$in': TIMELINE_VERBS})
+    entries = [{'owner': owner, 'activity': activity['_id']} for activity in db.activity.find(query, {'_id': 1})]
+    insertTimelineEntries(db, entries)
+
+
+def rebuildUserTimeline(db, user):
+    """
+        Discards and recreates from scratch the materialized timeline of a user.
+        user must be a max.models.User object
+    """
+    db[TIMELINE_COLLECTION].remove({'owner': user['_id']})
+    backfillTimeline(db, user['_id'], buildTimelineQuery(user, user.getFollowedIds()))
+
+
+def rebuildTimelines(db, usernames=[]):
+    """
+        Rebuilds the timelines of the specified usernames, or of all users if none specified.
+        Returns the number of timelines rebuilt
+    """
+    ensureTimelineIndexes(db)
+    query = usernames and {'username': {'$in': usernames}} or {}
+    rebuilt = 0
+    users = MADMaxCollection(db.users)
+    for user in db.users.find(query):
+        rebuildUserTimeline(db, users.ItemWrapper(user))
+        rebuilt += 1
+    return rebuilt
+
+
+def getTimelineActivityIds(db, owner, limit=None, after=None, before=None, **kwargs):
+    """
+        Returns the _id's of the activities in a page of the materialized owner timeline,
+        newest first.
+    """
+    query = {'owner': owner}
+    if after or before:
+        condition = after and '$gt' or '$lt'
+        query['activity'] = {condition: after or before}
+
+    # When paging forward, take the page closest to the offset, not the newest one
+    walk_forward = after and limit
+    cursor = db[TIMELINE_COLLECTION].find(query, {'activity': 1})
+    cursor = cursor.sort('activity', walk_forward and ASCENDING or DESCENDING)
+    if limit:
+        cursor = cursor.limit(limit)
+    ids = [entry['activity'] for entry in cursor]
+    if walk_forward:
+        ids.reverse()
+    return ids
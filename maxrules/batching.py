@@ -0,0 +1,77 @@
+"""
+    Micro-batching of the tweets received from the stream
+
+    Instead of sending a task to the workers for each tweet, tweets are collected and
+    sent together when the batch is full or when its first tweet has waited for the
+    batch window. A tweet is never held longer than the window, and no more than a
+    batch of tweets is ever kept in memory.
+"""
+import threading
+import logging
+import time
+
+logger = logging.getLogger("tweeterlistener")
+
+
+class TweetBatcher(object):
+    """
+        Collects tweets and hands them in batches to flush, a callable receiving the
+        list of tweets, from the caller thread when full or from a background thread
+        when the window expires
+    """
+
+    def __init__(self, flush, size, window):
+        self.flush = flush
+        self.size = size
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = []
+        self.started = None
+        self.thread = threading.Thread(target=self.watch, name='maxrules-tweet-batcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, tweet):
+        """
+            Adds a tweet to the current batch, sending it if full
+        """
+        with self.lock:
+            if not self.pending:
+                self.started = time.time()
+            self.pending.append(tweet)
+            batch = len(self.pending) >= self.size and self.take() or None
+        self.send(batch)
+
+    def take(self):
+        """
+            Returns the current batch and starts a new one. Must hold the lock
+        """
+        batch, self.pending = self.pending, []
+        return batch
+
+    def send(self, batch):
+        """
+            Hands a batch to flush, if any, logging the errors
+        """
+        if not batch:
+            return
+        try:
+            self.flush(batch)
+        except Exception:
+            logger.exception('Error sending a batch of %d tweets' % len(batch))
+
+    def expired(self):
+        """
+            Returns the current batch if its first tweet has waited for the window
+        """
+        with self.lock:
+            if self.pending and time.time() - self.started >= self.window:
+                return self.take()
+
+    def watch(self):
+        """
+            Sends the batches whose window expired, forever
+        """
+        while True:
+            time.sleep(self.window / 10.0)
+            self.send(self.expired())
@@ -7,6 +7,15 @@ BROKER_VHOST = "localhost"
 CELERY_RESULT_BACKEND = "amqp"
 CELERY_IMPORTS = ("maxrules.tasks", "max.models")
 
-# MongoDB config
-mongodb_url = "mongodb://localhost"
-mongodb_db_name = "max"
+# Seconds the tweet routing tables are kept before reloading them, even if
+# no context or user twitter fields changed meanwhile
+routing_tables_max_age = 300
+
+# Configuration of the MAX application the tweets are posted to. Its settings
+# and database are used to create the activities in-process
+max_ini_file = "/var/pyramid/maxserver/config/max.ini"
+
+# Tweets received from the stream are sent to the workers in batches of up to
+# tweet_batch_size tweets, waiting at most tweet_batch_window seconds to fill them
+tweet_batch_size = 50
+tweet_batch_window = 2
@@ -0,0 +1,97 @@
+"""
+    In-memory tables to route tweets to MAX contexts and users
+
+    Instead of querying the contexts and users collections for every tweet, each worker
+    keeps the contexts and users with twitter fields in memory, and reloads them when
+    the twitter routing version changes (see max.routing) or when they get too old.
+"""
+from max.MADMax import MADMaxCollection
+from max.routing import getTwitterRoutingVersion
+import threading
+import time
+
+
+class TwitterRoutingTables(object):
+    """
+        Routing tables of a worker process:
+
+            contexts_by_username: lowercased twitter username to the contexts that follow it
+            contexts_by_hashtag: lowercased hashtag to the contexts that track it
+            users_by_username: lowercased twitter username to the _id of its MAX user
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.version = None
+        self.loaded_at = 0
+        self.contexts_by_username = {}
+        self.contexts_by_hashtag = {}
+        self.users_by_username = {}
+
+    def load(self, db, version):
+        """
+            Reloads the tables from the database
+        """
+        contexts = MADMaxCollection(db.contexts).search({'$or': [{'twitterUsername': {'$exists': True}},
+                                                                 {'twitterHashtag': {'$exists': True}}]})
+        users = MADMaxCollection(db.users).search({'twitterUsername': {'$exists': True}}, show_fields=['_id', 'twitterUsername'])
+
+        # Only the contexts whose twitter username was resolved are followed
+        followed = set([context['twitterUsername'].lower() for context in contexts if context.get('twitterUsername') and 'twitterUsernameId' in context])
+        contexts_by_username = {}
+        contexts_by_hashtag = {}
+        for context in contexts:
+            username = (context.get('twitterUsername') or '').lower()
+            if username in followed:
+                contexts_by_username.setdefault(username, []).append(context)
+            hashtag = (context.get('twitterHashtag') or '').lower()
+            if hashtag:
+                contexts_by_hashtag.setdefault(hashtag, []).append(context)
+
+        users_by_username = {}
+        for user in users:
+            username = (user.get('twitterUsername') or '').lower()
+            if username:
+                users_by_username.setdefault(username, user['_id'])
+
+        self.contexts_by_username = contexts_by_username
+        self.contexts_by_hashtag = contexts_by_hashtag
+        self.users_by_username = users_by_username
+        self.version = version
+        self.loaded_at = time.time()
+
+    def refresh(self, db):
+        """
+            Reloads the tables if the routing version changed or they are too old.
+            Costs a single lookup of the routing version otherwise.
+        """
+        version = getTwitterRoutingVersion(db)
+        with self.lock:
+            if version != self.version or time.time() - self.loaded_at > self.max_age:
+                self.load(db, version)
+
+    def getFollowingContexts(self, twitter_username):
+        """
+            Returns the contexts following a twitter username
+        """
+        return self.contexts_by_username.get(twitter_username.lower(), [])
+
+    def getTrackingContexts(self, hashtags):
+        """
+            Returns the contexts tracking any of the hashtags, without repetitions
+        """
+        found = []
+        found_ids = set()
+        for hashtag in hashtags:
+            for context in self.contexts_by_hashtag.get(hashtag.lower(), []):
+                if context['_id'] not in found_ids:
+                    found_ids.add(context['_id'])
+                    found.append(context)
+        return found
+
+    def getUserId(self, twitter_username):
+        """
+            Returns the _id of the MAX user with a twitter username, or None
+        """
+        return self.users_by_username.get(twitter_username.lower())
@@ -1,12 +1,17 @@
 from celery.task import task
-from maxrules.twitter import twitter_generator_name, debug_hashtag, max_server_url
-import requests
-import pymongo
-from maxrules.config import mongodb_url, mongodb_db_name
+from pyramid.paster import get_appsettings
+from pyramid.registry import Registry
+from maxrules.twitter import twitter_generator_name, debug_hashtag
+from maxrules import config
+from maxrules.routing import TwitterRoutingTables
 from max.MADMax import MADMaxCollection
+from max.mongodb import getDatabase, getWriteConcerns
+from max.resources import loadMAXSettings
+from max.shortener import URLShortenerPool
+from max.exceptions import ObjectNotFound, Unauthorized
+from max.services import addActivities, ACTIVITY_ERRORS
 from max.rest.utils import canWriteInContexts
 from max.rest.utils import findHashtags
-import json
 import logging
 
 
@@ -19,122 +24,182 @@ logger.setLevel(logging.DEBUG)
 fh.setFormatter(formatter)
 logger.addHandler(fh)
 
+# Contexts and users to route the tweets to, shared by the tasks of this worker
+routing_tables = TwitterRoutingTables(max_age=config.routing_tables_max_age)
+
+# Registry the activities are created with
+max_registry = None
 
-@task
-def processTweet(twitter_username, content, tweetID='---'):
-    """ Process inbound tweet
-    """
-    logger.info("(INFO) Processing tweet %s from @%s with content: %s" % (str(tweetID), twitter_username, content))
 
-    conn = pymongo.Connection(mongodb_url)
-    db = conn[mongodb_db_name]
+def getMAXRegistry():
+    """
+        Returns a registry with the parts of the MAX application configured in
+        config.max_ini_file that creating activities needs: its settings, database,
+        write concerns and url shortener, built the first time. Activities are created
+        in-process with them, instead of posting them to the MAX REST API. The rest of
+        the application (oauth, notification feed, sampler, indexes) is not started.
+    """
+    global max_registry
+    if max_registry is None:
+        settings = get_appsettings(config.max_ini_file)
+        registry = Registry('maxrules')
+        registry.max_store = getDatabase(settings)
+        registry.max_write_concerns = getWriteConcerns(settings)
+        registry.max_settings = loadMAXSettings(settings, None)
+        registry.max_shortener = URLShortenerPool.fromSettings(registry.max_settings, registry.max_store)
+        max_registry = registry
+    return max_registry
+
+
+def buildTweetActivity(content, context_url):
+    """ Returns the data of the activity a tweet is posted as on a context
+    """
+    return {
+        "object": {
+            "objectType": "note",
+            "content": content
+        },
+        "contexts": [
+            context_url,
+        ],
+        "generator": twitter_generator_name
+    }
+
+
+def routeTweet(db, twitter_username, content, tweetID='---'):
+    """ Finds where an inbound tweet has to be posted, with the routing tables.
+        Returns the activities to create as (actor, activity data) pairs, and the
+        result of the tweet if some or all of them are discarded.
+    """
     users = MADMaxCollection(db.users)
     contexts = MADMaxCollection(db.contexts)
 
-    contexts_with_twitter_username = contexts.search({"twitterUsernameId": {"$exists": True}})
-    readable_follow_list = [users_to_follow.get('twitterUsername', '').lower() for users_to_follow in contexts_with_twitter_username]
     twitter_username = twitter_username.lower()
+    # Find the contexts following the user of the tweet
+    maxcontext = routing_tables.getFollowingContexts(twitter_username)
     # If we have a tweet from a followed user
-    if twitter_username in readable_follow_list:
-        # Find the context
-        maxcontext = contexts.search({"twitterUsername": twitter_username})
-
-        # Watch for the case when two or more context share twitterUsername
+    if maxcontext:
+        # Watch for the case when two or more context share twitterUsername,
+        # and post it impersonated as each context, freshly loaded
+        postings = []
         for context in maxcontext:
-            url_hash = context.get("urlHash")
-            context_url = context.get("url")
-
-            # Construct the payload with the activity information
-            newactivity = {
-                "object": {
-                    "objectType": "note",
-                    "content": content
-                },
-                "contexts": [
-                    context_url,
-                ],
-                "generator": twitter_generator_name
-            }
-
-            re = requests.post('%s/admin/contexts/%s/activities' % (max_server_url, url_hash), json.dumps(newactivity), auth=('admin', 'admin'), verify=False)
-            if re.status_code == 201:
-                # 200: Successful tweet from context
-                logger.info("(201) Successfully posted tweet %s from @%s as context %s" % (str(tweetID), twitter_username, context_url))
-                return "(201) %s tweet from context %s" % (twitter_username, context_url)
-            else:
-                # 500: Error accessing the MAX API
-                logger.info("(404) Discarding tweet %s from @%s : There's no MAX user with that twitter username." % (str(tweetID), twitter_username))
-                return "(404) No Such Max User"
-
-        return "Should not see me..."
+            try:
+                postings.append((contexts[context['_id']], buildTweetActivity(content, context['url'])))
+            except ObjectNotFound:
+                logger.info("(404) Discarding tweet %s from @%s : The context %s no longer exists." % (str(tweetID), twitter_username, context['url']))
+        return postings, not postings and "(404) No Such Max Context" or None
 
     # If we have a tweet from a tracked hashtag
     # Parse text and determine the second or nth hashtag
     possible_hastags = findHashtags(content)
-    # Prepare query with normalized possible_hastags
-
-    query = [dict(twitterHashtag=hashtag.lower()) for hashtag in possible_hastags]
 
     if debug_hashtag in possible_hastags:
         logger.info("%s Debug hashtag detected!" % content)
-        return "%s Debug hashtag detected! %s" % content
+        return [], "%s Debug hashtag detected!" % content
 
     # Check if twitter_username is a registered for a valid MAX username
     # if not, discard it
-    maxuser = users.search({"twitterUsername": twitter_username})
-    if maxuser:
-        maxuser = maxuser[0]
-    else:
+    maxuser_id = routing_tables.getUserId(twitter_username)
+    if maxuser_id is None:
         logger.info("(404) Discarding tweet %s from @%s : There's no MAX user with that twitter username." % (str(tweetID), twitter_username))
-        return "(404) %s: No such MAX user." % twitter_username
+        return [], "(404) %s: No such MAX user." % twitter_username
 
     # Check if hashtag is registered for a valid MAX context
     # if not, discard it
-    successful_tweets = 0
-    maxcontext = contexts.search({"$or": query})
-    if maxcontext:
-        for context in maxcontext:
-            # Check if MAX username has permission to post to the MAX context
-            # if not, discard it
-            try:
-                can_write = canWriteInContexts(maxuser, [context.url])
-            except:
-                can_write = False
-                logger.info("(401) Failure posting tweet %s: User %s can't write to %s" % (str(tweetID), maxuser.username, context['url']))
-
-            if can_write:
-
-                # Construct the payload with the activity information
-                newactivity = {
-                    "object": {
-                        "objectType": "note",
-                        "content": content
-                    },
-                    "contexts": [
-                        context.url,
-                    ],
-                    "generator": twitter_generator_name
-                }
-
-                # Use the restricted REST endpoint for create a new activity in the specified
-                # MAX context in name of the specified MAX username
-                re = requests.post('%s/admin/people/%s/activities' % (max_server_url, maxuser.username), json.dumps(newactivity), auth=('admin', 'admin'), verify=False)
-                if re.status_code == 201:
-                    logger.info("(201) Successfully posted tweet %s from @%s as %s on context %s" % (str(tweetID), twitter_username, maxuser['username'], context.url))
-                    successful_tweets += 1
-                    #return "(201) Successful tweet from user %s in context %s" % (maxuser, context.url)
-                else:
-                    logger.info("(500) Error accessing the MAX API at %s" % max_server_url)
-                    #return "(500) MAX API error"
-
-        error_message = len(maxcontext) != successful_tweets and " We weren't able to send the tweet to all contexts. See above for more information." or ""
-        logger.info("(INFO) Processed tweet %s to %d of %d possible contexts.%s" % (str(tweetID), successful_tweets, len(maxcontext), error_message))
-        if error_message:
-            return "(401) Some posts not sent"
-        else:
-            return "(200) All posts sent"
-    else:
+    maxcontext = routing_tables.getTrackingContexts(possible_hastags)
+    if not maxcontext:
         logger.info("(404) Discarding tweet %s from @%s: There are no MAX context with any of those hashtags" % (str(tweetID), twitter_username))
-        return "(404) %s: Not such MAX context %s" % (maxuser.username, maxcontext)
+        return [], "(404) %s: Not such MAX context" % twitter_username
+
+    # Load the user only now, as its subscriptions must be up to date to check its permissions
+    try:
+        maxuser = users[maxuser_id]
+    except ObjectNotFound:
+        logger.info("(404) Discarding tweet %s from @%s : There's no MAX user with that twitter username." % (str(tweetID), twitter_username))
+        return [], "(404) %s: No such MAX user." % twitter_username
+
+    postings = []
+    for context in maxcontext:
+        # Check if MAX username has permission to post to the MAX context
+        # if not, discard it
+        try:
+            canWriteInContexts(maxuser, [context.url])
+        except:
+            logger.info("(401) Failure posting tweet %s: User %s can't write to %s" % (str(tweetID), maxuser.username, context['url']))
+        else:
+            # Post in name of the MAX username in the specified MAX context
+            postings.append((maxuser, buildTweetActivity(content, context.url)))
+
+    return postings, len(postings) != len(maxcontext) and "(401) Some posts not sent" or None
+
+
+def getPostingErrorCode(error):
+    """ Returns the status code a posting failed with, like the REST API would answer
+    """
+    if isinstance(error, Unauthorized):
+        return 401
+    if isinstance(error, ACTIVITY_ERRORS):
+        return 400
+    return 500
+
+
+def processTweetBatch(tweets):
+    """ Routes a batch of inbound tweets, given as (twitter_username, content, tweetID)
+        tuples, and creates all the resulting activities in a single bulk operation.
+        Returns the result of each tweet, in the same order. A failure routing a tweet
+        or creating one of its activities doesn't affect the rest of the batch.
+    """
+    registry = getMAXRegistry()
+    db = registry.max_store
+    routing_tables.refresh(db)
+
+    results = []
+    postings = []
+    for position, (twitter_username, content, tweetID) in enumerate(tweets):
+        logger.info("(INFO) Processing tweet %s from @%s with content: %s" % (str(tweetID), twitter_username, content))
+        try:
+            routed, result = routeTweet(db, twitter_username, content, tweetID)
+        except Exception:
+            logger.exception("(500) Error routing tweet %s from @%s" % (str(tweetID), twitter_username))
+            routed, result = [], "(500) Error processing tweet"
+        results.append(result)
+        postings.extend([(position, actor, activity) for actor, activity in routed])
+
+    try:
+        created = addActivities(registry, db, [(actor, activity) for position, actor, activity in postings])
+    except Exception, error:
+        logger.exception("(500) Error posting a batch of %d tweets" % len(tweets))
+        created = [error] * len(postings)
+
+    # Worst status code of the failed postings of each tweet
+    failed = {}
+    for (position, actor, activity), newactivity in zip(postings, created):
+        tweetID = tweets[position][2]
+        actor_name = actor.get('username') or actor.get('url')
+        if isinstance(newactivity, Exception):
+            code = getPostingErrorCode(newactivity)
+            failed[position] = max(code, failed.get(position, 0))
+            logger.info("(%d) Error posting tweet %s as %s on context %s: %s" % (code, str(tweetID), actor_name, activity['contexts'][0], getattr(newactivity, 'value', newactivity)))
+        else:
+            logger.info("(201) Successfully posted tweet %s as %s on context %s" % (str(tweetID), actor_name, activity['contexts'][0]))
+
+    for position, result in enumerate(results):
+        if position in failed:
+            results[position] = "(%d) Some posts not sent" % failed[position]
+        elif result is None:
+            results[position] = "(200) All posts sent"
+    return results
 
-    return "Should not see mee"
+
+@task
+def processTweet(twitter_username, content, tweetID='---'):
+    """ Process inbound tweet
+    """
+    return processTweetBatch([(twitter_username, content, tweetID)])[0]
+
+
+@task
+def processTweets(tweets):
+    """ Process a batch of inbound tweets, given as (twitter_username, content, tweetID) tuples
+    """
+    return processTweetBatch(tweets)
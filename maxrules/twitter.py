@@ -4,7 +4,9 @@ import sys
 import optparse
 #from getpass import getpass
 from textwrap import TextWrapper
-import pymongo
+from max.mongodb import getConnection
+from maxrules.batching import TweetBatcher
+from maxrules import config
 import tweepy
 
 import logging
@@ -32,16 +34,26 @@ def main(argv=sys.argv, quiet=False):
     return command.run()
 
 
+def sendTweets(tweets):
+    """ Sends a batch of tweets to be processed by the workers
+    """
+    from maxrules.tasks import processTweets
+    processTweets.delay(tweets)
+
+
 class StreamWatcherListener(tweepy.StreamListener):
 
     status_wrapper = TextWrapper(width=60, initial_indent='    ', subsequent_indent='    ')
 
+    def __init__(self, *args, **kwargs):
+        super(StreamWatcherListener, self).__init__(*args, **kwargs)
+        self.batcher = TweetBatcher(sendTweets, size=config.tweet_batch_size, window=config.tweet_batch_window)
+
     def on_status(self, status):
         try:
             logger.info('Got tweet %d from %s via %s with content: %s' % (status.id, status.author.screen_name, status.source, status.text))
-            # Insert the new data in MAX
-            from maxrules.tasks import processTweet
-            processTweet.delay(status.author.screen_name.lower(), status.text, status.id)
+            # Insert the new data in MAX, along with the rest of the batch
+            self.batcher.add((status.author.screen_name.lower(), status.text, status.id))
         except:
             # Catch any unicode errors while printing to console
             # and just ignore them to avoid breaking application.
@@ -96,7 +108,7 @@ class MaxTwitterRulesRunner(object):
         #track_list = raw_input('Keywords to track (comma seperated):').strip()
 
         # Querying the BBDD for users to follow.
-        conn = pymongo.Connection(self.options.mongodb_url[0])
+        conn = getConnection(self.options.mongodb_url[0])
         db = conn[self.options.mongodb_db_name[0]]
         contexts_with_twitter_username = db.contexts.find({"twitterUsernameId": {"$exists": True}})
         follow_list = [users_to_follow.get('twitterUsernameId') for users_to_follow in contexts_with_twitter_username]
@@ -50,5 +50,8 @@ setup(name='max',
       main = max:main
       [console_scripts]
       maxrules.twitter = maxrules.twitter:main
+      max.timelines = max.scripts.timelines:main
+      max.indexes = max.scripts.indexes:main
+      max.terms = max.scripts.terms:main
       """,
       )